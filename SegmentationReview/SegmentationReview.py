@@ -1,7 +1,10 @@
 import logging
+import multiprocessing
 import os, shutil
+import time
 
 import vtk
+from vtk.util import numpy_support
 
 import pathlib
 from pathlib import Path
@@ -12,6 +15,7 @@ from slicer.util import VTKObservationMixin
 import ctk
 import qt
 from datetime import datetime
+from itertools import chain
 import SegmentStatistics
 import logging
 #from qt import QtCore, QtGui
@@ -29,6 +33,43 @@ except:
     import pandas as pd
     import numpy as np
     import SimpleITK as sitk
+
+from SegmentationReviewLib import (
+    DEFAULT_MASK_PATTERNS,
+    CasePrefetcher,
+    MASK_EDITED,
+    CentroidCache,
+    ComparisonPass,
+    DOCTOR_FILENAME,
+    DatasetDoctor,
+    MaskWriter,
+    PreviewCache,
+    QualityPrePass,
+    ResampleCache,
+    ResamplePass,
+    ReviewSession,
+    SCHEDULERS,
+    SessionLog,
+    StageTimer,
+    TIMINGS_FILENAME,
+    VolumeCache,
+    geometry_from_ijk_to_ras,
+    has_revisions,
+    ijk_to_ras,
+    joinpath,
+    label_statistics,
+    parse_mask_patterns,
+    export_annotations,
+    read_case,
+    read_cropped_case,
+    read_timings,
+    reviewer_name,
+    revisions_directory,
+    save_edit,
+    save_mask,
+    save_uncropped,
+    summarize_timings,
+)
 #
 # SegmentationReview
 #
@@ -78,22 +119,29 @@ class SegmentationReviewWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self._updatingGUIFromParameterNode = False
         self.volume_node = None
         self.segmentation_node = None
-        self.nifti_files = []
-        self.segmentation_files = []
-        self.directory=None
-        self.current_index=0
-        self.likert_scores = []
-        self.n_files = 0
-        self.seg_mask_status = [] # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded, 3- mask edited
-        self.with_mapper_flag = False
-        self.id_subs = []
-        self.id_subs_checked = []
-        self.unique_case_flag=False
-        self.finish_flag = False
         self.pointListNode = None
         self.window_level = None   # To store current window/level settings
-        self.segment_visiblity_states = {}  # Dictionary to store the visibility toggle of each segment
-
+        self.segment_visiblity_states = {}  # Dictionary to store the visibility toggle of each segment (by segment name)
+        self.prefetcher = None  # reads the next cases in the background
+        self.reuse_nodes = False  # keep one set of nodes and swap the data of each case into them
+        self.array_loader = False  # read cases with SimpleITK into shared arrays instead of the Slicer file readers
+        self.labelmap_node = None  # pooled labelmap used to import masks into the pooled segmentation
+        self.segmentEditorNode = None
+        self.scanTimer = None  # adds the cases found by a recursive directory scan
+        self.volume_cache = None  # memory-mapped decompressed volumes, None if disabled
+        self.preview_cache = None  # downsampled previews of the current dataset, None if disabled
+        self.resample_cache = None  # masks of the current dataset resampled to their image grid, None if disabled
+        self.refineTimer = None  # swaps the full resolution data in once it is read
+        self._refine_index = None  # case shown as a preview, waiting for its full resolution data
+        self.mask_writer = None  # writes edited masks in the background
+        self.saveTimer = None  # reports the masks written in the background
+        self._pending_saves = []  # (future, session, index, path, previous path, previous status) of running saves
+        self.qaTimer = None  # follows the QA pre-pass of the dataset
+        self.checkTimer = None  # follows the header check of the dataset
+        self.compareTimer = None  # follows the comparison of the predictions of the dataset
+        self.prediction_nodes = []  # segmentation nodes of the predictions of the current case, in comparison mode
+        self.timer = StageTimer()  # times the stages of each case, disabled unless the timing log is on
+        self._crop = None  # region of the full-size mask if the current case is cropped to its mask
 
 
     def setup(self):
@@ -162,6 +210,31 @@ class SegmentationReviewWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         # add a paint brush from segment editor window
         # Create a new segment editor widget and add it to the NiftyViewerWidget
         self._createSegmentEditorWidget_()
+
+        self._createAdvancedSettingsWidget_()
+        self.prefetcher = CasePrefetcher(depth=self.prefetchDepthSpinBox.value,
+                                         max_bytes=self.prefetchMemorySpinBox.value * 1024 ** 2,
+                                         crop_margin_mm=self.cropMarginSpinBox.value)
+        self.onVolumeCacheSettingsChanged()
+        self.scanTimer = qt.QTimer()
+        self.scanTimer.setInterval(250)
+        self.scanTimer.connect('timeout()', self.onScanTimer)
+        self.refineTimer = qt.QTimer()
+        self.refineTimer.setInterval(100)
+        self.refineTimer.connect('timeout()', self.onRefineTimer)
+        self.mask_writer = MaskWriter(compression_level=self.maskCompressionSpinBox.value)
+        self.saveTimer = qt.QTimer()
+        self.saveTimer.setInterval(200)
+        self.saveTimer.connect('timeout()', self.onSaveTimer)
+        self.qaTimer = qt.QTimer()
+        self.qaTimer.setInterval(1000)
+        self.qaTimer.connect('timeout()', self.onQATimer)
+        self.checkTimer = qt.QTimer()
+        self.checkTimer.setInterval(1000)
+        self.checkTimer.connect('timeout()', self.onCheckTimer)
+        self.compareTimer = qt.QTimer()
+        self.compareTimer.setInterval(1000)
+        self.compareTimer.connect('timeout()', self.onCompareTimer)
         
         #self.segmentEditorWidgetWidget.volumes.collapsed = True
          # Set parameter node first so that the automatic selections made when the scene is set are saved
@@ -170,6 +243,11 @@ class SegmentationReviewWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         # Make sure parameter node is initialized (needed for module reload)
         #self.initializeParameterNode()
 
+    @property
+    def session(self):
+        """The review session of the current dataset directory, owned by the logic"""
+        return self.logic.session
+
     def _createSegmentEditorWidget_(self):
         """Create and initialize a customize Slicer Editor which contains just some the tools that we need for the segmentation"""
 
@@ -206,6 +284,292 @@ class SegmentationReviewWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
         self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndImportEvent, self.onSceneEndImport)
         
+    def _createAdvancedSettingsWidget_(self):
+        """Create the collapsed panel with performance settings, persisted in the application settings"""
+        advancedCollapsibleButton = ctk.ctkCollapsibleButton()
+        advancedCollapsibleButton.text = "Advanced"
+        advancedCollapsibleButton.collapsed = True
+        self.layout.addWidget(advancedCollapsibleButton)
+        self.advancedFormLayout = qt.QFormLayout(advancedCollapsibleButton)
+
+        # number of upcoming cases read in the background while the current one is rated
+        self.prefetchDepthSpinBox = qt.QSpinBox()
+        self.prefetchDepthSpinBox.setRange(0, 16)
+        self.prefetchDepthSpinBox.value = slicer.util.settingsValue("SegmentationReview/PrefetchDepth", 2, converter=int)
+        self.prefetchDepthSpinBox.toolTip = "Number of upcoming cases read in the background (0 disables prefetching)"
+        self.advancedFormLayout.addRow("Prefetch depth: ", self.prefetchDepthSpinBox)
+
+        self.prefetchMemorySpinBox = qt.QSpinBox()
+        self.prefetchMemorySpinBox.setRange(0, 256 * 1024)
+        self.prefetchMemorySpinBox.suffix = " MB"
+        self.prefetchMemorySpinBox.value = slicer.util.settingsValue("SegmentationReview/PrefetchMemoryMB", 2048, converter=int)
+        self.prefetchMemorySpinBox.toolTip = "Maximum memory held by prefetched cases"
+        self.advancedFormLayout.addRow("Prefetch memory: ", self.prefetchMemorySpinBox)
+
+        self.prefetchDepthSpinBox.connect('valueChanged(int)', self.onPrefetchSettingsChanged)
+        self.prefetchMemorySpinBox.connect('valueChanged(int)', self.onPrefetchSettingsChanged)
+
+        # where ratings are stored; SQLite keeps annotations.csv up to date when a session is closed
+        self.annotationBackendComboBox = qt.QComboBox()
+        self.annotationBackendComboBox.addItem("CSV (annotations.csv)", "csv")
+        self.annotationBackendComboBox.addItem("SQLite (annotations.sqlite)", "sqlite")
+        self.annotationBackendComboBox.currentIndex = max(0, self.annotationBackendComboBox.findData(
+            slicer.util.settingsValue("SegmentationReview/AnnotationBackend", "csv")))
+        self.annotationBackendComboBox.toolTip = "Storage of the ratings, used for the next opened directory"
+        self.advancedFormLayout.addRow("Annotation storage: ", self.annotationBackendComboBox)
+        self.annotationBackendComboBox.connect('currentIndexChanged(int)', self.onAnnotationBackendChanged)
+
+        # node pool: the scene keeps the same volume/segmentation/point list nodes for the whole session
+        self.reuseNodesCheckBox = qt.QCheckBox()
+        self.reuseNodesCheckBox.checked = slicer.util.settingsValue("SegmentationReview/ReuseNodes", False, converter=slicer.util.toBool)
+        self.reuseNodesCheckBox.toolTip = "Keep one volume, segmentation, editor and point list node and swap the data of each case into them"
+        self.advancedFormLayout.addRow("Reuse scene nodes: ", self.reuseNodesCheckBox)
+        self.reuseNodesCheckBox.connect('toggled(bool)', self.onReuseNodesToggled)
+        self.reuse_nodes = self.reuseNodesCheckBox.checked
+
+        # read with SimpleITK and hand the voxel buffers to the nodes, instead of slicer.util.loadVolume/loadSegmentation
+        self.arrayLoaderCheckBox = qt.QCheckBox()
+        self.arrayLoaderCheckBox.checked = slicer.util.settingsValue("SegmentationReview/ArrayLoader", False, converter=slicer.util.toBool)
+        self.arrayLoaderCheckBox.toolTip = ("Read the cases that were not read ahead with SimpleITK and give the voxels to the scene without "
+                                            "copying them (falls back to the Slicer readers for files SimpleITK cannot read)")
+        self.advancedFormLayout.addRow("Load with SimpleITK: ", self.arrayLoaderCheckBox)
+        self.arrayLoaderCheckBox.connect('toggled(bool)', self.onArrayLoaderToggled)
+        self.array_loader = self.arrayLoaderCheckBox.checked
+
+        # without mapping file: walk the subfolders in the background and pair images and masks by name patterns
+        self.recursiveScanCheckBox = qt.QCheckBox()
+        self.recursiveScanCheckBox.checked = slicer.util.settingsValue("SegmentationReview/RecursiveScan", False, converter=slicer.util.toBool)
+        self.recursiveScanCheckBox.toolTip = "Without mapping file, also look for cases in subfolders; the review starts while the scan is running"
+        self.advancedFormLayout.addRow("Scan subfolders: ", self.recursiveScanCheckBox)
+
+        self.maskPatternsLineEdit = qt.QLineEdit()
+        self.maskPatternsLineEdit.text = slicer.util.settingsValue("SegmentationReview/MaskPatterns", ", ".join(DEFAULT_MASK_PATTERNS))
+        self.maskPatternsLineEdit.toolTip = "Comma separated mask file names of an image {stem} (its name without extension), * and ? are wildcards"
+        self.advancedFormLayout.addRow("Mask patterns: ", self.maskPatternsLineEdit)
+
+        self.recursiveScanCheckBox.connect('toggled(bool)', self.onScanSettingsChanged)
+        self.maskPatternsLineEdit.connect('editingFinished()', self.onScanSettingsChanged)
+
+        # decompressed volumes kept in the Slicer cache folder and memory-mapped when a case is opened again
+        self.volumeCacheSpinBox = qt.QSpinBox()
+        self.volumeCacheSpinBox.setRange(0, 4096)
+        self.volumeCacheSpinBox.suffix = " GB"
+        self.volumeCacheSpinBox.value = slicer.util.settingsValue("SegmentationReview/VolumeCacheGB", 0, converter=int)
+        self.volumeCacheSpinBox.toolTip = "Disk space for decompressed volumes in the Slicer cache folder (0 disables the cache)"
+        self.advancedFormLayout.addRow("Volume cache: ", self.volumeCacheSpinBox)
+        self.volumeCacheSpinBox.connect('valueChanged(int)', self.onVolumeCacheSettingsChanged)
+
+        # show a downsampled preview first and swap in the full resolution data when it is read
+        self.previewFirstCheckBox = qt.QCheckBox()
+        self.previewFirstCheckBox.checked = slicer.util.settingsValue("SegmentationReview/PreviewFirst", False, converter=slicer.util.toBool)
+        self.previewFirstCheckBox.toolTip = "Show a low resolution preview (stored next to the dataset) while the full resolution case is loaded"
+        self.advancedFormLayout.addRow("Preview first: ", self.previewFirstCheckBox)
+        self.previewFirstCheckBox.connect('toggled(bool)', self.onPreviewFirstToggled)
+
+        # read only the region around the mask (see SegmentationReviewLib.crop)
+        self.cropMarginSpinBox = qt.QSpinBox()
+        self.cropMarginSpinBox.setRange(0, 1000)
+        self.cropMarginSpinBox.suffix = " mm"
+        self.cropMarginSpinBox.specialValueText = "off"
+        self.cropMarginSpinBox.value = slicer.util.settingsValue("SegmentationReview/CropMarginMM", 0, converter=int)
+        self.cropMarginSpinBox.toolTip = ("Load only the bounding box of the mask grown by this margin; edited masks are saved "
+                                          "in full size (0 loads the whole image)")
+        self.advancedFormLayout.addRow("Crop to mask: ", self.cropMarginSpinBox)
+        self.cropMarginSpinBox.connect('valueChanged(int)', self.onCropMarginChanged)
+
+        # masks on another grid than their image are resampled once and cached (see SegmentationReviewLib.resample)
+        self.resampleMasksCheckBox = qt.QCheckBox()
+        self.resampleMasksCheckBox.checked = slicer.util.settingsValue("SegmentationReview/ResampleMasks", False, converter=slicer.util.toBool)
+        self.resampleMasksCheckBox.toolTip = ("Resample masks that are not on the grid of their image once, in the background, "
+                                              "and keep the result next to the dataset instead of resampling on every load")
+        self.advancedFormLayout.addRow("Resample masks: ", self.resampleMasksCheckBox)
+        self.resampleMasksCheckBox.connect('toggled(bool)', self.onResampleMasksToggled)
+
+        # gzip level of the edited masks, which are written in the background
+        self.maskCompressionSpinBox = qt.QSpinBox()
+        self.maskCompressionSpinBox.setRange(0, 9)
+        self.maskCompressionSpinBox.value = slicer.util.settingsValue("SegmentationReview/MaskCompressionLevel", 1, converter=int)
+        self.maskCompressionSpinBox.toolTip = "Compression level of saved masks, from 0 (none, fastest) to 9 (smallest files)"
+        self.advancedFormLayout.addRow("Mask compression: ", self.maskCompressionSpinBox)
+        self.maskCompressionSpinBox.connect('valueChanged(int)', self.onMaskCompressionChanged)
+
+        # edited masks as full files, or as sparse revisions of the original mask (see SegmentationReviewLib.revisions)
+        self.editStorageComboBox = qt.QComboBox()
+        self.editStorageComboBox.addItem("Full mask files", "full")
+        self.editStorageComboBox.addItem("Sparse revisions (mask_revisions)", "revisions")
+        self.editStorageComboBox.currentIndex = max(0, self.editStorageComboBox.findData(
+            slicer.util.settingsValue("SegmentationReview/EditStorage", "full")))
+        self.editStorageComboBox.toolTip = "Store each edit as the changed region of the original mask instead of a full copy"
+        self.advancedFormLayout.addRow("Edited masks: ", self.editStorageComboBox)
+        self.editStorageComboBox.connect('currentIndexChanged(int)', self.onEditStorageChanged)
+
+        # metrics of all cases computed on a process pool when a dataset is opened (see SegmentationReviewLib.qa)
+        self.qaPrePassCheckBox = qt.QCheckBox()
+        self.qaPrePassCheckBox.checked = slicer.util.settingsValue("SegmentationReview/QAPrePass", False, converter=slicer.util.toBool)
+        self.qaPrePassCheckBox.toolTip = "Check all masks in the background when a directory is opened and write qa_metrics.csv"
+        self.advancedFormLayout.addRow("QA pre-pass: ", self.qaPrePassCheckBox)
+        self.qaPrePassCheckBox.connect('toggled(bool)', self.onQAPrePassToggled)
+
+        # headers of all images and masks checked on a process pool when a dataset is opened (see SegmentationReviewLib.doctor)
+        self.datasetCheckCheckBox = qt.QCheckBox()
+        self.datasetCheckCheckBox.checked = slicer.util.settingsValue("SegmentationReview/DatasetCheck", False, converter=slicer.util.toBool)
+        self.datasetCheckCheckBox.toolTip = ("Check the file headers of all cases in the background when a directory is opened "
+                                             "(geometry mismatches, corrupt files, non-integer masks) and write " + DOCTOR_FILENAME)
+        self.advancedFormLayout.addRow("Check dataset: ", self.datasetCheckCheckBox)
+        self.datasetCheckCheckBox.connect('toggled(bool)', self.onDatasetCheckToggled)
+
+        # order of the cases, see SegmentationReviewLib.scheduler
+        self.reviewOrderComboBox = qt.QComboBox()
+        self.reviewOrderComboBox.addItem("File order", "sequential")
+        self.reviewOrderComboBox.addItem("Priority (missing, empty, unusual masks first)", "priority")
+        self.reviewOrderComboBox.currentIndex = max(0, self.reviewOrderComboBox.findData(
+            slicer.util.settingsValue("SegmentationReview/ReviewOrder", "sequential")))
+        self.reviewOrderComboBox.toolTip = ("Review first the cases without mask, with an empty mask (QA pre-pass) and then by the "
+                                            "'uncertainty' column of the mapping file, or by how unusual the mask volume is")
+        self.advancedFormLayout.addRow("Review order: ", self.reviewOrderComboBox)
+        self.reviewOrderComboBox.connect('currentIndexChanged(int)', self.onReviewOrderChanged)
+
+        # several reviewers on one dataset directory, see SegmentationReviewLib.shards
+        self.reviewerLineEdit = qt.QLineEdit()
+        self.reviewerLineEdit.text = slicer.util.settingsValue("SegmentationReview/Reviewer", "")
+        self.reviewerLineEdit.placeholderText = "single reviewer"
+        self.reviewerLineEdit.toolTip = ("Name of this reviewer when several reviewers share the dataset directory: "
+                                         "each case is reviewed once and the ratings go to annotations.<name>.csv")
+        self.advancedFormLayout.addRow("Reviewer: ", self.reviewerLineEdit)
+        self.reviewerLineEdit.connect('editingFinished()', self.onReviewerChanged)
+
+        # duration of each stage of each case, written next to the annotations (see SegmentationReviewLib.timing)
+        self.timingLogCheckBox = qt.QCheckBox()
+        self.timingLogCheckBox.checked = slicer.util.settingsValue("SegmentationReview/TimingLog", False, converter=slicer.util.toBool)
+        self.timingLogCheckBox.toolTip = "Write the time spent in each stage of each case to " + TIMINGS_FILENAME
+        self.advancedFormLayout.addRow("Timing log: ", self.timingLogCheckBox)
+        self.timingLogCheckBox.connect('toggled(bool)', self.onTimingLogToggled)
+
+        # summaries of the ratings of all reviewers, see SegmentationReviewLib.export
+        self.exportButton = qt.QPushButton("Export summaries")
+        self.exportButton.toolTip = "Write annotations_cases.csv, annotations_reviewers.csv and annotations_agreement.csv to the directory"
+        self.advancedFormLayout.addRow("Annotations: ", self.exportButton)
+        self.exportButton.connect('clicked(bool)', self.onExportClicked)
+
+    def onPrefetchSettingsChanged(self):
+        settings = qt.QSettings()
+        settings.setValue("SegmentationReview/PrefetchDepth", self.prefetchDepthSpinBox.value)
+        settings.setValue("SegmentationReview/PrefetchMemoryMB", self.prefetchMemorySpinBox.value)
+        self.prefetcher.depth = self.prefetchDepthSpinBox.value
+        self.prefetcher.max_bytes = self.prefetchMemorySpinBox.value * 1024 ** 2
+        self._schedule_prefetch()
+
+    def onReuseNodesToggled(self, checked):
+        qt.QSettings().setValue("SegmentationReview/ReuseNodes", checked)
+        self.reuse_nodes = checked
+
+    def onArrayLoaderToggled(self, checked):
+        qt.QSettings().setValue("SegmentationReview/ArrayLoader", checked)
+        self.array_loader = checked
+
+    def onAnnotationBackendChanged(self):
+        qt.QSettings().setValue("SegmentationReview/AnnotationBackend", self.annotationBackendComboBox.currentData)
+
+    def onVolumeCacheSettingsChanged(self):
+        qt.QSettings().setValue("SegmentationReview/VolumeCacheGB", self.volumeCacheSpinBox.value)
+        max_bytes = self.volumeCacheSpinBox.value * 1024 ** 3
+        if max_bytes == 0:
+            self.volume_cache = None
+        elif self.volume_cache is None:
+            self.volume_cache = VolumeCache(os.path.join(slicer.app.cachePath, "SegmentationReview", "volumes"), max_bytes)
+        else:
+            self.volume_cache.max_bytes = max_bytes
+            self.volume_cache.evict()
+        self.prefetcher.volume_cache = self.volume_cache
+
+    def onPreviewFirstToggled(self, checked):
+        qt.QSettings().setValue("SegmentationReview/PreviewFirst", checked)
+        self._open_preview_cache()
+
+    def _open_preview_cache(self):
+        """Use the previews of the current dataset directory, if enabled"""
+        self.preview_cache = None
+        if self.previewFirstCheckBox.checked and self.session.directory:
+            try:
+                self.preview_cache = PreviewCache(self.session.directory)
+            except OSError as e:
+                logging.getLogger('SegmentationReview').info(f'Previews disabled, cannot store them: {e}')
+        self.prefetcher.preview_cache = self.preview_cache
+
+    def onCropMarginChanged(self, margin):
+        qt.QSettings().setValue("SegmentationReview/CropMarginMM", margin)
+        # cases read ahead with the previous margin (or in full) are read again
+        self.prefetcher.cancel()
+        self.prefetcher.crop_margin_mm = margin
+        self._schedule_prefetch()
+
+    def onResampleMasksToggled(self, checked):
+        qt.QSettings().setValue("SegmentationReview/ResampleMasks", checked)
+        self._open_resample_cache()
+
+    def _open_resample_cache(self):
+        """Use the resampled masks of the current dataset directory, if enabled"""
+        self.resample_cache = None
+        if self.resampleMasksCheckBox.checked and self.session.directory:
+            try:
+                self.resample_cache = ResampleCache(self.session.directory)
+            except OSError as e:
+                logging.getLogger('SegmentationReview').info(f'Resampled masks disabled, cannot store them: {e}')
+        self.prefetcher.resample_cache = self.resample_cache
+
+    def onMaskCompressionChanged(self, level):
+        qt.QSettings().setValue("SegmentationReview/MaskCompressionLevel", level)
+        self.mask_writer.compression_level = level
+
+    def onEditStorageChanged(self):
+        qt.QSettings().setValue("SegmentationReview/EditStorage", self.editStorageComboBox.currentData)
+
+    def onQAPrePassToggled(self, checked):
+        qt.QSettings().setValue("SegmentationReview/QAPrePass", checked)
+
+    def onDatasetCheckToggled(self, checked):
+        qt.QSettings().setValue("SegmentationReview/DatasetCheck", checked)
+
+    def onReviewOrderChanged(self):
+        qt.QSettings().setValue("SegmentationReview/ReviewOrder", self.reviewOrderComboBox.currentData)
+
+    def onReviewerChanged(self):
+        qt.QSettings().setValue("SegmentationReview/Reviewer", self.reviewerLineEdit.text.strip())
+
+    def onTimingLogToggled(self, checked):
+        qt.QSettings().setValue("SegmentationReview/TimingLog", checked)
+        self._open_timer()
+
+    def _open_timer(self):
+        """Time the stages to the timing log of the current dataset directory, if enabled"""
+        self._close_timer()
+        if self.timingLogCheckBox.checked and self.session.directory:
+            self.timer = StageTimer(joinpath(self.session.directory, TIMINGS_FILENAME))
+
+    def _close_timer(self):
+        """Close the timing log and report p50/p95 per stage"""
+        if not self.timer.enabled:
+            return
+        self.timer.close()
+        try:
+            summary = summarize_timings(read_timings(self.timer.path))
+            logging.getLogger('SegmentationReview').info(f'Seconds per stage ({self.timer.path}):\n{summary.to_string()}')
+        except Exception as e:
+            logging.getLogger('SegmentationReview').info(f'Cannot summarize {self.timer.path}: {e}')
+        self.timer = StageTimer()
+
+    def onExportClicked(self):
+        if not self.session.directory:
+            return
+        with slicer.util.tryWithErrorDisplay("Cannot export the annotations.", waitCursor=True):
+            paths = self.logic.exportAnnotations()
+            slicer.util.infoDisplay("Annotation summaries written to:\n" + "\n".join(paths))
+
+    def onScanSettingsChanged(self):
+        settings = qt.QSettings()
+        settings.setValue("SegmentationReview/RecursiveScan", self.recursiveScanCheckBox.checked)
+        settings.setValue("SegmentationReview/MaskPatterns", self.maskPatternsLineEdit.text)
+
     def enter(self):
         """Runs whenever the module is reopened"""
         #print("Enter")
@@ -227,103 +591,89 @@ class SegmentationReviewWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.initializeParameterNode()
     
     def overwrite_mask_clicked(self):
+        if self._refine_index is not None:
+            slicer.util.warningDisplay("The case is shown as a low resolution preview. Save the mask once the full resolution is loaded.")
+            return
         # overwrite self.segmentEditorWidget.segmentationNode()
-        self.segmentation_node = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLSegmentationNode')
-        file_path = self.segmentation_files[self.current_index]
+        if not self._in_scene(self.segmentation_node):
+            self.segmentation_node = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLSegmentationNode')
+        session = self.session
+        index = session.current_index
+        file_path = session.segmentation_files[index]
         print("Overwriting mask",file_path)
-        edited_mask_filename = str(os.path.basename(self.nifti_files[self.current_index])).split(".")[0]+f"_edited_mask_{datetime.now().strftime('%Y%m%d_%H%M%S')}.nii.gz"
-        edited_mask_filepath = os.path.join(self.directory, edited_mask_filename)
+        edited_mask_filename = str(os.path.basename(session.nifti_files[index])).split(".")[0]+f"_edited_mask_{datetime.now().strftime('%Y%m%d_%H%M%S')}.nii.gz"
+        edited_mask_filepath = os.path.join(session.directory, edited_mask_filename)
 
         # Convert the segmentation node to a labelmap volume node (https://slicer.readthedocs.io/en/latest/developer_guide/script_repository.html#export-labelmap-node-from-segmentation-node)
-        edited_mask_labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-        referenceVolumeNode = slicer.mrmlScene.GetFirstNodeByClass("vtkMRMLScalarVolumeNode")
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(self.segmentation_node, edited_mask_labelmapVolumeNode, referenceVolumeNode)
-        edited_mask_labelmapVolumeNode.SetName(edited_mask_filename.split(".")[0])
-
-        # Save the edited mask to file
-        slicer.util.saveNode(edited_mask_labelmapVolumeNode, edited_mask_filepath)
-        print(f"Saved edited mask to {edited_mask_filepath}")
+        with self.timer.stage("mask_export"):
+            edited_mask_labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+            try:
+                referenceVolumeNode = self.volume_node if self._in_scene(self.volume_node) else slicer.mrmlScene.GetFirstNodeByClass("vtkMRMLScalarVolumeNode")
+                slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(self.segmentation_node, edited_mask_labelmapVolumeNode, referenceVolumeNode)
+                # snapshot of the voxels and geometry, so that the reviewer can go on while the mask is written
+                mask = slicer.util.arrayFromVolume(edited_mask_labelmapVolumeNode).copy()
+                ijkToRas = vtk.vtkMatrix4x4()
+                edited_mask_labelmapVolumeNode.GetIJKToRASMatrix(ijkToRas)
+                geometry = geometry_from_ijk_to_ras(slicer.util.arrayFromVTKMatrix(ijkToRas))
+            finally:
+                slicer.mrmlScene.RemoveNode(edited_mask_labelmapVolumeNode)
+
+        # Save the edited mask to file and move the previous mask to a backup folder (instead of deleting it), in the background
+        backup_mask_filepath = os.path.join(session.directory, "backup_masks", os.path.basename(file_path))
+        revisions = revisions_directory(session.directory, file_path, session.nifti_files[index])
+        if self.editStorageComboBox.currentData == "revisions":
+            # the original mask stays in place, the edit is stored as a revision of it, which is loaded from now on
+            save, args = save_edit, (revisions, file_path, edited_mask_filepath, backup_mask_filepath,
+                                     self.mask_writer.compression_level, session.nifti_files[index])
+            saved_mask_filepath = file_path
+        else:
+            save, args = save_mask, (edited_mask_filepath, file_path, backup_mask_filepath, self.mask_writer.compression_level)
+            saved_mask_filepath = edited_mask_filepath
+        if self._crop is not None:
+            # the edit covers the cropped region: paste it into the current full-size mask (or latest revision),
+            # which is written before this save by the writer thread if it was edited before
+            future = self.mask_writer.run(save_uncropped, save, mask, geometry, self._crop, file_path, *args, revisions=revisions)
+        else:
+            future = self.mask_writer.run(save, mask, geometry, *args)
+        self._pending_saves.append((future, session, index, edited_mask_filepath, file_path, session.seg_mask_status[index]))
+        if self.timer.enabled:
+            # from the submission, so the time waiting behind earlier saves is included
+            start, timer, case = time.perf_counter(), self.timer, self.timer.case
+            future.add_done_callback(lambda future: timer.record("mask_write", time.perf_counter() - start, case))
+        self.saveTimer.start()
 
         # update the mask status
-        self.seg_mask_status[self.current_index] = 3
+        session.seg_mask_status[index] = MASK_EDITED
         # add to the list of segmentation files
-        self.segmentation_files[self.current_index] = edited_mask_filepath
-
-        # move the previous mask to a backup folder (instead of deleting it)
-        backup_folder = os.path.join(self.directory, "backup_masks")
-        if not os.path.exists(backup_folder):
-            os.makedirs(backup_folder)
-        backup_mask_filepath = os.path.join(backup_folder, os.path.basename(file_path))
-        try:
-            shutil.move(file_path, backup_mask_filepath)
-            print(f"Moved previous mask to {backup_mask_filepath}")
-        except OSError as e:
-            print(f"Error moving previous mask to {backup_mask_filepath}: {e}")
-
+        session.segmentation_files[index] = saved_mask_filepath
+
+    def onSaveTimer(self):
+        """Report the edited masks that were written in the background"""
+        running = []
+        for save in self._pending_saves:
+            future, session, index, path, previous_path, previous_status = save
+            if not future.done():
+                running.append(save)
+                continue
+            try:
+                saved_path = future.result()
+            except Exception as e:
+                # the case keeps its previous mask
+                if session.segmentation_files[index] in (path, previous_path):
+                    session.segmentation_files[index] = previous_path
+                    session.seg_mask_status[index] = previous_status
+                slicer.util.errorDisplay(f"Cannot save the edited mask {path}: {e}")
+                continue
+            if saved_path == path and session.segmentation_files[index] == previous_path:
+                # could not be stored as a revision, saved in full instead
+                session.segmentation_files[index] = path
+            logging.getLogger('SegmentationReview').info(f'Saved edited mask to {saved_path}')
+            slicer.util.showStatusMessage(f"Saved edited mask {os.path.basename(saved_path)}", 3000)
+        self._pending_saves = running
+        if not running:
+            self.saveTimer.stop()
 
-    def joinpath(self,rootdir,targetdir):
-        return os.path.join(os.sep, rootdir+os.sep,targetdir)
 
-    def _is_valid_extension(self, path):
-        return any(path.endswith(i) for i in [".nii", ".nii.gz", ".nrrd"])
-    
-    def _construct_full_path(self, path):
-        if os.path.isabs(path):
-            return path
-        else:
-            return self.joinpath(self.directory, path)
-    
-    def _restore_index(self, ann_csv, files_list, mask_list, mask_status_list=None):
-        #print(files_list,mask_list)
-        #print(self.unique_case_flag)
-        #ann_csv {[self.nifti_files[self.current_index]],[likert_score],[self.ui.comment.toPlainText()]}
-        statuses, unchecked_files, unchecked_masks, checked_ids, id_subs_list = [], [], [], [], []
-        list_of_checked = ann_csv['file'].values
-        list_of_checked = [self._construct_full_path(i) for i in list_of_checked]
-        
-        list_of_checked_masks = ann_csv['mask_path'].values
-        #print(list_of_checked)
-        # check if ['mask_path'] is empty
-        if type(list_of_checked_masks[0]) == str:
-            list_of_checked_masks = [self._construct_full_path(i) for i in list_of_checked_masks]
-        
-        #find subset of files that are not checked
-        if self.unique_case_flag:
-            # read what ids were checked by finding the corresponding ids
-            checked_ids = []
-            list_of_checked = ann_csv['file'].values
-            # first, check what ids were checked
-            for id_subj, img, _ in zip(self.mappings["subj_id"], self.mappings["img_path"], self.mappings["mask_path"]):
-                if img in list_of_checked:
-                    checked_ids.append(id_subj)
-            # second, find the files that were not checked       
-            for id_subj, img, mask in zip(self.mappings["subj_id"], self.mappings["img_path"], self.mappings["mask_path"]):
-                if id_subj not in checked_ids:
-                    id_subs_list.append(id_subj)
-                    unchecked_files.append(self._construct_full_path(img))
-                    # check if mask is empty or nan 
-                    if type(mask) == str:
-                        unchecked_masks.append(self._construct_full_path(mask))
-                        statuses.append(2)
-                    else:
-                        unchecked_masks.append("")
-                        statuses.append(0)
-                        
-            #print("Checked ids",checked_ids)
-            #print("Unchecked files",unchecked_files)
-            #print("Unchecked masks",unchecked_masks)
-            
-        else:
-            for i in range(len(files_list)):
-                if files_list[i] not in list_of_checked:
-                    unchecked_files.append(files_list[i])
-                    unchecked_masks.append(mask_list[i])
-                    statuses.append(mask_status_list[i])
-        
-        
-        #return list of unchecked files
-        return unchecked_files, unchecked_masks, statuses, id_subs_list, checked_ids
-    
     def getDefaultSourceVolumeNodeID(self):
         layoutManager = slicer.app.layoutManager()
         firstForegroundVolumeID = None
@@ -362,165 +712,145 @@ class SegmentationReviewWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
    
     def onAtlasDirectoryChanged(self, directory):
         
-        self.directory = os.path.normpath(directory)
-        directory = self.directory
-        logger = logging.getLogger('SegmentationReview')
-        logger.setLevel(logging.DEBUG)
-
-        # Set up logging to file
-        fileHandler = logging.FileHandler(self.joinpath(directory,'segmentation_review.log'))
-        fileHandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-        logger.addHandler(fileHandler) 
+        directory = os.path.normpath(directory)
+
+        # cases read ahead for the previous directory are of no use anymore
+        self._close_timer()
+        self.prefetcher.cancel()
+        self.scanTimer.stop()
+        self.qaTimer.stop()
+        self.checkTimer.stop()
+        self.compareTimer.stop()
+        self._stop_refinement()
         
         try:
             slicer.mrmlScene.RemoveNode(self.volume_node) 
             slicer.mrmlScene.RemoveNode(self.segmentation_node)
         except:
             pass
-        
-        self.unique_case_flag=False
-        # case 0: searching for one unique nifti file for id
-        # they 
-        if os.path.exists(self.joinpath(directory,"mapping_unique.csv")):
-            case_flag = True
-            # mapping file contains id and nifti file name
-            id_subs = []
-            self.mappings = pd.read_csv(self.joinpath(directory,"mapping_unique.csv"))
-            self.unique_case_flag = True
-            for id_subj, img, mask in zip(self.mappings["subj_id"], self.mappings["img_path"], self.mappings["mask_path"]):
-                # counting images
-                if os.path.exists(self.joinpath(directory,img)) and self._is_valid_extension(self.joinpath(directory,img)):
-                    self.nifti_files.append(self.joinpath(directory,img))
-                    id_subs.append(id_subj)
-                    # counting masks
-                    # check if mask is 
-                    if type(mask) == str:
-                        if os.path.exists(self.joinpath(directory,mask)) and self._is_valid_extension(self.joinpath(directory,mask)):
-                            
-                            self.segmentation_files.append(self.joinpath(directory,mask))
-                            self.seg_mask_status.append(2) # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded
-                            logger.info(f'Found mask for {img}')
-                        elif self._is_valid_extension(self.joinpath(directory,mask)) and not os.path.exists(self.joinpath(directory,mask)):
-                           
-                            self.segmentation_files.append("")
-                            self.seg_mask_status.append(1) # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded
-                            logger.info(f'Cannot load mask for {img}, check path')
-                        else:
-                            
-                            self.segmentation_files.append("")
-                            self.seg_mask_status.append(0) # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded
-                            logger.info(f'No mask provided for {img}')
-                    else:
-                        
-                        self.segmentation_files.append("")
-                        self.seg_mask_status.append(0)
-                        logger.info(f'No mask provided for {img}')
-                else:
-                    logger.info(f'File {img} does not exist or has wrong extension, skipping')
-            #get unique ids
-            self.id_subs = id_subs
-            #print("Unique:",len(np.unique(self.id_subs)),id_subs)   
-        
-        # case 1: mapper cvs is present
-        elif os.path.exists(self.joinpath(directory,"mapping.csv")):
-            logger.info('Found mappings between files and masks') 
-            #print("Found mappings between files and masks")
-            self.mappings = pd.read_csv(self.joinpath(directory,"mapping.csv"))
-            self.with_mapper_flag = True
-            # casting to zero all nan values
-            
-            #print("Loaded mappings between files and masks")
-            for img, mask in zip(self.mappings["img_path"], self.mappings["mask_path"]):
-                # counting images
-                if os.path.exists(self.joinpath(directory,img)) and self._is_valid_extension(self.joinpath(directory,img)):
-                    self.nifti_files.append(self.joinpath(directory,img))
-                    # counting masks
-                    # check if mask is 
-                    if type(mask) == str:
-                        if os.path.exists(self.joinpath(directory,mask)) and self._is_valid_extension(self.joinpath(directory,mask)):
-                            self.segmentation_files.append(self.joinpath(directory,mask))
-                            self.seg_mask_status.append(2) # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded
-                            logger.info(f'Found mask for {img}')
-                        elif self._is_valid_extension(self.joinpath(directory,mask)) and not os.path.exists(self.joinpath(directory,mask)):
-                            self.segmentation_files.append("")
-                            self.seg_mask_status.append(1) # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded
-                            logger.info(f'Cannot load mask for {img}, check path')
-                        else:
-                            self.segmentation_files.append("")
-                            self.seg_mask_status.append(0) # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded
-                            logger.info(f'No mask provided for {img}')
-                    else:
-                        self.segmentation_files.append("")
-                        self.seg_mask_status.append(0)
-                        logger.info(f'No mask provided for {img}')
-                else:
-                    logger.info(f'File {img} does not exist or has wrong extension, skipping')                   
-                # ToDo: write to log how many files were found, how many masks were found 
-                
-                
-        # case 2: mapper cvs is not present; list files from file
-        else:
-            logger.info('No mappings between files and masks') 
-            #print("No mappings between files and masks")
-            for file in os.listdir(directory):
-                if ".nii" in file and "_mask" not in file:  
-                    self.nifti_files.append(self.joinpath(directory,file)) #
-                    
-                    if os.path.exists(self.joinpath(directory,file.split(".")[0]+"_mask.nii.gz")):
-                        self.segmentation_files.append(self.joinpath(directory,file.split(".")[0]+"_mask.nii.gz"))
-                        self.seg_mask_status.append(2) # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded
-                        logger.info(f'Found mask for {file}')
-                    else:
-                        self.segmentation_files.append("")
-                        self.seg_mask_status.append(0) # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded
-                        logger.info(f'No mask for {file}')
-                #else:
-                #    logger.info(f'File {file} does not exist or has wrong extension, skipping')
-                        
-        self.current_index = 0               
-        # load the .cvs file with the old annotations or create a new one
-        #print("Path exists",os.path.exists(self.joinpath(directory,"annotations.csv")))
-        if os.path.exists(self.joinpath(directory,"annotations.csv")):
-        
-            ann_csv = pd.read_csv(self.joinpath(directory,"annotations.csv"), header=None,index_col=False, names=["file","annotation","comment","mask_path","mask_status"])
-            #print(ann_csv)
-            if self.unique_case_flag:
-                self.nifti_files, self.segmentation_files, self.seg_mask_status, self.id_subs, self.id_subs_checked = self._restore_index(ann_csv, self.nifti_files,
-                                                                                                 self.segmentation_files, self.seg_mask_status)
-            else:
-                self.nifti_files, self.segmentation_files, self.seg_mask_status, _,_ = self._restore_index(ann_csv, self.nifti_files, self.segmentation_files, self.seg_mask_status)
-            
-            logger.info(f'Found session, restoring annotations {len(self.nifti_files)} files left') 
-            
-        self.n_files = len(self.nifti_files)
-        self.ui.status_checked.setText("Checked: "+ str(self.current_index) + " / "+str(self.n_files))
-        
-        #print("Images:",len(self.nifti_files), 
-        #      "Masks:",len(self.segmentation_files))
-        logger.info( f'Total Images Loaded: {len(self.nifti_files)}, Images with Masks: {len(self.segmentation_files)}')
+        self._remove_prediction_nodes()
+
+        # discover the cases and restore the previous annotations, if any
+        session = self.logic.openDirectory(directory, annotation_backend=self.annotationBackendComboBox.currentData,
+                                           recursive=self.recursiveScanCheckBox.checked,
+                                           mask_patterns=parse_mask_patterns(self.maskPatternsLineEdit.text),
+                                           review_order=self.reviewOrderComboBox.currentData,
+                                           reviewer=reviewer_name(self.reviewerLineEdit.text) if self.reviewerLineEdit.text.strip() else None)
+        # masks edited as revisions are read from their latest revision
+        self.prefetcher.dataset_directory = session.directory
+        self._open_preview_cache()
+        self._open_resample_cache()
+        self._open_timer()
+        self.update_status_checked()
         
         # load first file with mask
-        self.load_nifti_file(self.unique_case_flag)
+        self.load_nifti_file(session.unique_case_flag)
+        if session.scanner is not None:
+            self.scanTimer.start()
+        if self.qaPrePassCheckBox.checked:
+            # with a recursive scan, only the cases found so far are checked
+            self.logic.startQualityPrePass()
+            self.qaTimer.start()
+        if self.datasetCheckCheckBox.checked:
+            self.logic.startDatasetCheck()
+            self.checkTimer.start()
+        if self.resample_cache is not None:
+            self.logic.startResamplePass(self.resample_cache)
+        if session.predictions:
+            # mapping file with several masks per case: compare them with the mask of each case
+            self.logic.startComparison()
+            self.compareTimer.start()
+
+    def onScanTimer(self):
+        """Add the cases found by the recursive scan, and load the first one if the review was waiting for it"""
+        session = self.session
+        waiting = session.current_index >= session.n_files
+        if session.poll_scan():
+            if waiting:
+                self.load_nifti_file(session.unique_case_flag)
+            else:
+                self._schedule_prefetch()
+        if session.scanner is None:
+            self.scanTimer.stop()
+        self.update_status_checked()
+
+    def onQATimer(self):
+        """Show the progress of the QA pre-pass, and flag the masks that cannot be loaded once it is done"""
+        if self.logic.qa is None or self.logic.qa.done:
+            self.qaTimer.stop()
+            self.logic.applyQualityPrePass()
+            if self.logic.qa is not None and self.session.scheduler is not SCHEDULERS["sequential"]:
+                # the cases after the current one move: what was read ahead no longer matches their indexes
+                self.prefetcher.cancel()
+                self.session.reschedule(self.logic.qa.metrics())
+                if self._refine_index is not None:
+                    self._start_refinement()
+                else:
+                    self._schedule_prefetch()
+        self.update_status_checked()
+
+    def onCheckTimer(self):
+        """Show the progress of the dataset check, and flag the masks that cannot be loaded once it is done"""
+        doctor = self.logic.doctor
+        if doctor is None or doctor.done:
+            self.checkTimer.stop()
+            self.logic.applyDatasetCheck()
+            if doctor is not None:
+                slicer.util.showStatusMessage(doctor.summary(), 10000)
+        self.update_status_checked()
+
+    def onCompareTimer(self):
+        """Show the progress of the comparison, and the metrics of the current case once they are known"""
+        comparison = self.logic.comparison
+        if comparison is None or comparison.done:
+            self.compareTimer.stop()
+            if comparison is not None:
+                slicer.util.showStatusMessage(comparison.summary(), 10000)
+        self.update_status_checked()
+
+    def update_status_checked(self):
+        session = self.session
+        status = "Checked: "+ str(session.current_index) + " / "+str(session.n_files)
+        if session.scanner is not None:
+            status += " (scanning subfolders...)"
+        if self._refine_index is not None:
+            status += " (preview, loading full resolution...)"
+        qa = self.logic.qa
+        if qa is not None and not qa.done:
+            status += " (QA %d / %d)" % qa.progress
+        if qa is not None and session.current_index < session.n_files:
+            issues = qa.issues(session.nifti_files[session.current_index])
+            if issues:
+                status += " - QA: " + ", ".join(issues)
+        doctor = self.logic.doctor
+        if doctor is not None and not doctor.done:
+            status += " (checking headers %d / %d)" % doctor.progress
+        if doctor is not None and session.current_index < session.n_files:
+            issues = doctor.issues(session.nifti_files[session.current_index])
+            if issues:
+                status += " - Check: " + ", ".join(issues)
+        comparison = self.logic.comparison
+        if comparison is not None and not comparison.done:
+            status += " (comparing %d / %d)" % comparison.progress
+        if comparison is not None and session.current_index < session.n_files:
+            # None once the mask is edited: no metrics of the previous version are shown
+            metrics = comparison.metrics(session.nifti_files[session.current_index],
+                                         session.segmentation_files[session.current_index])
+            if metrics:
+                status += " - " + ", ".join(
+                    "vs %s: Dice %s, HD95 %s mm" % (name, "-" if values["dice"] is None else "%.2f" % values["dice"],
+                                                    "-" if values["hd95_mm"] is None else "%.1f" % values["hd95_mm"])
+                    for name, values in metrics.items())
+        self.ui.status_checked.setText(status)
      
-    def _numerical_status_to_str(self, status):
-        return {0: "No mask found", 1: "Cannot load mask", 2: "Mask loaded, no edits", 3:"Mask edited"}[status]   
-    
-    def _rating_to_str(self, rating):
-        return {1: "Acceptable with no changes", 2: "Acceptable with minor changes", 
-                3: "Unacceptable with major changes", 
-                4: "Unacceptable and not visible",
-                5: "Bad images"}[rating]  
-    
     def save_and_next_clicked(self):
+        session = self.session
+        # a rating given on the preview: the full resolution read is cancelled by the next prefetch schedule
+        self._stop_refinement()
         likert_score = 0
         
         if self.ui.radioButton_1.isChecked():
             likert_score=1
-            if self.unique_case_flag:
-                self.id_subs_checked.append(self.id_subs[self.current_index])
-                #print("found the file for this id",self.current_index,self.id_subs[self.current_index])
-                # update current index display
-                #self.ui.status_checked.setText("Checked: "+ str(self.current_index) + " / "+str(self.n_files))
         elif self.ui.radioButton_2.isChecked():
             likert_score=2
         elif self.ui.radioButton_3.isChecked():
@@ -530,57 +860,37 @@ class SegmentationReviewWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         elif self.ui.radioButton_5.isChecked():
             likert_score=5
        
-            
-        self.likert_scores.append([self.current_index, likert_score, self.ui.comment.toPlainText()])
-        # append data frame to CSV file
-        if  self.finish_flag == False:
-            head, tail = os.path.split(self.nifti_files[self.current_index])
-            data = {'file': [self.nifti_files[self.current_index].replace(head,"").replace("/","").replace("\\","")],
-                        'annotation': [self._rating_to_str(likert_score)],
-                        'comment': [self.ui.comment.toPlainText()],
-                        'mask_path': [self.segmentation_files[self.current_index].replace(head,"").replace("/","").replace("\\","")],
-                        'mask_status': [self._numerical_status_to_str(self.seg_mask_status[self.current_index])]}
-            df = pd.DataFrame(data)   
-            df.to_csv(self.joinpath(self.directory,"annotations.csv"), mode='a', index=False, header=False)
+        # append the rating to the annotations file
+        with self.timer.stage("annotation_append"):
+            metrics = self.logic.caseMetrics(session.current_index) if session.predictions else None
+            session.record_rating(likert_score, self.ui.comment.toPlainText(), metrics)
+        self.timer.flush()
 
         # go to the next file if there is one
-        ret = 0
-        if self.current_index <= self.n_files:#-1:
-            if self.volume_node:
-                # Store current window and level
-                self.store_current_window_level_settings()
+        if session.finish_flag:
+            return
+        if self._in_scene(self.volume_node):
+            # Store current window and level
+            self.store_current_window_level_settings()
+            if not self.reuse_nodes:
                 slicer.mrmlScene.RemoveNode(self.volume_node)
-            if self.segmentation_node:
-                # Store current mask label visibility states
-                self.store_segment_visiblity_states()
+        if self._in_scene(self.segmentation_node):
+            # Store current mask label visibility states
+            self.store_segment_visiblity_states()
+            if not self.reuse_nodes:
                 slicer.mrmlScene.RemoveNode(self.segmentation_node)
                 slicer.mrmlScene.RemoveNode(self.pointListNode)
-                #slicer.mrmlScene.Clear(0)
-            if self.unique_case_flag:
-                while ret == 0 and self.current_index <= self.n_files:#-1:
-                    self.current_index += 1
-                    
-                    ret = self.load_nifti_file(unique=True)
-                    #print("skip, load next",self.id_subs[self.current_index])
-                    
-                    if self.current_index == self.n_files:
-                    
-                        print("*All files checked", self.current_index, self.n_files)
-                        self.finish_flag = True
-                        break
-                    
-                    #self.current_index += 1
-                    
-            else:
-                self.current_index += 1
-                self.load_nifti_file()
-
-            self.ui.comment.setPlainText("")
-            self.ui.status_checked.setText("Checked: "+ str(self.current_index) + " / "+str(self.n_files))
-
+        if session.advance():
+            self.load_nifti_file(session.unique_case_flag)
+        elif session.finish_flag:
+            print("*All files checked", session.current_index, session.n_files)
         else:
-            #print("_All files checked")
-            self.finish_flag = True
+            # the next case is loaded by onScanTimer once the scan finds it
+            logging.getLogger('SegmentationReview').info(
+                f'All {session.n_files} cases found so far are checked, waiting for the scan to find more files')
+
+        self.ui.comment.setPlainText("")
+        self.update_status_checked()
 
     def store_current_window_level_settings(self):
         """Store current HU window and level settings."""
@@ -596,82 +906,360 @@ class SegmentationReviewWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
     def store_segment_visiblity_states(self):
         """Store the visibility states of mask labels."""
-        for segment_id in self.segmentation_node.GetSegmentation().GetSegmentIDs():
+        # keyed by segment name (derived from the label value), which stays the same for a given label
+        # even when segment IDs do not, e.g. when masks are imported into a reused segmentation node
+        segmentation = self.segmentation_node.GetSegmentation()
+        for segment_id in segmentation.GetSegmentIDs():
             visibility = self.segmentation_node.GetDisplayNode().GetSegmentVisibility(segment_id)
-            self.segment_visiblity_states[segment_id] = visibility
+            self.segment_visiblity_states[segmentation.GetSegment(segment_id).GetName()] = visibility
 
     def restore_segment_visiblity_states(self):
         """Restore the visibility states of mask labels.""" 
-        for segment_id in self.segmentation_node.GetSegmentation().GetSegmentIDs():
-            visibility = self.segment_visiblity_states.get(segment_id, True)
+        segmentation = self.segmentation_node.GetSegmentation()
+        for segment_id in segmentation.GetSegmentIDs():
+            visibility = self.segment_visiblity_states.get(segmentation.GetSegment(segment_id).GetName(), True)
             self.segmentation_node.GetDisplayNode().SetSegmentVisibility(segment_id, visibility)
 
 
     def load_nifti_file(self, unique=False):
         """Load NIFTI file and associated segmentation."""
-        for node in [self.volume_node, self.segmentation_node, self.pointListNode, self.segmentEditorWidget.segmentationNode()]:
-            if node:
-                slicer.mrmlScene.RemoveNode(node)
+        self._remove_prediction_nodes()
+        if not self.reuse_nodes:
+            for node in [self.volume_node, self.segmentation_node, self.pointListNode, self.segmentEditorWidget.segmentationNode()]:
+                if node:
+                    slicer.mrmlScene.RemoveNode(node)
         slicer.util.resetSliceViews()
         
-        if unique:
-            if self.current_index < self.n_files and self.id_subs[self.current_index] in self.id_subs_checked:
-                return 0
-            elif self.current_index == self.n_files:
-                return 1
+        session = self.session
+        if session.current_index >= session.n_files:
+            return None
+
+        self.timer.case = os.path.basename(session.nifti_files[session.current_index])
 
         # Pause rendering until all data is loaded
         slicer.app.layoutManager().setRenderPaused(True)
 
-        self.volume_node = slicer.util.loadVolume(self.nifti_files[self.current_index])
+        # Use the arrays read in the background if this case was prefetched
+        with self.timer.stage("volume_read"):
+            case = self.prefetcher.take(session.current_index)
+            preview = None
+            # the Slicer readers and the previews only know the original mask of a case edited as revisions
+            edited = has_revisions(revisions_directory(session.directory, session.segmentation_files[session.current_index],
+                                                       session.nifti_files[session.current_index]))
+            crop_margin = self.cropMarginSpinBox.value
+            if crop_margin:
+                # the region around the mask is small enough to be read without preview; prefetched cases are cropped already
+                if case is None:
+                    case = self._read_cropped_case(session.current_index, crop_margin)
+            elif case is None and self.preview_cache is not None and not edited:
+                preview = self.preview_cache.read_case(session.nifti_files[session.current_index],
+                                                       session.segmentation_files[session.current_index])
+            if ((self.reuse_nodes or self.array_loader or self.volume_cache is not None or self.resample_cache is not None or edited)
+                    and case is None and preview is None):
+                case = self._read_case(session.current_index)
+        self._crop = case.crop if case is not None else None
+        try:
+            if preview is not None:
+                # full resolution is read in the background and swapped in by onRefineTimer
+                case = preview
+            if self.reuse_nodes and case is not None:
+                with self.timer.stage("pooled_nodes_load"):
+                    self._load_case_into_pooled_nodes(case)
+            else:
+                self._load_case_into_new_nodes(case, unique)
+        finally:
+            # Resume rendering to show the loaded data
+            with self.timer.stage("render_resume"):
+                slicer.app.layoutManager().setRenderPaused(False)
+
+        self._load_prediction_nodes()
+
+        if preview is not None:
+            self._start_refinement()
+        else:
+            # Start reading the next cases while this one is reviewed
+            self._schedule_prefetch()
+        
+        return None
+
+    def _remove_prediction_nodes(self):
+        for node in self.prediction_nodes:
+            if self._in_scene(node):
+                slicer.mrmlScene.RemoveNode(node)
+        self.prediction_nodes = []
+
+    def _load_prediction_nodes(self):
+        """Load the predictions of the current case as further segmentations, shown as outlines"""
+        session = self.session
+        if session.current_index >= session.n_files:
+            return
+        with self.timer.stage("predictions_load"):
+            for name, path in sorted(session.prediction_files(session.current_index).items()):
+                try:
+                    node = slicer.util.loadSegmentation(path)
+                except Exception as e:
+                    logging.getLogger('SegmentationReview').warning(f'Cannot load the prediction {name} ({path}): {e}')
+                    continue
+                node.SetName("%s [%s]" % (self._node_name(session.nifti_files[session.current_index]), name))
+                node.GetDisplayNode().SetVisibility2DFill(False)
+                self.prediction_nodes.append(node)
+
+    def _load_case_into_new_nodes(self, case, unique=False):
+        """Create the volume and segmentation nodes of the current case, from prefetched arrays if available"""
+        session = self.session
+        if self.reuse_nodes:
+            # the case cannot be read into arrays: load it from file instead of into the pooled nodes
+            for node in [self.volume_node, self.segmentation_node]:
+                if self._in_scene(node):
+                    slicer.mrmlScene.RemoveNode(node)
+
+        with self.timer.stage("volume_load"):
+            if case is not None:
+                self.volume_node = self._volume_node_from_array(case.image, case.image_geometry, case.image_path)
+            else:
+                self.volume_node = slicer.util.loadVolume(session.nifti_files[session.current_index])
         # Adjust window/level based on the previous settings, if any.
         self.restore_window_level_settings()
         
         try:
-            self.segmentation_node = slicer.util.loadSegmentation(self.segmentation_files[self.current_index])
+            with self.timer.stage("segmentation_load"):
+                if case is not None and case.mask is not None:
+                    self.segmentation_node = self._segmentation_node_from_array(case.mask, case.mask_geometry, case.mask_path)
+                else:
+                    self.segmentation_node = slicer.util.loadSegmentation(session.segmentation_files[session.current_index])
             # Restore the segment visibility toggles from the previous segmentation, if any.
             self.restore_segment_visiblity_states()
             # Set the segmentation node to the segment editor widget
-            self.set_segmentation_and_mask_for_segmentation_editor()
-        except:
+            self.set_segmentation_and_mask_for_segmentation_editor(case=case)
+        except Exception as e:
+            issues = self.logic.doctor.issues(session.nifti_files[session.current_index]) if self.logic.doctor is not None else []
+            logging.getLogger('SegmentationReview').warning(
+                f'Cannot load the mask of {session.nifti_files[session.current_index]}: {e}' + (f' ({"; ".join(issues)})' if issues else ''))
             if not unique:
                 self.enter()
 
-        # Resume rendering to show the loaded data
-        slicer.app.layoutManager().setRenderPaused(False)
-        
-        return None
+    def _start_refinement(self):
+        """Read the full resolution data of the previewed case ahead of the next cases"""
+        session = self.session
+        index = session.current_index
+        self._refine_index = index
+        self.prefetcher.schedule(chain([(index, session.nifti_files[index], session.segmentation_files[index])],
+                                       self._upcoming_cases()))
+        self.refineTimer.start()
+
+    def _stop_refinement(self):
+        self.refineTimer.stop()
+        self._refine_index = None
+
+    def onRefineTimer(self):
+        """Swap the full resolution data of the current case into the nodes that show its preview"""
+        index = self._refine_index
+        if index is None or index != self.session.current_index:
+            self._stop_refinement()
+            return
+        if self.prefetcher.scheduled(index) and not self.prefetcher.ready(index):
+            return
+        self._stop_refinement()
+        # not scheduled (no prefetch depth or memory left): read it now
+        case = self.prefetcher.take(index) or self._read_case(index)
+        if case is not None:
+            # keep what the reviewer adjusted on the preview
+            if self._in_scene(self.volume_node):
+                self.store_current_window_level_settings()
+            if self._in_scene(self.segmentation_node):
+                self.store_segment_visiblity_states()
+            if not self.reuse_nodes and self._in_scene(self.pointListNode):
+                slicer.mrmlScene.RemoveNode(self.pointListNode)
+            slicer.app.layoutManager().setRenderPaused(True)
+            try:
+                self._load_case_into_pooled_nodes(case)
+            finally:
+                slicer.app.layoutManager().setRenderPaused(False)
+            if not self.reuse_nodes and self._in_scene(self.labelmap_node):
+                slicer.mrmlScene.RemoveNode(self.labelmap_node)
+        self._schedule_prefetch()
+        self.update_status_checked()
+
+    def _read_case(self, index):
+        """Read a case into arrays now, or return None if SimpleITK cannot read it"""
+        session = self.session
+        try:
+            return read_case(session.nifti_files[index], session.segmentation_files[index], self.volume_cache, self.preview_cache,
+                             self.resample_cache, session.directory)
+        except Exception as e:
+            logging.getLogger('SegmentationReview').info(f'Cannot read {session.nifti_files[index]} into arrays: {e}')
+            return None
+
+    def _read_cropped_case(self, index, margin_mm):
+        """Read the region of a case around its mask, or return None if SimpleITK cannot read it"""
+        session = self.session
+        try:
+            return read_cropped_case(session.nifti_files[index], session.segmentation_files[index], margin_mm, self.resample_cache,
+                                     session.directory)
+        except Exception as e:
+            logging.getLogger('SegmentationReview').info(f'Cannot read {session.nifti_files[index]} into arrays: {e}')
+            return None
+
+    def _in_scene(self, node):
+        return node is not None and bool(slicer.mrmlScene.IsNodePresent(node))
+
+    def _update_pooled_volume(self, node, array, geometry, path, nodeClassName):
+        """Swap a voxel array into a pooled volume node, creating the node on first use"""
+        if not self._in_scene(node):
+            return self._volume_node_from_array(array, geometry, path, nodeClassName=nodeClassName)
+        self.logic.setVolumeArray(node, array, slicer.util.vtkMatrixFromArray(ijk_to_ras(geometry)))
+        node.SetName(self._node_name(path))
+        return node
+
+    def _load_case_into_pooled_nodes(self, case):
+        """Swap the image and mask of a case into the pooled nodes, keeping the scene size constant"""
+        self.volume_node = self._update_pooled_volume(self.volume_node, case.image, case.image_geometry,
+                                                      case.image_path, "vtkMRMLScalarVolumeNode")
+        # Adjust window/level based on the previous settings, if any.
+        self.restore_window_level_settings()
 
-    def set_segmentation_and_mask_for_segmentation_editor(self):
+        if not self._in_scene(self.segmentation_node):
+            self.segmentation_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+            self.segmentation_node.CreateDefaultDisplayNodes()
+        self.segmentation_node.GetSegmentation().RemoveAllSegments()
+        self.segmentation_node.SetReferenceImageGeometryParameterFromVolumeNode(self.volume_node)
+        if case.mask is None:
+            # no mask: an empty segmentation lets the reviewer draw a new one
+            self.segmentation_node.SetName(self._node_name(case.image_path) + "_segmentation")
+            self.set_segmentation_and_mask_for_segmentation_editor(jump_to_centroids=False)
+            return
+
+        self.labelmap_node = self._update_pooled_volume(self.labelmap_node, case.mask, case.mask_geometry,
+                                                        case.mask_path, "vtkMRMLLabelMapVolumeNode")
+        self.labelmap_node.SetHideFromEditors(True)
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(self.labelmap_node, self.segmentation_node)
+        self.segmentation_node.SetName(self._node_name(case.mask_path))
+        self.restore_segment_visiblity_states()
+        self.set_segmentation_and_mask_for_segmentation_editor(case=case)
+
+    def _upcoming_cases(self):
+        """Cases that follow the current one, as (index, image path, mask path), skipping checked subjects"""
+        session = self.session
+        for index in session.pending_indexes(session.current_index + 1):
+            yield index, session.nifti_files[index], session.segmentation_files[index]
+
+    def _schedule_prefetch(self):
+        if self.prefetcher is None:
+            return
+        self.prefetcher.schedule(self._upcoming_cases())
+
+    def _node_name(self, path):
+        return os.path.basename(path).split(".")[0]
+
+    def _volume_node_from_array(self, array, geometry, path, nodeClassName="vtkMRMLScalarVolumeNode"):
+        """Create a volume node from a voxel array read with SimpleITK"""
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass(nodeClassName, self._node_name(path))
+        self.logic.setVolumeArray(volumeNode, array, slicer.util.vtkMatrixFromArray(ijk_to_ras(geometry)))
+        volumeNode.CreateDefaultDisplayNodes()
+        return volumeNode
+
+    def _segmentation_node_from_array(self, array, geometry, path):
+        """Create a segmentation node from a labelmap array read with SimpleITK"""
+        labelmap_node = self._volume_node_from_array(array, geometry, path, nodeClassName="vtkMRMLLabelMapVolumeNode")
+        segmentation_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", self._node_name(path))
+        segmentation_node.CreateDefaultDisplayNodes()
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmap_node, segmentation_node)
+        slicer.mrmlScene.RemoveNode(labelmap_node)
+        return segmentation_node
+
+    def set_segmentation_and_mask_for_segmentation_editor(self, jump_to_centroids=True, case=None):
         slicer.app.processEvents()
         
-        # Set up segment editor widget
-        self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        self.segmentEditorWidget.setMRMLSegmentEditorNode(slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode"))
-        self.segmentEditorWidget.setSegmentationNode(self.segmentation_node)
-        self.segmentEditorWidget.setSourceVolumeNode(self.volume_node)
+        # Set up segment editor widget, with one editor node for the whole session
+        with self.timer.stage("editor_setup"):
+            self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
+            if not self._in_scene(self.segmentEditorNode):
+                self.segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
+            self.segmentEditorWidget.setMRMLSegmentEditorNode(self.segmentEditorNode)
+            self.segmentEditorWidget.setSegmentationNode(self.segmentation_node)
+            self.segmentEditorWidget.setSourceVolumeNode(self.volume_node)
+
+            if self.reuse_nodes and self._in_scene(self.pointListNode):
+                self.pointListNode.RemoveAllControlPoints()
+            else:
+                self.pointListNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+                self.pointListNode.CreateDefaultDisplayNodes()
+        if not jump_to_centroids:
+            return
         
-        # Compute centroids and jump to them
+        # Jump to the centroids of the visible segments
+        with self.timer.stage("segment_statistics"):
+            centroids = self._segment_centroids(case)
+            if centroids is None:
+                centroids = self._segment_statistics_centroids()
+        markupsLogic = slicer.modules.markups.logic()
+        segmentation = self.segmentation_node.GetSegmentation()
+        for segmentId, centroid_ras in centroids.items():
+            if self.segment_visiblity_states.get(segmentation.GetSegment(segmentId).GetName(), True):
+                markupsLogic.JumpSlicesToLocation(*centroid_ras, False)
+
+    def _segment_centroids(self, case=None):
+        """RAS centroid of each segment computed from the mask voxels, or None if segments and labels do not match"""
+        session = self.session
+        mask_path = session.segmentation_files[session.current_index]
+        if not mask_path or not os.path.exists(mask_path):
+            return None
+        try:
+            if case is not None and case.mask is not None and (case.downsampling != 1 or case.crop is not None):
+                # preview or cropped mask: not cached under the mask file, whose voxel indexes differ
+                statistics = label_statistics(case.mask, case.mask_geometry)
+            elif case is not None and case.mask is not None and case.mask_path == mask_path:
+                statistics = self.logic.centroids.get(mask_path, case.mask, case.mask_geometry)
+            else:
+                # computed ahead by the QA pre-pass, if it ran
+                statistics = None
+                if self.logic.qa is not None:
+                    statistics = self.logic.qa.statistics(session.nifti_files[session.current_index], mask_path)
+                if statistics is None:
+                    statistics = self.logic.centroids.get(mask_path)
+        except Exception as e:
+            logging.getLogger('SegmentationReview').info(f'Cannot compute centroids of {mask_path}: {e}')
+            return None
+        # segments are imported from the labelmap in increasing label value order
+        segment_ids = list(self.segmentation_node.GetSegmentation().GetSegmentIDs())
+        if len(segment_ids) != len(statistics):
+            return None
+        return dict(zip(segment_ids, statistics.centroids_ras))
+
+    def _segment_statistics_centroids(self):
+        """RAS centroid of each segment computed by SegmentStatistics (slower, works for any segmentation)"""
         segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
         segStatLogic.getParameterNode().SetParameter("Segmentation", self.segmentation_node.GetID())
         segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.centroid_ras.enabled", str(True))
         segStatLogic.computeStatistics()
         stats = segStatLogic.getStatistics()
-        
-        self.pointListNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
-        self.pointListNode.CreateDefaultDisplayNodes()
-        
-        markupsLogic = slicer.modules.markups.logic()
-        for segmentId in stats["SegmentIDs"]:
-            if self.segment_visiblity_states.get(segmentId, True):
-                centroid_ras = stats[segmentId, "LabelmapSegmentStatisticsPlugin.centroid_ras"]
-                markupsLogic.JumpSlicesToLocation(*centroid_ras, False)
+        return {segmentId: stats[segmentId, "LabelmapSegmentStatisticsPlugin.centroid_ras"] for segmentId in stats["SegmentIDs"]}
 
     def cleanup(self):
         """
         Called when the application closes and the module widget is destroyed.
         """
         self.removeObservers()
+        if self.scanTimer:
+            self.scanTimer.stop()
+        if self.refineTimer:
+            self.refineTimer.stop()
+        if self.qaTimer:
+            self.qaTimer.stop()
+        if self.checkTimer:
+            self.checkTimer.stop()
+        if self.compareTimer:
+            self.compareTimer.stop()
+        if self.mask_writer:
+            # the edited masks that are still queued are written before Slicer exits
+            self.mask_writer.shutdown()
+            self.onSaveTimer()
+        if self.prefetcher:
+            self.prefetcher.shutdown()
+        # the timing summary goes to the log of the session, which closeSession closes
+        self._close_timer()
+        if self.logic:
+            self.logic.closeSession()
         #self.effectFactorySingleton.disconnect("effectRegistered(QString)", self.editorEffectRegistered)
 
     def exit(self):
@@ -792,6 +1380,162 @@ class SlicerLikertDLratingLogic(ScriptedLoadableModuleLogic):
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        self.session = ReviewSession()
+        self.centroids = CentroidCache()  # per-label centroids of mask files, used to jump to the segments
+        self.qa = None  # QA pre-pass of the session, see startQualityPrePass
+        self.doctor = None  # header check of the session, see startDatasetCheck
+        self.resampling = None  # resampling of the masks of the session, see startResamplePass
+        self.comparison = None  # comparison of the predictions of the session, see startComparison
+        self.log = SessionLog()  # segmentation_review.log of the current directory
+        self._sharedArrays = {}  # volume node ID -> array whose buffer the image data of the node uses
+
+    def openDirectory(self, directory, annotation_backend="csv", recursive=False, mask_patterns=DEFAULT_MASK_PATTERNS,
+                      review_order="sequential", reviewer=None):
+        """Start a new review session: discover the cases of ``directory`` and restore previous annotations.
+
+        ``review_order`` is the name of a scheduler in SegmentationReviewLib.SCHEDULERS. With a
+        ``reviewer`` name, the session is shared with the other reviewers of the directory.
+        """
+        self.closeSession()
+        # the log of the new directory gets the discovery messages
+        self.log.open(directory)
+        self.session = ReviewSession(annotation_backend, recursive=recursive, mask_patterns=mask_patterns,
+                                     scheduler=SCHEDULERS[review_order], reviewer=reviewer).open(directory)
+        return self.session
+
+    def setVolumeArray(self, volumeNode, array, ijkToRAS):
+        """Make ``array`` (KJI order, as read by SimpleITK) the voxels of a volume node.
+
+        Unlike slicer.util.updateVolumeFromArray, the image data wraps the buffer of the array
+        instead of copying it; the array is referenced here for as long as the node uses it.
+        Arrays memory-mapped from the volume cache are mapped copy-on-write, so they are used
+        as they are: the node's voxels stay in the OS file cache until the segment editor
+        writes into them. Read-only arrays are copied.
+        """
+        if not array.flags.writeable or not array.flags.c_contiguous or array.dtype == bool:
+            array = np.array(array, dtype=np.uint8 if array.dtype == bool else array.dtype, order="C")
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(*reversed(array.shape))
+        imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array.reshape(-1), deep=False))
+        self._sharedArrays = {nodeID: shared for nodeID, shared in self._sharedArrays.items()
+                              if slicer.mrmlScene.GetNodeByID(nodeID) is not None}
+        self._sharedArrays[volumeNode.GetID()] = array
+        volumeNode.SetIJKToRASMatrix(ijkToRAS)
+        volumeNode.SetAndObserveImageData(imageData)
+        volumeNode.StorableModified()
+        return volumeNode
+
+    def startQualityPrePass(self, workers=None):
+        """Compute the QA metrics of the cases of the session on a process pool, in the background.
+
+        The table is written to qa_metrics.csv in the dataset directory; ``self.qa`` answers
+        the metrics of the cases already done (see SegmentationReviewLib.qa.QualityPrePass).
+        """
+        if self.qa is not None:
+            self.qa.cancel()
+        session = self.session
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        self.qa = QualityPrePass(session.directory, zip(session.nifti_files, session.segmentation_files),
+                                 workers, self._processContext()).start()
+        return self.qa
+
+    def applyQualityPrePass(self):
+        """Set the mask status of the cases whose mask the QA pre-pass could not load"""
+        if self.qa is None or not self.qa.done:
+            return 0
+        failed = [row["mask_path"] for row in (self.qa.row(path) for path in self.session.nifti_files)
+                  if row is not None and row["mask_load_failed"]]
+        return self.session.mark_unloadable_masks(failed)
+
+    def startDatasetCheck(self, workers=None):
+        """Check the image and mask headers of the cases of the session on a process pool, in the background.
+
+        The report is written to dataset_doctor.csv in the dataset directory (see
+        SegmentationReviewLib.doctor.DatasetDoctor).
+        """
+        if self.doctor is not None:
+            self.doctor.cancel()
+        session = self.session
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        self.doctor = DatasetDoctor(session.directory, zip(session.nifti_files, session.segmentation_files),
+                                    workers, self._processContext()).start()
+        return self.doctor
+
+    def startResamplePass(self, cache, workers=None):
+        """Resample the masks of the session that are not on the grid of their image into ``cache``
+        (a SegmentationReviewLib.resample.ResampleCache) on a process pool, in the background."""
+        if self.resampling is not None:
+            self.resampling.cancel()
+        session = self.session
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        self.resampling = ResamplePass(cache, zip(session.nifti_files, session.segmentation_files),
+                                       workers, self._processContext()).start()
+        return self.resampling
+
+    def startComparison(self, workers=None):
+        """Compare the predictions of the cases of the session with their mask on a process pool, in the background.
+
+        The metrics are written to comparison_metrics.csv in the dataset directory (see
+        SegmentationReviewLib.compare.ComparisonPass).
+        """
+        if self.comparison is not None:
+            self.comparison.cancel()
+        session = self.session
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        cases = [(image_path, mask_path, session.prediction_files(index))
+                 for index, (image_path, mask_path) in enumerate(zip(session.nifti_files, session.segmentation_files))]
+        self.comparison = ComparisonPass(session.directory, cases, workers, self._processContext()).start()
+        return self.comparison
+
+    def caseMetrics(self, index):
+        """Comparison metrics of the predictions of case ``index``, stored with its rating. None if the
+        comparison has not reached the case yet or its mask (or latest revision) was edited since: the
+        metrics are never computed in the GUI thread, the next comparison of the dataset updates them."""
+        session = self.session
+        if not session.prediction_files(index) or self.comparison is None:
+            return None
+        return self.comparison.metrics(session.nifti_files[index], session.segmentation_files[index])
+
+    def applyDatasetCheck(self):
+        """Set the mask status of the cases whose mask is unreadable or corrupt"""
+        if self.doctor is None or not self.doctor.done:
+            return 0
+        return self.session.mark_unloadable_masks(self.doctor.unloadable_masks())
+
+    @staticmethod
+    def _processContext():
+        """Multiprocessing context whose workers run PythonSlicer, as the Slicer executable cannot be used"""
+        context = multiprocessing.get_context("spawn")
+        executable = os.path.join(slicer.app.slicerHome, "bin", "PythonSlicer" + (".exe" if os.name == "nt" else ""))
+        if os.path.exists(executable):
+            context.set_executable(executable)
+        return context
+
+    def exportAnnotations(self, output_directory=None):
+        """Write the per-case, per-reviewer and agreement summaries of the ratings of the current directory"""
+        self.session.store.flush()
+        return export_annotations(self.session.directory, output_directory)
+
+    def closeSession(self):
+        """Commit the ratings of the current session"""
+        if self.qa is not None:
+            self.qa.cancel()
+            self.qa = None
+        if self.doctor is not None:
+            self.doctor.cancel()
+            self.doctor = None
+        if self.resampling is not None:
+            self.resampling.cancel()
+            self.resampling = None
+        if self.comparison is not None:
+            self.comparison.cancel()
+            self.comparison = None
+        self.session.close()
+        self.log.close()
 
     
 #
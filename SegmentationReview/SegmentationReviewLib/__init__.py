@@ -0,0 +1,47 @@
+"""Qt-free helpers of the SegmentationReview module.
+
+Nothing in this package imports slicer, vtk or qt, so it can be used (and benchmarked)
+from plain Python as well as from inside 3D Slicer.
+"""
+
+from .prefetch import CaseData, CasePrefetcher, geometry_from_ijk_to_ras, ijk_to_ras, read_case, read_image
+from .common import (
+    ANNOTATION_COLUMNS,
+    CANNOT_LOAD_MASK,
+    MASK_EDITED,
+    MASK_LOADED,
+    NO_MASK,
+    is_valid_extension,
+    joinpath,
+    numerical_status_to_str,
+    rating_to_str,
+    split_extension,
+)
+from .ingest import classify_listing, classify_mapping, list_existing
+from .case_index import CaseIndex, discover
+from .scan import DEFAULT_MASK_PATTERNS, DirectoryScanner, pair_masks, parse_mask_patterns
+from .session import ReviewSession
+from .store import CsvAnnotationStore, SqliteAnnotationStore, open_annotation_store
+from .volume_cache import VolumeCache
+from .preview import PreviewCache, downsample
+from .mask_writer import MaskWriter, save_mask, write_mask
+from .revisions import (
+    MaskRevisions,
+    compact_dataset,
+    has_revisions,
+    read_latest_revision,
+    revisions_directory,
+    save_edit,
+    save_revision,
+)
+from .centroids import CentroidCache, LabelStatistics, file_digest, label_statistics
+from .qa import QA_METRICS_FILENAME, QualityPrePass, case_metrics, read_metrics
+from .scheduler import SCHEDULERS, PriorityScheduler, sequential
+from .shards import CaseLeases, default_reviewer, merge_annotations, read_all_annotations, reviewer_name
+from .export import annotation_sources, cohen_kappa, export_annotations, fleiss_kappa, read_latest
+from .timing import TIMINGS_FILENAME, StageTimer, read_timings, summarize as summarize_timings
+from .session_log import LOG_FILENAME, SessionLog
+from .crop import Crop, crop_case, mask_bounding_box, read_cropped_case, read_region, save_uncropped, uncrop
+from .doctor import DOCTOR_FILENAME, DatasetDoctor, check_case, read_report as read_doctor_report
+from .resample import RESAMPLE_DIRECTORY, ResampleCache, ResamplePass, resample_mask, same_grid
+from .compare import COMPARISON_FILENAME, ComparisonPass, compare_case, compare_masks, prediction_metrics, read_comparison
@@ -0,0 +1,288 @@
+"""Benchmarks of the session engine, runnable without the Slicer GUI.
+
+Run from the SegmentationReview module directory, e.g.::
+
+    python -m SegmentationReviewLib.benchmarks restore
+
+Benchmarks that compare with a Slicer code path (such as SegmentStatistics) only time
+that path when run with Slicer's Python, e.g. from the Python console::
+
+    from SegmentationReviewLib import benchmarks; benchmarks.main(["centroids"])
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from .centroids import label_statistics
+from .common import ANNOTATION_COLUMNS, MASK_LOADED, joinpath, numerical_status_to_str, rating_to_str
+from .prefetch import ijk_to_ras, read_case
+from .session import ReviewSession
+from .store import ANNOTATION_STORES, CsvAnnotationStore, open_annotation_store
+
+
+def _synthetic_session(directory, n_cases, n_annotated, unique=False, cases_per_subject=4):
+    """A session over ``n_cases`` synthetic cases, with ``n_annotated`` of them in annotations.csv."""
+    session = ReviewSession()
+    session.directory = directory
+    session.unique_case_flag = unique
+    session.nifti_files = [joinpath(directory, f"case{i:06d}.nii.gz") for i in range(n_cases)]
+    session.segmentation_files = [joinpath(directory, f"case{i:06d}_mask.nii.gz") for i in range(n_cases)]
+    session.seg_mask_status = [MASK_LOADED] * n_cases
+    if unique:
+        session.id_subs = [f"subj{i // cases_per_subject:06d}" for i in range(n_cases)]
+
+    ratings = [rating_to_str(1 + i % 5) for i in range(n_annotated)]
+    pd.DataFrame({
+        "file": [f"case{i:06d}.nii.gz" for i in range(n_annotated)],
+        "annotation": ratings,
+        "comment": [""] * n_annotated,
+        "mask_path": [f"case{i:06d}_mask.nii.gz" for i in range(n_annotated)],
+        "mask_status": [numerical_status_to_str(MASK_LOADED)] * n_annotated,
+    }, columns=ANNOTATION_COLUMNS).to_csv(session.annotations_path, index=False, header=False)
+    session.store = CsvAnnotationStore(directory)
+    return session
+
+
+def _legacy_restore(session, ann_csv):
+    """The list-membership restore used before hashed indexes, kept for comparison."""
+    list_of_checked = [session._construct_full_path(i) for i in ann_csv['file'].values]
+    unchecked = []
+    for i in range(len(session.nifti_files)):
+        if session.nifti_files[i] not in list_of_checked:
+            unchecked.append(session.nifti_files[i])
+    return unchecked
+
+
+def benchmark_restore(sizes=(1000, 10000, 100000), unique=False, legacy_max=10000):
+    """Time restoring a session from annotations.csv with all but 10% of the cases annotated.
+
+    Returns a list of dicts with the case count and the restore time in seconds, and the
+    time of the former list-based restore for sizes up to ``legacy_max`` (it is quadratic).
+    """
+    results = []
+    for n_cases in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            session = _synthetic_session(directory, n_cases, n_annotated=n_cases * 9 // 10, unique=unique)
+            all_files = list(session.nifti_files)
+
+            start = time.perf_counter()
+            session.restore_annotations()
+            restore_seconds = time.perf_counter() - start
+
+            legacy_seconds = None
+            if not unique and n_cases <= legacy_max:
+                session.nifti_files = all_files
+                ann_csv = pd.read_csv(session.annotations_path, header=None, index_col=False, names=ANNOTATION_COLUMNS)
+                start = time.perf_counter()
+                _legacy_restore(session, ann_csv)
+                legacy_seconds = time.perf_counter() - start
+
+            results.append({"cases": n_cases, "left": session.n_files,
+                            "restore_s": restore_seconds, "legacy_restore_s": legacy_seconds})
+    return results
+
+
+def benchmark_store(sizes=(1000, 10000, 100000), ratings=200):
+    """Time ``ratings`` appends and the restore read on stores that already hold ``size`` ratings."""
+    results = []
+    for backend in ANNOTATION_STORES:
+        for n_existing in sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                # fill the store through annotations.csv, which the SQLite store imports on creation
+                _synthetic_session(directory, n_existing, n_annotated=n_existing)
+                store = open_annotation_store(directory, backend)
+                record = {"file": "new.nii.gz", "annotation": rating_to_str(2), "comment": "",
+                          "mask_path": "new_mask.nii.gz", "mask_status": numerical_status_to_str(MASK_LOADED)}
+                start = time.perf_counter()
+                for _ in range(ratings):
+                    store.append(record)
+                append_seconds = (time.perf_counter() - start) / ratings
+                store.flush()
+
+                start = time.perf_counter()
+                store.read_checked()
+                read_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                store.is_checked("case000000.nii.gz")
+                lookup_seconds = time.perf_counter() - start
+                store.close()
+            results.append({"backend": backend, "ratings": n_existing, "append_s": append_seconds,
+                            "read_s": read_seconds, "first_lookup_s": lookup_seconds})
+    return results
+
+
+def _synthetic_mask(size, n_labels=3):
+    """A size^3 labelmap with ``n_labels`` spheres of increasing label value."""
+    k, j, i = np.ogrid[:size, :size, :size]
+    mask = np.zeros((size, size, size), dtype=np.uint8)
+    for label in range(1, n_labels + 1):
+        center = size * label / (n_labels + 1)
+        radius = size / (3 * (n_labels + 1))
+        mask[(k - center) ** 2 + (j - size / 2) ** 2 + (i - center) ** 2 <= radius ** 2] = label
+    return mask
+
+
+def _segment_statistics_seconds(mask):
+    """Time of the SegmentStatistics centroid computation on ``mask``, or None outside of Slicer."""
+    try:
+        import slicer
+        import SegmentStatistics
+    except ImportError:
+        return None
+    labelmap_node = slicer.util.addVolumeFromArray(mask, nodeClassName="vtkMRMLLabelMapVolumeNode")
+    segmentation_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmap_node, segmentation_node)
+    start = time.perf_counter()
+    segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
+    segStatLogic.getParameterNode().SetParameter("Segmentation", segmentation_node.GetID())
+    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.centroid_ras.enabled", str(True))
+    segStatLogic.computeStatistics()
+    segStatLogic.getStatistics()
+    seconds = time.perf_counter() - start
+    slicer.mrmlScene.RemoveNode(segmentation_node)
+    slicer.mrmlScene.RemoveNode(labelmap_node)
+    return seconds
+
+
+def benchmark_centroids(sizes=(256, 512), n_labels=3):
+    """Time the NumPy centroid engine, and SegmentStatistics when run inside Slicer, on synthetic masks."""
+    geometry = {"spacing": (1.0, 1.0, 1.0), "origin": (0.0, 0.0, 0.0), "direction": (1, 0, 0, 0, 1, 0, 0, 0, 1)}
+    results = []
+    for size in sizes:
+        mask = _synthetic_mask(size, n_labels)
+        start = time.perf_counter()
+        label_statistics(mask, geometry)
+        numpy_seconds = time.perf_counter() - start
+        results.append({"size": size, "labels": n_labels, "numpy_s": numpy_seconds,
+                        "segment_statistics_s": _segment_statistics_seconds(mask)})
+    return results
+
+
+def _rss_bytes():
+    """Resident memory of the process, or None if it cannot be read."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _timed_peak(function):
+    """Seconds and peak resident memory increase (MB, sampled every 2 ms) of ``function()``; returns its result too."""
+    baseline = _rss_bytes()
+    peak = [baseline or 0]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.002):
+            peak[0] = max(peak[0], _rss_bytes() or 0)
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+    finally:
+        seconds = time.perf_counter() - start
+        done.set()
+        sampler.join()
+    peak_mb = None if baseline is None else (max(peak[0], _rss_bytes() or 0) - baseline) / 1024 ** 2
+    return seconds, peak_mb, result
+
+
+def _slicer_load_results(image_path, mask_path, repeats):
+    """Time and peak memory of slicer.util.loadVolume/loadSegmentation and of the SimpleITK shared-array loader,
+    or None outside of Slicer."""
+    try:
+        import slicer
+        from SegmentationReview import SlicerLikertDLratingLogic
+    except ImportError:
+        return None
+    logic = SlicerLikertDLratingLogic()
+
+    def file_readers():
+        return [slicer.util.loadVolume(image_path), slicer.util.loadSegmentation(mask_path)]
+
+    def shared_arrays():
+        case = read_case(image_path, mask_path)
+        nodes = []
+        for array, geometry, nodeClassName in [(case.image, case.image_geometry, "vtkMRMLScalarVolumeNode"),
+                                               (case.mask, case.mask_geometry, "vtkMRMLLabelMapVolumeNode")]:
+            node = slicer.mrmlScene.AddNewNodeByClass(nodeClassName)
+            logic.setVolumeArray(node, array, slicer.util.vtkMatrixFromArray(ijk_to_ras(geometry)))
+            nodes.append(node)
+        segmentation_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(nodes[1], segmentation_node)
+        return nodes + [segmentation_node]
+
+    results = {}
+    for name, loader in [("file_readers", file_readers), ("sitk_shared", shared_arrays)]:
+        seconds, peaks = [], []
+        for _ in range(repeats):
+            elapsed, peak_mb, nodes = _timed_peak(loader)
+            seconds.append(elapsed)
+            peaks.append(peak_mb)
+            for node in nodes:
+                slicer.mrmlScene.RemoveNode(node)
+        results[f"{name}_s"] = float(np.median(seconds))
+        results[f"{name}_peak_mb"] = None if None in peaks else float(max(peaks))
+    return results
+
+
+def benchmark_load(sizes=(256, 512), repeats=3):
+    """Per-case load time and peak memory of a size^3 int16 image and its mask written as .nii.gz: SimpleITK
+    read only, and inside Slicer the Slicer file readers against the SimpleITK shared-array loader."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            image_path = os.path.join(directory, f"image{size}.nii.gz")
+            mask_path = os.path.join(directory, f"image{size}_mask.nii.gz")
+            mask = _synthetic_mask(size)
+            sitk.WriteImage(sitk.GetImageFromArray((mask * 100).astype(np.int16)), image_path)
+            sitk.WriteImage(sitk.GetImageFromArray(mask), mask_path)
+            read = [_timed_peak(lambda: read_case(image_path, mask_path)) for _ in range(repeats)]
+            row = {"size": size, "sitk_read_s": float(np.median([seconds for seconds, _, _ in read])),
+                   "sitk_read_peak_mb": read[-1][1]}
+            row.update(_slicer_load_results(image_path, mask_path, repeats) or {})
+            results.append(row)
+    return results
+
+
+def _print_results(title, results):
+    print(title)
+    for row in results:
+        print("  " + ", ".join(f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}"
+                               for key, value in row.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SegmentationReview benchmarks")
+    parser.add_argument("benchmark", choices=["restore", "store", "centroids", "load"])
+    parser.add_argument("--sizes", type=int, nargs="+", help="number of cases or ratings (volume edge length for centroids and load)")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "restore":
+        sizes = args.sizes or [1000, 10000, 100000]
+        _print_results("restore (mapping.csv / directory listing)", benchmark_restore(sizes))
+        _print_results("restore (mapping_unique.csv)", benchmark_restore(sizes, unique=True))
+    elif args.benchmark == "store":
+        _print_results("annotation stores", benchmark_store(args.sizes or [1000, 10000, 100000]))
+    elif args.benchmark == "centroids":
+        _print_results("centroids", benchmark_centroids(args.sizes or [256, 512]))
+    elif args.benchmark == "load":
+        _print_results("case loading", benchmark_load(args.sizes or [256, 512]))
+
+
+if __name__ == "__main__":
+    main()
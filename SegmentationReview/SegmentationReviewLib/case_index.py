@@ -0,0 +1,205 @@
+"""Persistent index of the cases discovered in a dataset directory.
+
+The case table (image path, mask path, mask status, subj_id, image size and mtime) is
+saved to a hidden file in the dataset directory together with the state of every
+directory it references: its modification time and a hash of the names of the image
+files in it. Reopening the dataset lists again the directories whose modification time
+changed, and revalidates those where image files were added, removed or renamed; the
+rows of all other directories are taken from the index as they are. Files that are not
+images, such as the annotations and reports written next to the cases, change the
+modification time of their directory but not the names hashed, so they do not cause a
+revalidation.
+"""
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .common import VALID_EXTENSIONS, joinpath
+from .ingest import _add_subjects, _classify_paths, _parent_directories, classify_listing, classify_mapping, log_summary
+
+logger = logging.getLogger('SegmentationReview')
+
+CASE_INDEX_FILENAME = ".segmentation_review_cases.csv"
+CASE_INDEX_VERSION = 2
+LISTING = "listing"  # source of a dataset directory without mapping file
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _mtime(directory):
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+
+def directory_signature(directory):
+    """Hash of the sorted names of the image files in a directory (".nii" in the name or a valid
+    extension, as the listing and the mapping accept), None if it cannot be listed."""
+    try:
+        with os.scandir(directory) as entries:
+            names = sorted(entry.name for entry in entries if ".nii" in entry.name or entry.name.endswith(VALID_EXTENSIONS))
+    except OSError:
+        return None
+    return hashlib.blake2b("\0".join(names).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def directory_states(directories):
+    """``[modification time (ns), signature]`` of each directory, None for directories that cannot be read."""
+    states = {}
+    for directory in directories:
+        mtime = _mtime(directory)
+        states[directory] = None if mtime is None else [mtime, directory_signature(directory)]
+    return states
+
+
+def changed_directories(saved_states):
+    """Directories of ``saved_states`` (see directory_states) whose image files changed since. Only
+    the directories whose modification time changed are listed."""
+    changed = set()
+    for directory, state in saved_states.items():
+        mtime = _mtime(directory)
+        if state is None or mtime is None:
+            if state is not None or mtime is not None:
+                changed.add(directory)
+        elif mtime != state[0] and directory_signature(directory) != state[1]:
+            changed.add(directory)
+    return changed
+
+
+def stat_files(paths, workers=16, chunk_size=1024):
+    """Size and mtime (ns) of each path, -1 for missing files; stat calls run on a thread pool,
+    which hides most of the latency of network filesystems."""
+    def stat_chunk(chunk):
+        result = []
+        for path in chunk:
+            try:
+                stat = os.stat(path)
+                result.append((stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                result.append((-1, -1))
+        return result
+
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        stats = [stat for chunk in executor.map(stat_chunk, chunks) for stat in chunk]
+    return np.array(stats, dtype=np.int64).reshape(-1, 2)
+
+
+def _add_file_stats(table, rows):
+    """Fill the size and mtime_ns columns of the given rows, -1 for rows without valid image."""
+    if "size" not in table:
+        table["size"] = np.int64(-1)
+        table["mtime_ns"] = np.int64(-1)
+    table.loc[rows & ~table["img_valid"], ["size", "mtime_ns"]] = -1
+    rows = rows & table["img_valid"]
+    stats = stat_files(table.loc[rows, "img_path"].tolist())
+    if len(stats):
+        table.loc[rows, "size"] = stats[:, 0]
+        table.loc[rows, "mtime_ns"] = stats[:, 1]
+    return table
+
+
+def _referenced_directories(table, directory):
+    masks = table.loc[table["mask_ref"] != "", "mask_ref"]
+    parents = pd.concat([_parent_directories(pd.Series([joinpath(directory, "")])), _parent_directories(table["img_path"]),
+                         _parent_directories(masks)])
+    return set(parents.unique())
+
+
+class CaseIndex:
+    """The case index file of one dataset directory."""
+
+    def __init__(self, directory):
+        self.path = joinpath(directory, CASE_INDEX_FILENAME)
+
+    def load(self, source, signature):
+        """Return the saved ``(table, directory states)``, or None if missing or built from another source."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                if (header.get("version") != CASE_INDEX_VERSION or header.get("source") != source
+                        or header.get("signature") != signature):
+                    return None
+                table = pd.read_csv(f, keep_default_na=False, na_values=[], dtype={"img_path": str, "mask_path": str, "mask_ref": str})
+            if len(table) != header["rows"]:
+                raise ValueError(f'{len(table)} rows instead of {header["rows"]}, the index was not fully written')
+        except (OSError, ValueError, KeyError) as e:
+            if os.path.exists(self.path):
+                logger.info(f'Ignoring case index {self.path}: {e}')
+            return None
+        return table, header["directories"]
+
+    def save(self, table, source, signature, directories):
+        """Write the index with the current states of ``directories`` (see directory_states).
+
+        The file is created first and then written in place: creating or renaming a file
+        changes the mtime of the dataset directory, and an unchanged mtime spares the
+        listing of the directory on the next open.
+        """
+        try:
+            if not os.path.exists(self.path):
+                open(self.path, "w").close()
+            header = {"version": CASE_INDEX_VERSION, "source": source, "signature": signature,
+                      "rows": len(table), "directories": directory_states(directories)}
+            with open(self.path, "w", encoding="utf-8", newline="") as f:
+                f.write(json.dumps(header) + "\n")
+                table.to_csv(f, index=False)
+        except OSError as e:
+            # e.g. a read-only dataset directory: discovery simply runs again next time
+            logger.info(f'Cannot save case index {self.path}: {e}')
+
+
+def discover(directory, source=LISTING, mappings=None, use_index=True):
+    """Case table of a dataset directory, reusing and refreshing its case index.
+
+    ``source`` is the mapping file name (``mappings`` is then its content) or LISTING for
+    a directory without mapping file. See ingest.classify_mapping for the table columns;
+    ``size`` and ``mtime_ns`` of the images are added.
+    """
+    signature = file_signature(joinpath(directory, source)) if mappings is not None else None
+    case_index = CaseIndex(directory)
+    cached = case_index.load(source, signature) if use_index else None
+
+    if cached is None:
+        table = classify_listing(directory) if mappings is None else classify_mapping(mappings, directory)
+        table = _add_file_stats(table, pd.Series(True, index=table.index))
+        changed = None
+    else:
+        table, saved_states = cached
+        changed = changed_directories(saved_states)
+        if not changed:
+            logger.info(f'Case index: {len(table)} cases, no changed directories')
+            return table
+        if mappings is None:
+            # the listing has a single directory: list it again, keep the file stats of known images
+            fresh = classify_listing(directory)
+            known = fresh["img_path"].isin(set(table["img_path"]))
+            # nullable integers: float would round the mtimes in ns
+            fresh = fresh.merge(table[["img_path", "size", "mtime_ns"]].astype({"size": "Int64", "mtime_ns": "Int64"}),
+                                on="img_path", how="left")
+            fresh[["size", "mtime_ns"]] = fresh[["size", "mtime_ns"]].fillna(-1).astype(np.int64)
+            table = _add_file_stats(fresh, ~known)
+        else:
+            rows = (_parent_directories(table["img_path"]).isin(changed)
+                    | _parent_directories(table["mask_ref"]).isin(changed))
+            # only the paths of the changed rows are checked again; the subjects are numbered
+            # over all rows, as in a full classification
+            fresh = _classify_paths(mappings[rows.values], directory)
+            for column in fresh.columns:
+                table.loc[rows.values, column] = fresh[column].values
+            table = _add_subjects(_add_file_stats(table, rows), mappings)
+        logger.info(f'Case index: {len(table)} cases, {len(changed)} changed directories revalidated')
+
+    log_summary(table, "Case index" if changed else source)
+    if use_index:
+        case_index.save(table, source, signature, _referenced_directories(table, directory))
+    return table
@@ -0,0 +1,119 @@
+"""Per-label centroids and bounding boxes of a labelmap, computed with NumPy.
+
+This is what the widget needs to jump the slice views to the segments, without running
+the full SegmentStatistics machinery. Results are cached by the content hash of the
+mask file, so revisiting a case (or an identical copy of its mask) costs nothing.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .prefetch import ijk_to_ras, read_image
+
+
+class LabelStatistics:
+    """Voxel count, centroid and bounding box of every non-zero label of a labelmap.
+
+    All attributes are arrays with one row per label, sorted by label value:
+    ``labels``, ``counts``, ``centroids_ijk`` / ``centroids_ras`` (n x 3) and
+    ``bbox_min_ijk`` / ``bbox_max_ijk`` (n x 3, inclusive voxel indexes).
+    """
+
+    def __init__(self, labels, counts, centroids_ijk, bbox_min_ijk, bbox_max_ijk, geometry=None):
+        self.labels = labels
+        self.counts = counts
+        self.centroids_ijk = centroids_ijk
+        self.bbox_min_ijk = bbox_min_ijk
+        self.bbox_max_ijk = bbox_max_ijk
+        self.centroids_ras = None
+        if geometry is not None:
+            homogeneous = np.column_stack([centroids_ijk, np.ones(len(labels))])
+            self.centroids_ras = (ijk_to_ras(geometry) @ homogeneous.T).T[:, :3]
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def label_statistics(labelmap, geometry=None):
+    """Compute LabelStatistics of a labelmap array in KJI order (as read by SimpleITK or Slicer).
+
+    One pass finds the foreground voxels; their labels are grouped with np.unique and the
+    coordinate sums with np.bincount, so the cost is one scan of the array plus work
+    proportional to the number of foreground voxels.
+    """
+    flat = labelmap.ravel()
+    foreground = np.flatnonzero(flat)
+    labels, inverse = np.unique(flat[foreground], return_inverse=True)
+    n_labels = len(labels)
+    counts = np.bincount(inverse, minlength=n_labels)
+
+    # IJK coordinates of the foreground voxels, from their flat index
+    n_k, n_j, n_i = labelmap.shape
+    k, rest = np.divmod(foreground, n_j * n_i)
+    j, i = np.divmod(rest, n_i)
+    coordinates = (i, j, k)
+
+    centroids = np.empty((n_labels, 3))
+    bbox_min = np.empty((n_labels, 3), dtype=np.int64)
+    bbox_max = np.empty((n_labels, 3), dtype=np.int64)
+    for axis, values in enumerate(coordinates):
+        if n_labels:
+            centroids[:, axis] = np.bincount(inverse, weights=values, minlength=n_labels) / counts
+        if n_labels == 1:
+            bbox_min[0, axis], bbox_max[0, axis] = values.min(), values.max()
+        elif n_labels > 1:
+            bbox_min[:, axis] = np.iinfo(np.int64).max
+            bbox_max[:, axis] = -1
+            np.minimum.at(bbox_min[:, axis], inverse, values)
+            np.maximum.at(bbox_max[:, axis], inverse, values)
+    return LabelStatistics(labels, counts, centroids, bbox_min, bbox_max, geometry)
+
+
+def file_digest(path, chunk_size=1024 ** 2):
+    """BLAKE2 hash of a file's content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CentroidCache:
+    """LabelStatistics of mask files, cached by file content hash (least recently used are dropped)."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._statistics = OrderedDict()  # content hash -> LabelStatistics
+        self._digests = {}  # (path, size, mtime) -> content hash, so unchanged files are hashed once
+
+    def digest(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            digest = file_digest(path)
+            with self._lock:
+                self._digests[key] = digest
+        return digest
+
+    def get(self, mask_path, labelmap=None, geometry=None):
+        """Statistics of ``mask_path``; the mask is read from disk unless its array is given."""
+        digest = self.digest(mask_path)
+        with self._lock:
+            statistics = self._statistics.get(digest)
+            if statistics is not None:
+                self._statistics.move_to_end(digest)
+                return statistics
+        if labelmap is None:
+            labelmap, geometry = read_image(mask_path)
+        statistics = label_statistics(labelmap, geometry)
+        with self._lock:
+            self._statistics[digest] = statistics
+            while len(self._statistics) > self.max_entries:
+                self._statistics.popitem(last=False)
+        return statistics
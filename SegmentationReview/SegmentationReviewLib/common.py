@@ -0,0 +1,41 @@
+"""Definitions shared by the SegmentationReview helpers."""
+import os
+
+# mask status of a case
+NO_MASK = 0
+CANNOT_LOAD_MASK = 1
+MASK_LOADED = 2
+MASK_EDITED = 3
+
+ANNOTATION_COLUMNS = ["file", "annotation", "comment", "mask_path", "mask_status"]
+# optional last column of the annotation files: JSON metrics of the predictions of the case, see compare
+METRICS_COLUMN = "metrics"
+
+VALID_EXTENSIONS = (".nii.gz", ".nii", ".nrrd")  # longest first, see split_extension
+
+
+def joinpath(rootdir, targetdir):
+    return os.path.join(os.sep, rootdir + os.sep, targetdir)
+
+
+def is_valid_extension(path):
+    return path.endswith(VALID_EXTENSIONS)
+
+
+def split_extension(name):
+    """Split a file name into its stem and valid extension, e.g. ("case1", ".nii.gz")."""
+    for extension in VALID_EXTENSIONS:
+        if name.endswith(extension):
+            return name[:-len(extension)], extension
+    return name, ""
+
+
+def numerical_status_to_str(status):
+    return {0: "No mask found", 1: "Cannot load mask", 2: "Mask loaded, no edits", 3: "Mask edited"}[status]
+
+
+def rating_to_str(rating):
+    return {1: "Acceptable with no changes", 2: "Acceptable with minor changes",
+            3: "Unacceptable with major changes",
+            4: "Unacceptable and not visible",
+            5: "Bad images"}[rating]
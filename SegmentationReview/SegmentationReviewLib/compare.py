@@ -0,0 +1,304 @@
+"""Comparison of the predictions of a case with its mask.
+
+In comparison mode a mapping file has further mask columns next to ``mask_path``, named
+``mask_path_<prediction>`` (e.g. one per model version). Each prediction is compared with
+the mask of its case:
+
+- Dice of the foreground and of each label, from one bincount of the label pairs;
+- volumes and volume difference (prediction - mask) in ml;
+- 95th percentile Hausdorff distance and average symmetric surface distance in mm, from
+  distance maps computed on the bounding box of both masks only.
+
+A prediction that is not on the grid of the mask is resampled to it (nearest neighbour).
+A mask edited as revisions (see revisions) is compared from its latest revision.
+``ComparisonPass`` computes the metrics of all cases on a process pool when a dataset is
+opened and writes them to comparison_metrics.csv, reusing the rows of unchanged files. The
+metrics of a case are also stored with its rating (see store).
+"""
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from .common import joinpath
+from .crop import mask_bounding_box
+from .doctor import _error_message
+from .prefetch import _read_revision, read_image
+from .qa import _signature
+from .resample import resample_mask, same_grid
+from .revisions import MANIFEST_FILENAME, has_revisions, revisions_directory
+
+logger = logging.getLogger('SegmentationReview')
+
+COMPARISON_FILENAME = "comparison_metrics.csv"
+# metrics stored with the ratings and shown during the review, see prediction_metrics
+SUMMARY_METRICS = ["dice", "volume_difference_ml", "hd95_mm", "assd_mm"]
+_MAX_BINCOUNT_LABEL = 1023  # above, labels are renumbered with np.unique first
+
+
+def _label_indexes(reference, prediction):
+    """Both labelmaps as small non-negative integers, for a bincount of the label pairs, and the label values."""
+    if min(reference.min(initial=0), prediction.min(initial=0)) >= 0 and max(
+            reference.max(initial=0), prediction.max(initial=0)) <= _MAX_BINCOUNT_LABEL:
+        n_labels = int(max(reference.max(initial=0), prediction.max(initial=0))) + 1
+        return reference.astype(np.intp, copy=False), prediction.astype(np.intp, copy=False), np.arange(n_labels)
+    labels = np.union1d([0], np.concatenate([np.unique(reference), np.unique(prediction)]))
+    return np.searchsorted(labels, reference), np.searchsorted(labels, prediction), labels
+
+
+def _surface(mask):
+    """Voxels of a (zero padded) boolean mask with a 6-neighbour outside of the mask."""
+    interior = mask.copy()
+    for axis in range(3):
+        interior &= np.roll(mask, 1, axis) & np.roll(mask, -1, axis)
+    return mask & ~interior
+
+
+def _distance_to(surface, spacing):
+    """Distance (mm) of every voxel to the nearest voxel of ``surface``."""
+    image = sitk.GetImageFromArray(surface.astype(np.uint8))
+    image.SetSpacing([float(value) for value in spacing])
+    distance = sitk.SignedMaurerDistanceMap(image, insideIsPositive=False, squaredDistance=False, useImageSpacing=True)
+    return np.maximum(sitk.GetArrayViewFromImage(distance), 0)
+
+
+def surface_distances(reference, prediction, spacing):
+    """Distances (mm) from the surface of each boolean mask to the surface of the other, or None if one is empty.
+
+    The distance maps cover the bounding box of both masks plus one voxel only.
+    """
+    if not reference.any() or not prediction.any():
+        return None
+    start, stop = mask_bounding_box(reference | prediction)
+    region = tuple(slice(a, b) for a, b in zip(start, stop))
+    reference_surface = _surface(np.pad(reference[region], 1))
+    prediction_surface = _surface(np.pad(prediction[region], 1))
+    return (_distance_to(prediction_surface, spacing)[reference_surface],
+            _distance_to(reference_surface, spacing)[prediction_surface])
+
+
+def compare_masks(reference, prediction, spacing):
+    """Overlap metrics of a predicted labelmap with the reference labelmap on the same grid (KJI arrays,
+    ``spacing`` as in their geometry)."""
+    reference_indexes, prediction_indexes, labels = _label_indexes(reference, prediction)
+    n = len(labels)
+    confusion = np.bincount((reference_indexes * n + prediction_indexes).ravel(), minlength=n * n).reshape(n, n)
+    reference_counts, prediction_counts = confusion.sum(axis=1)[1:], confusion.sum(axis=0)[1:]
+    intersection = np.diag(confusion)[1:]
+    present = reference_counts + prediction_counts > 0
+    label_dice = 2 * intersection[present] / (reference_counts + prediction_counts)[present]
+    foreground = reference_counts.sum() + prediction_counts.sum()
+    voxel_ml = float(np.prod(spacing)) / 1000
+    metrics = {"dice": float(2 * confusion[1:, 1:].sum() / foreground) if foreground else np.nan,
+               "label_dice": {str(label): round(float(dice), 6) for label, dice in zip(labels[1:][present], label_dice)},
+               "volume_mask_ml": float(reference_counts.sum() * voxel_ml),
+               "volume_prediction_ml": float(prediction_counts.sum() * voxel_ml),
+               "volume_difference_ml": float((prediction_counts.sum() - reference_counts.sum()) * voxel_ml),
+               "hd95_mm": np.nan, "assd_mm": np.nan}
+    distances = surface_distances(reference > 0, prediction > 0, spacing)
+    if distances is not None:
+        metrics["hd95_mm"] = float(max(np.percentile(distances[0], 95), np.percentile(distances[1], 95)))
+        metrics["assd_mm"] = float(np.concatenate(distances).mean())
+    return metrics
+
+
+def _labels(mask):
+    return mask if np.issubdtype(mask.dtype, np.integer) else np.rint(mask).astype(np.int16)
+
+
+def mask_signature(image_path, mask_path, dataset_directory=None):
+    """``(size, mtime_ns)`` the metrics of a case are keyed by: of the revisions manifest if the mask was
+    edited as revisions in ``dataset_directory``, else of the mask file ((-1, -1) without mask)."""
+    if dataset_directory is not None:
+        directory = revisions_directory(dataset_directory, mask_path, image_path)
+        if has_revisions(directory):
+            return _signature(os.path.join(directory, MANIFEST_FILENAME))
+    return _signature(mask_path) if mask_path else (-1, -1)
+
+
+def compare_case(image_path, mask_path, predictions, dataset_directory=None):
+    """One row per prediction ``{name: path}`` of a case with its metrics, or the error that prevented them.
+    With ``dataset_directory``, a mask edited as revisions is compared from its latest revision."""
+    rows = []
+    mask_size, mask_mtime_ns = mask_signature(image_path, mask_path, dataset_directory)
+    reference = _read_revision(dataset_directory, mask_path, image_path)
+    for name, prediction_path in sorted(predictions.items()):
+        prediction_size, prediction_mtime_ns = _signature(prediction_path)
+        row = {"img_path": image_path, "prediction": name, "mask_path": mask_path, "prediction_path": prediction_path,
+               "mask_size": mask_size, "mask_mtime_ns": mask_mtime_ns, "prediction_size": prediction_size,
+               "prediction_mtime_ns": prediction_mtime_ns, "error": ""}
+        try:
+            if reference is None and not mask_path:
+                raise ValueError("no mask to compare with")
+            if reference is None:
+                reference = read_image(mask_path)
+            prediction, prediction_geometry = read_image(prediction_path)
+            if not same_grid(prediction.shape, prediction_geometry, reference[0].shape, reference[1]):
+                prediction, _ = resample_mask(prediction, prediction_geometry, reference[0].shape, reference[1])
+            row.update(compare_masks(_labels(reference[0]), _labels(prediction), reference[1]["spacing"]))
+        except Exception as e:
+            row["error"] = _error_message(e)
+        rows.append(row)
+    return rows
+
+
+def _compare_chunk(dataset_directory, cases):
+    # runs in the worker processes
+    return [row for image_path, mask_path, predictions in cases
+            for row in compare_case(image_path, mask_path, predictions, dataset_directory)]
+
+
+def prediction_metrics(rows):
+    """``{prediction: {metric: value}}`` of the SUMMARY_METRICS of the rows of a case, as stored with its rating."""
+    metrics = {}
+    for row in rows:
+        if not row["error"]:
+            metrics[row["prediction"]] = {key: None if pd.isna(row[key]) else round(float(row[key]), 4)
+                                          for key in SUMMARY_METRICS}
+    return metrics
+
+
+def read_comparison(path):
+    table = pd.read_csv(path, keep_default_na=False, na_values=[""], dtype={"img_path": str, "prediction": str, "mask_path": str,
+                                                                            "prediction_path": str, "error": str})
+    table[["mask_path", "prediction_path", "error"]] = table[["mask_path", "prediction_path", "error"]].fillna("")
+    table["label_dice"] = [json.loads(value) if isinstance(value, str) and value else {} for value in table["label_dice"]]
+    return table
+
+
+class ComparisonPass:
+    """Computes the metrics of the ``(image path, mask path, {prediction: path})`` cases of a dataset in the background.
+
+    Works as qa.QualityPrePass: ``start`` returns immediately, the rows of unchanged files are
+    taken from the previous comparison_metrics.csv, ``metrics`` answers for the cases done so
+    far, and the table is saved when all cases are done. Masks edited as revisions in the
+    dataset ``directory`` are compared from their latest revision.
+    """
+
+    def __init__(self, directory, cases, workers=None, mp_context=None, chunk_size=4):
+        self.directory = directory
+        self.path = joinpath(directory, COMPARISON_FILENAME)
+        self.cases = [case for case in cases if case[2]]
+        self.workers = workers
+        self.mp_context = mp_context
+        self.chunk_size = chunk_size
+        self._rows = {}  # image path -> rows of its predictions
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._cancelled = False
+        self._executor = None
+
+    def start(self):
+        threading.Thread(target=self._run, name="SegmentationReviewComparison", daemon=True).start()
+        return self
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def progress(self):
+        """(cases compared, total cases)"""
+        with self._lock:
+            return len(self._rows), len(self.cases)
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        self._cancelled = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _reusable_rows(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            previous = read_comparison(self.path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.info(f'Ignoring {self.path}: {e}')
+            return {}
+        rows = {}
+        for row in previous.to_dict("records"):
+            if ((row["mask_size"], row["mask_mtime_ns"]) == mask_signature(row["img_path"], row["mask_path"], self.directory)
+                    and (row["prediction_size"], row["prediction_mtime_ns"]) == _signature(row["prediction_path"])):
+                rows.setdefault(row["img_path"], []).append(row)
+        return rows
+
+    def _run(self):
+        try:
+            reusable = self._reusable_rows()
+            todo = []
+            for image_path, mask_path, predictions in self.cases:
+                rows = reusable.get(image_path, [])
+                if ({row["prediction"]: row["prediction_path"] for row in rows} == predictions
+                        and all(row["mask_path"] == mask_path for row in rows)):
+                    self._rows[image_path] = rows
+                else:
+                    todo.append((image_path, mask_path, predictions))
+            logger.info(f'Comparison: {len(self.cases) - len(todo)} cases unchanged, computing {len(todo)}')
+            if todo and not self._cancelled:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context)
+                futures = [self._executor.submit(_compare_chunk, self.directory, todo[i:i + self.chunk_size])
+                           for i in range(0, len(todo), self.chunk_size)]
+                for future in as_completed(futures):
+                    if self._cancelled:
+                        return
+                    computed = {}
+                    for row in future.result():
+                        computed.setdefault(row["img_path"], []).append(row)
+                    with self._lock:
+                        self._rows.update(computed)
+                self._executor.shutdown()
+            self.save()
+            logger.info(self.summary())
+        except Exception as e:
+            if not self._cancelled:
+                logger.error(f'Comparison of the predictions failed: {e}')
+        finally:
+            self._done.set()
+
+    def table(self):
+        with self._lock:
+            rows = [row for image_path, _, _ in self.cases for row in self._rows.get(image_path, [])]
+        table = pd.DataFrame(rows)
+        if "label_dice" in table:
+            table["label_dice"] = [json.dumps(value) if isinstance(value, dict) else "" for value in table["label_dice"]]
+        return table
+
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        self.table().to_csv(temporary_path, index=False)
+        os.replace(temporary_path, self.path)
+
+    def summary(self):
+        table = self.table()
+        if not len(table):
+            return 'Comparison: no predictions'
+        valid = table[table["error"] == ""]
+        dice = ", ".join(f"{name} {value:.3f}" for name, value in valid.groupby("prediction")["dice"].median().items())
+        return (f'Comparison: {table["img_path"].nunique()} cases, {len(table) - len(valid)} predictions could not be '
+                f'compared; median Dice {dice}')
+
+    def rows(self, image_path):
+        """Rows of the predictions of a case, or None if not compared (yet)."""
+        with self._lock:
+            return self._rows.get(image_path)
+
+    def metrics(self, image_path, mask_path=None):
+        """``{prediction: {metric: value}}`` of a case (see prediction_metrics), or None if not compared
+        (yet) or compared with another mask than ``mask_path`` or its latest revision, e.g. before it
+        was edited. Only looks up the rows: cheap enough for the GUI thread."""
+        rows = self.rows(image_path)
+        if rows is None:
+            return None
+        if mask_path is not None:
+            signature = mask_signature(image_path, mask_path, self.directory)
+            if any(row["mask_path"] != mask_path or (row["mask_size"], row["mask_mtime_ns"]) != signature for row in rows):
+                return None
+        return prediction_metrics(rows)
@@ -0,0 +1,166 @@
+"""Cases cropped to the region around their mask.
+
+The bounding box of the mask is found with one pass over the labelmap, padded by a
+margin in millimeters, and only that region of the image is read: ImageFileReader
+extracts it while reading, which for formats that support streaming (e.g. uncompressed
+NRRD) reads only the voxels of the region. Edits of a cropped mask are pasted back into
+the full-size mask with ``uncrop`` before they are saved.
+"""
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from .prefetch import CaseData, _read_revision, read_image
+from .resample import resample_mask, same_grid
+
+
+class Crop:
+    """Region ``start`` (KJI) of a case cropped from masks of ``full_shape`` and ``full_geometry``.
+
+    ``mask_path`` is the mask the voxels outside of the region come from when an edited
+    cropped mask is saved ("" for none).
+    """
+
+    def __init__(self, start, full_shape, full_geometry, mask_path=""):
+        self.start = tuple(int(index) for index in start)
+        self.full_shape = tuple(int(size) for size in full_shape)
+        self.full_geometry = full_geometry
+        self.mask_path = mask_path
+
+
+def mask_bounding_box(mask):
+    """Inclusive-exclusive ``(start, stop)`` KJI bounds of the non-zero voxels, None for an empty mask. Also
+    used for the voxels changed by an edit (see revisions)."""
+    bounds = []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        indexes = np.flatnonzero(mask.any(axis=other_axes))
+        if not len(indexes):
+            return None
+        bounds.append((indexes[0], indexes[-1] + 1))
+    return tuple(start for start, _ in bounds), tuple(stop for _, stop in bounds)
+
+
+def padded_region(bounds, shape, spacing, margin_mm):
+    """``(start, stop)`` KJI of ``bounds`` grown by ``margin_mm`` on each side, within ``shape``.
+    ``spacing`` is in IJK order, as in the geometry dicts."""
+    margin = [int(np.ceil(margin_mm / spacing_mm)) for spacing_mm in reversed(spacing)]
+    start = tuple(max(0, index - pad) for index, pad in zip(bounds[0], margin))
+    stop = tuple(min(size, index + pad) for index, size, pad in zip(bounds[1], shape, margin))
+    return start, stop
+
+
+def region_geometry(geometry, start):
+    """Geometry of the region of an image starting at voxel ``start`` (KJI)."""
+    direction = np.asarray(geometry["direction"], dtype=float).reshape(3, 3)
+    offset = direction @ (np.asarray(geometry["spacing"], dtype=float) * np.asarray(start[::-1], dtype=float))
+    return {"spacing": tuple(geometry["spacing"]),
+            "origin": tuple(np.asarray(geometry["origin"], dtype=float) + offset),
+            "direction": tuple(geometry["direction"])}
+
+
+def read_region(path, start, stop):
+    """Voxels ``start:stop`` (KJI) of an image file and their geometry, extracted while reading."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    full_geometry = {"spacing": reader.GetSpacing(), "origin": reader.GetOrigin(), "direction": reader.GetDirection()}
+    reader.SetExtractIndex([int(index) for index in reversed(start)])
+    reader.SetExtractSize([int(b - a) for a, b in zip(reversed(start), reversed(stop))])
+    image = reader.Execute()
+    return sitk.GetArrayFromImage(image), region_geometry(full_geometry, start)
+
+
+def crop_case(case, margin_mm):
+    """Crop a case read in full (e.g. by the prefetcher) to its mask; returns the case unchanged if it cannot be cropped."""
+    if case.mask is None or case.downsampling != 1 or not same_grid(
+            case.image.shape, case.image_geometry, case.mask.shape, case.mask_geometry):
+        return case
+    bounds = mask_bounding_box(case.mask)
+    if bounds is None:
+        return case
+    start, stop = padded_region(bounds, case.mask.shape, case.mask_geometry["spacing"], margin_mm)
+    region = tuple(slice(a, b) for a, b in zip(start, stop))
+    geometry = region_geometry(case.mask_geometry, start)
+    cropped = CaseData(case.image_path, case.mask_path, np.ascontiguousarray(case.image[region]), geometry,
+                       np.ascontiguousarray(case.mask[region]), geometry)
+    cropped.crop = Crop(start, case.mask.shape, case.mask_geometry, case.mask_path)
+    return cropped
+
+
+def read_cropped_case(image_path, mask_path, margin_mm, resample_cache=None, dataset_directory=None):
+    """Read the mask, then only the region of the image around it. Cases without a non-empty mask on the
+    grid of the image (after resampling through ``resample_cache``, if given) are read in full. With
+    ``dataset_directory``, a mask edited as revisions is read from its latest revision (see revisions)."""
+    revision = _read_revision(dataset_directory, mask_path, image_path)
+    if revision is None and (not mask_path or not os.path.exists(mask_path)):
+        return CaseData(image_path, mask_path, *read_image(image_path))
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(image_path)
+    reader.ReadImageInformation()
+    image_shape = tuple(reversed(reader.GetSize()))
+    image_geometry = {"spacing": reader.GetSpacing(), "origin": reader.GetOrigin(), "direction": reader.GetDirection()}
+    if revision is not None:
+        mask, mask_geometry = revision
+    elif resample_cache is not None:
+        mask, mask_geometry = resample_cache.read(mask_path, image_shape, image_geometry)
+    else:
+        mask, mask_geometry = read_image(mask_path)
+    if not np.issubdtype(mask.dtype, np.integer):
+        mask = np.rint(mask).astype(np.int16)
+    bounds = mask_bounding_box(mask)
+    if bounds is None or not same_grid(image_shape, image_geometry, mask.shape, mask_geometry):
+        return CaseData(image_path, mask_path, *read_image(image_path), mask, mask_geometry)
+    start, stop = padded_region(bounds, mask.shape, mask_geometry["spacing"], margin_mm)
+    image, geometry = read_region(image_path, start, stop)
+    region = tuple(slice(a, b) for a, b in zip(start, stop))
+    case = CaseData(image_path, mask_path, image, geometry, np.ascontiguousarray(mask[region]), geometry)
+    case.crop = Crop(start, mask.shape, mask_geometry, mask_path)
+    return case
+
+
+def region_start(geometry, full_geometry):
+    """Voxel (KJI) of the full grid at the origin of ``geometry``."""
+    direction = np.asarray(full_geometry["direction"], dtype=float).reshape(3, 3)
+    offset = np.asarray(geometry["origin"], dtype=float) - np.asarray(full_geometry["origin"], dtype=float)
+    ijk = np.linalg.solve(direction * np.asarray(full_geometry["spacing"], dtype=float), offset)
+    return tuple(int(index) for index in np.rint(ijk[::-1]))
+
+
+def uncrop(mask, geometry, crop, base_path=None, revisions=None):
+    """Paste a cropped (edited) mask of ``geometry`` into the full-size mask ``base_path`` (default:
+    the mask the case was cropped from, zeros if there is none); returns the full mask and geometry.
+    If the ``revisions`` folder (see revisions) holds revisions, the latest one is the full-size mask
+    instead. Voxels of ``mask`` outside of the full grid are dropped."""
+    # imported here: revisions imports this module
+    from .revisions import MaskRevisions, has_revisions
+
+    base_path = crop.mask_path if base_path is None else base_path
+    if revisions and has_revisions(revisions):
+        full, full_geometry = MaskRevisions(revisions).reconstruct()
+    elif base_path and os.path.exists(base_path):
+        full, full_geometry = read_image(base_path)
+    else:
+        full = None
+    if full is not None:
+        if not same_grid(full.shape, full_geometry, crop.full_shape, crop.full_geometry):
+            # a mask that was resampled to the grid of the image for the review
+            full, _ = resample_mask(full, full_geometry, crop.full_shape, crop.full_geometry)
+        full = full.astype(np.result_type(full, mask), copy=False)
+    else:
+        full = np.zeros(crop.full_shape, dtype=mask.dtype)
+    start = region_start(geometry, crop.full_geometry)
+    target = tuple(slice(max(0, a), min(n, a + m)) for a, m, n in zip(start, mask.shape, crop.full_shape))
+    source = tuple(slice(t.start - a, t.stop - a) for t, a in zip(target, start))
+    if all(t.stop > t.start for t in target):
+        full[target] = mask[source]
+    return full, crop.full_geometry
+
+
+def save_uncropped(save, mask, geometry, crop, base_path, *args, revisions=None):
+    """Run ``save(full mask, full geometry, *args)`` (e.g. mask_writer.save_mask or revisions.save_edit)
+    on ``mask`` pasted into ``base_path`` (or the latest of ``revisions``, see uncrop), in the background
+    with MaskWriter.run."""
+    full, full_geometry = uncrop(mask, geometry, crop, base_path, revisions)
+    return save(full, full_geometry, *args)
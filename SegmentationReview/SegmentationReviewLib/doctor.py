@@ -0,0 +1,289 @@
+"""Dataset doctor: header-only validation of all cases before the review.
+
+For every image/mask pair only the file headers are read (ImageFileReader.ReadImageInformation),
+on a process pool, and the problems that otherwise show up one case at a time are reported:
+
+- files that cannot be read, extensions that do not match the content (e.g. a gzip
+  stream named ``.nii`` or an uncompressed file named ``.nii.gz``);
+- corrupt gzip streams of ``.nii.gz`` files: a header that cannot be decompressed, or
+  a stream whose uncompressed size (from the gzip trailer) differs from the size the
+  NIfTI header announces, as for truncated files;
+- masks whose size, spacing, origin or direction differ from their image;
+- masks with a floating point or multi-component pixel type instead of integer labels.
+
+No voxels are decoded, so a large dataset is checked in minutes. The report is written to
+dataset_doctor.csv in the dataset directory, one row per case. From the command line::
+
+    python -m SegmentationReviewLib.doctor /path/to/dataset
+"""
+import argparse
+import gzip
+import logging
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from .common import is_valid_extension, joinpath
+
+logger = logging.getLogger('SegmentationReview')
+
+DOCTOR_FILENAME = "dataset_doctor.csv"
+FLAG_COLUMNS = ["unreadable_image", "unreadable_mask", "bad_extension", "corrupt_image_gzip", "corrupt_mask_gzip",
+                "size_mismatch", "spacing_mismatch", "origin_mismatch", "direction_mismatch", "non_integer_labels"]
+_FLOAT_PIXEL_IDS = {sitk.sitkFloat32, sitk.sitkFloat64, sitk.sitkComplexFloat32, sitk.sitkComplexFloat64,
+                    sitk.sitkVectorFloat32, sitk.sitkVectorFloat64}
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _nifti_data_size(header):
+    """Bytes of a NIfTI-1/2 file (header and voxels) according to its header, None if it is not NIfTI."""
+    for endian in "<>":
+        sizeof_hdr = struct.unpack_from(endian + "i", header)[0] if len(header) >= 4 else 0
+        if sizeof_hdr == 348 and len(header) >= 112:
+            dims = struct.unpack_from(endian + "8h", header, 40)
+            bitpix = struct.unpack_from(endian + "h", header, 72)[0]
+            vox_offset = int(struct.unpack_from(endian + "f", header, 108)[0])
+        elif sizeof_hdr == 540 and len(header) >= 176:
+            bitpix = struct.unpack_from(endian + "h", header, 14)[0]
+            dims = struct.unpack_from(endian + "8q", header, 16)
+            vox_offset = struct.unpack_from(endian + "q", header, 168)[0]
+        else:
+            continue
+        if not 1 <= dims[0] <= 7:
+            return None
+        return vox_offset + int(np.prod(dims[1:dims[0] + 1], dtype=np.int64)) * bitpix // 8
+    return None
+
+
+def check_file_encoding(path):
+    """``(bad_extension, corrupt_gzip, message)`` of a file, from its first and last bytes."""
+    with open(path, "rb") as file:
+        start = file.read(4)
+        compressed = start[:2] == _GZIP_MAGIC
+        if not is_valid_extension(path):
+            return True, False, "unsupported extension"
+        if path.endswith(".nrrd"):
+            return (False, False, "") if start == b"NRRD" else (True, False, "not a NRRD file")
+        if compressed != path.endswith(".gz"):
+            return True, False, "gzip compressed, named .nii" if compressed else "not gzip compressed, named .nii.gz"
+        if not compressed:
+            return False, False, ""
+        file.seek(-4, os.SEEK_END)
+        # the trailer of the (last) gzip member holds the uncompressed size modulo 2**32
+        trailer_size = struct.unpack("<I", file.read(4))[0]
+    try:
+        with gzip.open(path, "rb") as stream:
+            header = stream.read(540)
+    except (OSError, EOFError, zlib.error) as e:
+        return False, True, f"corrupt gzip stream: {e}"
+    expected = _nifti_data_size(header)
+    if expected is not None and expected % 2 ** 32 != trailer_size:
+        return False, True, f"gzip stream of {trailer_size} bytes, the header announces {expected} (truncated?)"
+    return False, False, ""
+
+
+def _file_header(path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader
+
+
+def _error_message(error):
+    # the messages of ITK exceptions start with the source file and line
+    lines = str(error).strip().splitlines()
+    return lines[-1].strip() if lines else type(error).__name__
+
+
+def _dims(reader):
+    return "x".join(str(size) for size in reader.GetSize())
+
+
+def check_case(image_path, mask_path):
+    """Problems of one case found from the file headers, as a dict (one row of the report)."""
+    row = {"img_path": image_path, "mask_path": mask_path, "img_dims": "", "mask_dims": "", "img_pixel_type": "",
+           "mask_pixel_type": "", **{column: False for column in FLAG_COLUMNS}}
+    issues = []
+    readers = {}
+    for role, path in (("img", image_path), ("mask", mask_path)):
+        if not path:
+            continue
+        name = "image" if role == "img" else "mask"
+        try:
+            bad_extension, corrupt_gzip, message = check_file_encoding(path)
+        except OSError as e:
+            row[f"unreadable_{name}"] = True
+            issues.append(f"{name}: {e}")
+            continue
+        row["bad_extension"] |= bad_extension
+        row[f"corrupt_{name}_gzip"] = corrupt_gzip
+        if message:
+            issues.append(f"{name}: {message}")
+        try:
+            reader = _file_header(path)
+        except Exception as e:
+            row[f"unreadable_{name}"] = True
+            issues.append(f"{name} header cannot be read: {_error_message(e)}")
+            continue
+        readers[role] = reader
+        row[f"{role}_dims"] = _dims(reader)
+        row[f"{role}_pixel_type"] = sitk.GetPixelIDValueAsString(reader.GetPixelID())
+
+    mask = readers.get("mask")
+    if mask is not None:
+        if mask.GetPixelID() in _FLOAT_PIXEL_IDS or mask.GetNumberOfComponents() > 1:
+            row["non_integer_labels"] = True
+            issues.append(f"mask voxels are {row['mask_pixel_type']}, not integer labels")
+        image = readers.get("img")
+        if image is not None:
+            if image.GetSize() != mask.GetSize():
+                row["size_mismatch"] = True
+                issues.append(f"mask size {row['mask_dims']}, image size {row['img_dims']}")
+            for key, getter in (("spacing", "GetSpacing"), ("origin", "GetOrigin"), ("direction", "GetDirection")):
+                image_value, mask_value = getattr(image, getter)(), getattr(mask, getter)()
+                if len(image_value) != len(mask_value) or not np.allclose(image_value, mask_value, atol=1e-3):
+                    row[f"{key}_mismatch"] = True
+                    issues.append(f"mask {key} differs from the image")
+    row["issues"] = "; ".join(issues)
+    return row
+
+
+def _check_chunk(cases):
+    # runs in the worker processes
+    return [check_case(image_path, mask_path) for image_path, mask_path in cases]
+
+
+def read_report(path):
+    return pd.read_csv(path, keep_default_na=False, na_values=[],
+                       dtype={"img_path": str, "mask_path": str, "issues": str})
+
+
+class DatasetDoctor:
+    """Checks the headers of the ``(image path, mask path)`` cases of a dataset in the background.
+
+    Works as qa.QualityPrePass: ``start`` returns immediately, ``progress`` and ``issues``
+    can be used while the cases are checked on a process pool, and the report is saved
+    when all of them are done.
+    """
+
+    def __init__(self, directory, cases, workers=None, mp_context=None, chunk_size=256):
+        self.path = joinpath(directory, DOCTOR_FILENAME)
+        self.cases = list(cases)
+        self.workers = workers
+        self.mp_context = mp_context
+        self.chunk_size = chunk_size
+        self._rows = {}  # image path -> report row
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._cancelled = False
+        self._executor = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="SegmentationReviewDoctor", daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def progress(self):
+        """(cases checked, total cases)"""
+        with self._lock:
+            return len(self._rows), len(self.cases)
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        self._cancelled = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        try:
+            if self.cases and not self._cancelled:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context)
+                futures = [self._executor.submit(_check_chunk, self.cases[i:i + self.chunk_size])
+                           for i in range(0, len(self.cases), self.chunk_size)]
+                for future in as_completed(futures):
+                    if self._cancelled:
+                        return
+                    with self._lock:
+                        for row in future.result():
+                            self._rows[row["img_path"]] = row
+                self._executor.shutdown()
+            self.save()
+            logger.info(self.summary())
+        except Exception as e:
+            if not self._cancelled:
+                logger.error(f'Dataset check failed: {e}')
+        finally:
+            self._done.set()
+
+    def report(self):
+        """The rows checked so far, in the order of the cases."""
+        with self._lock:
+            rows = [self._rows[image_path] for image_path, _ in self.cases if image_path in self._rows]
+        return pd.DataFrame(rows, columns=["img_path", "mask_path", "img_dims", "mask_dims", "img_pixel_type",
+                                           "mask_pixel_type"] + FLAG_COLUMNS + ["issues"])
+
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        self.report().to_csv(temporary_path, index=False)
+        os.replace(temporary_path, self.path)
+
+    def summary(self):
+        report = self.report()
+        counts = ", ".join(f"{int(report[column].sum())} {column.replace('_', ' ')}" for column in FLAG_COLUMNS)
+        return f'Dataset check: {int((report["issues"] != "").sum())} of {len(report)} cases with problems ({counts})'
+
+    def row(self, image_path):
+        with self._lock:
+            return self._rows.get(image_path)
+
+    def issues(self, image_path):
+        """Short descriptions of the problems found in a case."""
+        row = self.row(image_path)
+        return row["issues"].split("; ") if row is not None and row["issues"] else []
+
+    def unloadable_masks(self):
+        """Masks that cannot be loaded: unreadable headers and corrupt gzip streams."""
+        with self._lock:
+            return [row["mask_path"] for row in self._rows.values()
+                    if row["mask_path"] and (row["unreadable_mask"] or row["corrupt_mask_gzip"])]
+
+
+def main(argv=None):
+    from .session import ReviewSession
+
+    parser = argparse.ArgumentParser(description="Check the image and mask headers of a dataset")
+    parser.add_argument("directory", help="dataset directory")
+    parser.add_argument("--recursive", action="store_true", help="without mapping file, also look for cases in subfolders")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+    session = ReviewSession(recursive=args.recursive).open(args.directory)
+    try:
+        session.wait_for_scan()
+        cases = list(zip(session.nifti_files, session.segmentation_files))
+    finally:
+        session.close()
+    doctor = DatasetDoctor(args.directory, cases, args.workers).start()
+    doctor.wait()
+    report = doctor.report()
+    for row in report[report["issues"] != ""].itertuples():
+        print(f"{row.img_path}: {row.issues}")
+    print(doctor.summary())
+    print(doctor.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Export of the annotations of a dataset with per-case, per-reviewer and agreement summaries.
+
+The annotation files of all reviewers (annotations.csv, and annotations.<reviewer>.csv /
+.sqlite of sharded sessions, see shards) are read in chunks. For each reviewer only the
+last rating of a case is kept, so re-reviews do not count twice and memory grows with the
+number of cases, not with the number of rows. From the command line::
+
+    python -m SegmentationReviewLib.export /path/to/dataset
+
+writes to the dataset directory:
+
+- ``annotations_cases.csv``: one row per case with its full image path, the rating of every
+  reviewer, the majority rating and the fraction of reviewers who gave it, and in comparison
+  mode the metrics of each prediction (e.g. ``dice_<prediction>``, see compare);
+- ``annotations_reviewers.csv``: per reviewer, the number of cases, the distribution of the
+  ratings and the median / mean time per case (SQLite annotations only, which have a time
+  stamp; pauses longer than ``max_gap`` seconds are not counted);
+- ``annotations_agreement.csv``: Cohen's kappa of every pair of reviewers on their common
+  cases, and Fleiss' kappa over all cases with at least two ratings.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from .common import METRICS_COLUMN, joinpath, rating_to_str
+from .shards import annotation_files
+from .store import ANNOTATION_FILE_COLUMNS, read_annotation_csv, sqlite_annotation_columns
+
+logger = logging.getLogger('SegmentationReview')
+
+RATINGS = [1, 2, 3, 4, 5]
+RATING_VALUES = {rating_to_str(rating): rating for rating in RATINGS}
+KEY = ["reviewer", "file"]
+
+
+def annotation_sources(directory):
+    """``{reviewer: path}`` of the annotation files of a dataset; a reviewer's SQLite file wins over its CSV export."""
+    sources = {}
+    for reviewer, path in annotation_files(directory):
+        if reviewer not in sources or path.endswith(".sqlite"):
+            sources[reviewer] = path
+    return sources
+
+
+def iter_chunks(path, chunksize=100000):
+    """Rows of an annotation file in chunks with the annotations.csv columns, metrics and ``created_at`` (NaN for CSV)."""
+    if path.endswith(".sqlite"):
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            yield from pd.read_sql_query(
+                f"SELECT {sqlite_annotation_columns(connection)}, created_at FROM annotations ORDER BY id",
+                connection, chunksize=chunksize)
+        finally:
+            connection.close()
+    else:
+        for chunk in read_annotation_csv(path, chunksize=chunksize):
+            yield chunk.assign(created_at=np.nan)
+
+
+def read_latest(sources, chunksize=100000, max_gap=900):
+    """Last rating of every (reviewer, file) of ``{reviewer: path}`` annotation files.
+
+    Adds the columns ``reviewer``, ``rating`` (1-5, NaN if unknown) and ``seconds``: time
+    since the reviewer's previous rating, NaN after a pause longer than ``max_gap``.
+    """
+    latest = []
+    for reviewer, path in sources.items():
+        table, previous_time = None, np.nan
+        for chunk in iter_chunks(path, chunksize):
+            times = chunk["created_at"].to_numpy(dtype=float)
+            seconds = np.diff(times, prepend=previous_time)
+            seconds[(seconds < 0) | (seconds > max_gap)] = np.nan
+            if len(times):
+                previous_time = times[-1]
+            chunk = chunk.assign(reviewer=reviewer, seconds=seconds,
+                                 rating=chunk["annotation"].map(RATING_VALUES))
+            table = chunk if table is None else pd.concat([table, chunk], ignore_index=True)
+            # last write wins; dropping duplicates per chunk keeps the table at one row per case
+            table = table.drop_duplicates("file", keep="last")
+        if table is not None:
+            latest.append(table)
+            logger.info(f'{path}: {len(table)} rated cases')
+    if not latest:
+        return pd.DataFrame(columns=ANNOTATION_FILE_COLUMNS + ["created_at", "reviewer", "seconds", "rating"])
+    return pd.concat(latest, ignore_index=True)
+
+
+def resolve_paths(directory, files):
+    """Full image paths of the ``file`` names of annotations, through the mapping file if there is one."""
+    for mapping in ("mapping_unique.csv", "mapping.csv"):
+        mapping_path = joinpath(directory, mapping)
+        if os.path.exists(mapping_path):
+            img_paths = pd.read_csv(mapping_path, usecols=["img_path"])["img_path"].dropna().astype(str)
+            full_paths = img_paths.map(lambda path: path if os.path.isabs(path) else joinpath(directory, path))
+            by_name = pd.Series(full_paths.to_numpy(), index=img_paths.map(os.path.basename).to_numpy())
+            by_name = by_name[~by_name.index.duplicated()]
+            return files.map(by_name).fillna(files.map(lambda file: joinpath(directory, file)))
+    return files.map(lambda file: joinpath(directory, file))
+
+
+def case_summary(latest, directory):
+    """One row per case: image path, rating of each reviewer, majority rating and agreement."""
+    ratings = latest.pivot(index="file", columns="reviewer", values="rating")
+    ratings.columns = [f"rating_{reviewer}" if reviewer else "rating" for reviewer in ratings.columns]
+    values = ratings.to_numpy(dtype=float)
+    counts = np.stack([(values == rating).sum(axis=1) for rating in RATINGS], axis=1)
+    n_ratings = counts.sum(axis=1)
+    summary = pd.DataFrame({"img_path": resolve_paths(directory, ratings.index.to_series()).to_numpy(),
+                            "n_ratings": n_ratings}, index=ratings.index)
+    summary = summary.join(ratings).join(metrics_summary(latest))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        summary["majority_rating"] = np.where(n_ratings > 0, np.array(RATINGS)[counts.argmax(axis=1)], np.nan)
+        summary["agreement"] = counts.max(axis=1) / n_ratings
+    return summary.reset_index()
+
+
+def metrics_summary(latest):
+    """Comparison metrics of each case from its last rating with metrics, one column per metric and prediction."""
+    rated = latest[latest[METRICS_COLUMN].fillna("") != ""].drop_duplicates("file", keep="last")
+    flat = {}
+    for file, metrics in zip(rated["file"], rated[METRICS_COLUMN]):
+        flat[file] = {f"{key}_{name}": value for name, values in json.loads(metrics).items()
+                      for key, value in values.items() if not isinstance(value, dict)}
+    return pd.DataFrame.from_dict(flat, orient="index")
+
+
+def reviewer_summary(latest):
+    """Per reviewer: number of cases, count of each rating and time per case."""
+    counts = pd.crosstab(latest["reviewer"], latest["rating"]).reindex(columns=RATINGS, fill_value=0)
+    counts.columns = [f"n_rating_{rating}" for rating in RATINGS]
+    grouped = latest.groupby("reviewer")
+    summary = pd.DataFrame({"n_cases": grouped.size(),
+                            "median_seconds_per_case": grouped["seconds"].median(),
+                            "mean_seconds_per_case": grouped["seconds"].mean()})
+    return summary.join(counts).fillna({column: 0 for column in counts.columns}).reset_index()
+
+
+def cohen_kappa(a, b):
+    """Cohen's kappa of two aligned arrays of ratings 1-5."""
+    if not len(a):
+        return np.nan
+    k = len(RATINGS)
+    confusion = np.bincount((a - 1) * k + (b - 1), minlength=k * k).reshape(k, k) / len(a)
+    observed = np.trace(confusion)
+    expected = confusion.sum(axis=1) @ confusion.sum(axis=0)
+    return 1.0 if expected == 1 else (observed - expected) / (1 - expected)
+
+
+def fleiss_kappa(counts):
+    """Fleiss' kappa of a cases x ratings matrix of counts; cases may have different numbers of ratings (at least 2)."""
+    n = counts.sum(axis=1)
+    counts, n = counts[n >= 2], n[n >= 2]
+    if not len(n):
+        return np.nan
+    agreement = ((counts * (counts - 1)).sum(axis=1) / (n * (n - 1))).mean()
+    proportions = counts.sum(axis=0) / n.sum()
+    expected = (proportions ** 2).sum()
+    return 1.0 if expected == 1 else (agreement - expected) / (1 - expected)
+
+
+def agreement_summary(latest):
+    """Cohen's kappa of each pair of reviewers and Fleiss' kappa of all of them."""
+    rated = latest.dropna(subset=["rating"])
+    ratings = rated.pivot(index="file", columns="reviewer", values="rating")
+    rows = []
+    for first, second in itertools.combinations(ratings.columns, 2):
+        both = ratings[[first, second]].dropna().to_numpy(dtype=np.int64)
+        rows.append({"statistic": "cohen_kappa", "reviewers": f"{first or '-'} / {second or '-'}",
+                     "n_cases": len(both), "kappa": cohen_kappa(both[:, 0], both[:, 1])})
+    values = ratings.to_numpy(dtype=float)
+    counts = np.stack([(values == rating).sum(axis=1) for rating in RATINGS], axis=1) if len(values) else np.zeros((0, 5))
+    rows.append({"statistic": "fleiss_kappa", "reviewers": "all", "n_cases": int((counts.sum(axis=1) >= 2).sum()),
+                 "kappa": fleiss_kappa(counts)})
+    return pd.DataFrame(rows, columns=["statistic", "reviewers", "n_cases", "kappa"])
+
+
+def export_annotations(directory, output_directory=None, sources=None, chunksize=100000):
+    """Write the case, reviewer and agreement summaries of a dataset; returns the written paths."""
+    output_directory = output_directory or directory
+    latest = read_latest(sources if sources is not None else annotation_sources(directory), chunksize)
+    tables = {"annotations_cases.csv": case_summary(latest, directory),
+              "annotations_reviewers.csv": reviewer_summary(latest),
+              "annotations_agreement.csv": agreement_summary(latest)}
+    paths = []
+    for filename, table in tables.items():
+        path = joinpath(output_directory, filename)
+        table.to_csv(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        paths.append(path)
+    logger.info(f'Exported {len(latest)} ratings of {latest["reviewer"].nunique()} reviewers to {output_directory}')
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the annotations of all reviewers of a dataset")
+    parser.add_argument("directory", help="dataset directory")
+    parser.add_argument("--output", help="folder of the summaries (default: the dataset directory)")
+    parser.add_argument("--chunksize", type=int, default=100000, help="rows read at a time")
+    args = parser.parse_args(argv)
+    for path in export_annotations(args.directory, args.output, chunksize=args.chunksize):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
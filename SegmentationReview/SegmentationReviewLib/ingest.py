@@ -0,0 +1,159 @@
+"""Bulk ingestion of mapping.csv / mapping_unique.csv and of plain directory listings.
+
+Instead of probing every row with os.path.exists, each directory referenced by the
+mapping is listed once with os.scandir and all rows are classified against the set of
+existing paths in one pandas pass. This keeps opening a large mapping on a network
+filesystem down to one directory listing per folder.
+
+Both produce a case table with one row per candidate case, see ``classify_mapping``.
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from .common import CANNOT_LOAD_MASK, MASK_LOADED, NO_MASK, VALID_EXTENSIONS, joinpath
+
+logger = logging.getLogger('SegmentationReview')
+
+# further mask columns of a mapping file, e.g. mask_path_v2: predictions compared with mask_path (see compare)
+PREDICTION_PREFIX = "mask_path_"
+
+
+def list_existing(directories):
+    """Return the set of paths found in ``directories`` (given with a trailing separator),
+    listing each directory once."""
+    existing = set()
+    for directory in directories:
+        try:
+            with os.scandir(directory) as entries:
+                existing.update(directory + entry.name for entry in entries)
+        except OSError:
+            # missing or unreadable directory: none of its files exist
+            continue
+    return existing
+
+
+def _full_paths(paths, directory):
+    """Vectorized ``joinpath(directory, path)``; absolute paths are kept as they are."""
+    paths = paths.astype(str)
+    prefix = joinpath(directory, "")
+    is_absolute = paths.str.startswith(os.sep)
+    if os.name == "nt":
+        is_absolute |= paths.str.match(r'^[A-Za-z]:[\\/]')
+    return paths.where(is_absolute, prefix + paths)
+
+
+def _normalized(paths):
+    """``paths`` with os.sep as the only separator: mapping files use "/", which Windows accepts as well (os.altsep)."""
+    paths = paths.astype(str)
+    if os.altsep is None:
+        return paths
+    return paths.str.replace(os.altsep, os.sep, regex=False)
+
+
+def _parent_directories(full_paths):
+    """Directory part of each (normalized) path, up to and including the last separator."""
+    return pd.Series([path[:path.rfind(os.sep) + 1] for path in _normalized(full_paths).tolist()], index=full_paths.index,
+                     dtype=object)
+
+
+def classify_mapping(mappings, directory):
+    """Classify every row of a mapping table.
+
+    Returns a DataFrame with one row per mapping row and the columns
+    ``img_path``/``mask_path`` (full paths, ``""`` for no mask), ``mask_ref`` (full path of
+    the mask named by the mapping, even if it does not exist), ``img_valid`` (image exists
+    and has a valid extension), ``mask_status`` (0 - no mask, 1 - mask path, cannot load,
+    2 - mask found), ``subj_id`` and ``subj_index`` (0-based subject group number) plus
+    ``subj_case`` (position of the case within its subject).
+    """
+    return _add_subjects(_classify_paths(mappings, directory), mappings)
+
+
+def _classify_paths(mappings, directory):
+    """The path and status columns of ``classify_mapping``, which depend on each row alone."""
+    img = _full_paths(mappings["img_path"].fillna(""), directory)
+    mask_column = mappings["mask_path"]
+    has_mask = mask_column.notna() & (mask_column.astype(str) != "")
+    mask = _full_paths(mask_column.where(has_mask, ""), directory)
+
+    # one listing per referenced directory
+    parents = pd.concat([_parent_directories(img), _parent_directories(mask[has_mask])])
+    existing = list_existing(parents.unique())
+
+    # the listed paths are normalized, as their directories
+    img_valid = img.str.endswith(VALID_EXTENSIONS) & _normalized(img).isin(existing)
+    mask_valid_extension = has_mask & mask.str.endswith(VALID_EXTENSIONS)
+    mask_exists = mask_valid_extension & _normalized(mask).isin(existing)
+    mask_status = np.select([mask_exists, mask_valid_extension], [MASK_LOADED, CANNOT_LOAD_MASK], default=NO_MASK)
+
+    return pd.DataFrame({
+        "img_path": img,
+        "mask_path": mask.where(mask_exists, ""),
+        "mask_ref": mask,
+        "img_valid": img_valid,
+        "mask_status": mask_status,
+    }, index=mappings.index)
+
+
+def _add_subjects(cases, mappings):
+    """Add the subject columns of ``classify_mapping``, which number the subjects over all rows."""
+    if "subj_id" in mappings:
+        cases["subj_id"] = mappings["subj_id"].values
+        cases["subj_index"] = pd.factorize(mappings["subj_id"])[0]
+        cases["subj_case"] = cases.groupby("subj_index").cumcount()
+    return cases
+
+
+def mapping_predictions(mappings, directory):
+    """``{image path: {prediction name: mask path}}`` of the ``mask_path_<name>`` columns of a mapping table,
+    with full paths; empty cells are left out."""
+    columns = [column for column in mappings.columns if column.startswith(PREDICTION_PREFIX)]
+    if not columns:
+        return {}
+    img = _full_paths(mappings["img_path"].fillna(""), directory)
+    predictions = {}
+    for column in columns:
+        paths = mappings[column]
+        has_mask = paths.notna() & (paths.astype(str) != "")
+        full_paths = _full_paths(paths[has_mask], directory)
+        name = column[len(PREDICTION_PREFIX):]
+        for image_path, mask_path in zip(img[has_mask].tolist(), full_paths.tolist()):
+            predictions.setdefault(image_path, {})[name] = mask_path
+    return predictions
+
+
+def classify_listing(directory):
+    """Case table of a dataset directory without mapping file.
+
+    Every NIfTI file without "_mask" in its name is an image; its mask is the file with the
+    same name and the suffix _mask.nii.gz, looked up in the same single directory listing.
+    """
+    names = os.listdir(directory)
+    existing = set(names)
+    images = [name for name in names if ".nii" in name and "_mask" not in name]
+    masks = [name.split(".")[0] + "_mask.nii.gz" for name in images]
+    mask_exists = np.array([mask in existing for mask in masks], dtype=bool)
+    prefix = joinpath(directory, "")
+    mask_ref = pd.Series([prefix + mask for mask in masks], dtype=object)
+    return pd.DataFrame({
+        "img_path": pd.Series([prefix + image for image in images], dtype=object),
+        "mask_path": mask_ref.where(mask_exists, ""),
+        "mask_ref": mask_ref,
+        "img_valid": True,
+        "mask_status": np.where(mask_exists, MASK_LOADED, NO_MASK),
+    })
+
+
+def log_summary(cases, source):
+    """Log one summary line for a case table instead of one line per case."""
+    valid = cases[cases["img_valid"]]
+    status_counts = valid["mask_status"].value_counts()
+    logger.info(f'{source}: {len(cases)} rows, {len(valid)} images found, '
+                f'{len(cases) - len(valid)} skipped (missing or wrong extension); '
+                f'masks: {status_counts.get(MASK_LOADED, 0)} found, '
+                f'{status_counts.get(CANNOT_LOAD_MASK, 0)} cannot be loaded, '
+                f'{status_counts.get(NO_MASK, 0)} not provided')
+
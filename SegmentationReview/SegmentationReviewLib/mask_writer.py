@@ -0,0 +1,81 @@
+"""Saving of edited masks in the background.
+
+Compressing a large labelmap takes seconds, so the widget only snapshots the voxels and
+hands them to a MaskWriter; the write and the backup of the previous mask run on a
+worker thread while the reviewer moves on.
+"""
+import gzip
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import SimpleITK as sitk
+
+from .common import split_extension
+
+logger = logging.getLogger('SegmentationReview')
+
+
+def write_mask(mask, geometry, path, compression_level=1):
+    """Write a labelmap array (KJI order) with its geometry. Level 0 writes without compression.
+
+    The file is written under a temporary name and renamed, so ``path`` never holds a
+    partially written mask.
+    """
+    image = sitk.GetImageFromArray(mask)
+    image.SetSpacing([float(value) for value in geometry["spacing"]])
+    image.SetOrigin([float(value) for value in geometry["origin"]])
+    image.SetDirection([float(value) for value in geometry["direction"]])
+    stem, extension = split_extension(path)
+    temporary_path = stem + ".tmp" + extension
+    if extension == ".nii.gz":
+        # the NIfTI writer ignores the compression level: write plain NIfTI and gzip it here
+        uncompressed_path = stem + ".tmp.nii"
+        sitk.WriteImage(image, uncompressed_path, False)
+        try:
+            with open(uncompressed_path, "rb") as source, gzip.open(temporary_path, "wb", compresslevel=compression_level) as target:
+                shutil.copyfileobj(source, target, 1024 ** 2)
+        finally:
+            os.remove(uncompressed_path)
+    else:
+        sitk.WriteImage(image, temporary_path, compression_level > 0, compression_level)
+    os.replace(temporary_path, path)
+
+
+def save_mask(mask, geometry, path, previous_path=None, backup_path=None, compression_level=1):
+    """Write an edited mask, then move the mask it replaces to ``backup_path`` (instead of deleting it).
+
+    Returns ``path``. A failed move of the previous mask is logged, it does not fail the save.
+    """
+    write_mask(mask, geometry, path, compression_level)
+    logger.info(f'Saved edited mask to {path}')
+    if not previous_path or not os.path.exists(previous_path) or backup_path is None:
+        return path
+    try:
+        os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+        shutil.move(previous_path, backup_path)
+        logger.info(f'Moved previous mask to {backup_path}')
+    except OSError as e:
+        logger.error(f'Error moving previous mask to {backup_path}: {e}')
+    return path
+
+
+class MaskWriter:
+    """Runs save_mask on a worker thread; masks are written one after the other, in submission order."""
+
+    def __init__(self, compression_level=1):
+        self.compression_level = compression_level
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SegmentationReviewMaskWriter")
+
+    def submit(self, mask, geometry, path, previous_path=None, backup_path=None):
+        """Queue the save of ``mask``; the returned Future gives the result of save_mask."""
+        return self._executor.submit(save_mask, mask, geometry, path, previous_path, backup_path, self.compression_level)
+
+    def run(self, function, *args, **kwargs):
+        """Queue another kind of save, e.g. revisions.save_edit, behind the pending ones."""
+        return self._executor.submit(function, *args, **kwargs)
+
+    def shutdown(self):
+        """Finish the queued saves."""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,231 @@
+"""Background reading of the upcoming review cases.
+
+While the reviewer rates the current case, a small thread pool reads the next cases
+(image and mask) with SimpleITK into NumPy arrays, so that the widget only has to turn
+in-memory arrays into MRML nodes after "Save and next" is clicked.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+import SimpleITK as sitk
+
+logger = logging.getLogger('SegmentationReview')
+
+
+def read_image(path):
+    """Read a 3D image with SimpleITK. Returns the voxel array (KJI order) and its geometry."""
+    image = sitk.ReadImage(path)
+    if image.GetDimension() != 3:
+        raise ValueError(f"Only 3D images can be read ahead, {path} has {image.GetDimension()} dimensions")
+    geometry = {"spacing": image.GetSpacing(),
+                "origin": image.GetOrigin(),
+                "direction": image.GetDirection()}
+    return sitk.GetArrayFromImage(image), geometry
+
+
+def ijk_to_ras(geometry):
+    """4x4 IJK to RAS matrix of an image geometry read by SimpleITK (which uses LPS)."""
+    direction = np.asarray(geometry["direction"], dtype=float).reshape(3, 3)
+    matrix = np.eye(4)
+    matrix[:3, :3] = direction * np.asarray(geometry["spacing"], dtype=float)
+    matrix[:3, 3] = geometry["origin"]
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ matrix
+
+
+def geometry_from_ijk_to_ras(matrix):
+    """Image geometry for SimpleITK (LPS) of a 4x4 IJK to RAS matrix, the inverse of ijk_to_ras."""
+    matrix = np.diag([-1.0, -1.0, 1.0, 1.0]) @ np.asarray(matrix, dtype=float)
+    spacing = np.linalg.norm(matrix[:3, :3], axis=0)
+    return {"spacing": tuple(spacing),
+            "origin": tuple(matrix[:3, 3]),
+            "direction": tuple((matrix[:3, :3] / spacing).ravel())}
+
+
+class CaseData:
+    """Voxel arrays and geometry of one image/mask pair; ``downsampling`` is above 1 for previews
+    and ``crop`` is set for cases cropped to their mask (see crop)."""
+
+    def __init__(self, image_path, mask_path, image, image_geometry, mask=None, mask_geometry=None, downsampling=1):
+        self.image_path = image_path
+        self.mask_path = mask_path
+        self.image = image
+        self.image_geometry = image_geometry
+        self.mask = mask  # None if there is no mask or it could not be read
+        self.mask_geometry = mask_geometry
+        self.downsampling = downsampling
+        self.crop = None
+
+    @property
+    def nbytes(self):
+        """Bytes held in process memory; memory-mapped arrays (see VolumeCache) are backed by their file."""
+        return sum(array.nbytes for array in (self.image, self.mask)
+                   if array is not None and not isinstance(array, np.memmap))
+
+
+def _read_revision(dataset_directory, mask_path, image_path):
+    """The latest mask revision of a case stored in ``dataset_directory`` (see revisions), None if
+    there is none or it cannot be read."""
+    if dataset_directory is None:
+        return None
+    # imported here: revisions imports this module
+    from .revisions import read_latest_revision
+    try:
+        return read_latest_revision(dataset_directory, mask_path, image_path)
+    except (OSError, ValueError) as e:
+        logger.info(f'Cannot read the mask revisions of {image_path}, reading {mask_path} instead: {e}')
+        return None
+
+
+def read_case(image_path, mask_path, volume_cache=None, preview_cache=None, resample_cache=None, dataset_directory=None):
+    """Read an image and its (optional) mask, through ``volume_cache`` if given. A mask that
+    cannot be read is left as None. The missing previews of the case are made if
+    ``preview_cache`` is given, and a mask that is not on the grid of the image is resampled
+    to it if ``resample_cache`` (a resample.ResampleCache) is given. With ``dataset_directory``,
+    a mask edited as revisions is read from its latest revision (see revisions)."""
+    read = volume_cache.read if volume_cache is not None else read_image
+    image, image_geometry = read(image_path)
+    mask, mask_geometry = None, None
+    revision = _read_revision(dataset_directory, mask_path, image_path)
+    if revision is not None:
+        mask, mask_geometry = revision
+    elif mask_path and os.path.exists(mask_path):
+        try:
+            if resample_cache is not None:
+                mask, mask_geometry = resample_cache.read(mask_path, image.shape, image_geometry, read)
+            else:
+                mask, mask_geometry = read(mask_path)
+            if not np.issubdtype(mask.dtype, np.integer):
+                mask = np.rint(mask).astype(np.int16)
+        except Exception as e:
+            logger.info(f'Cannot read mask {mask_path} ahead of time: {e}')
+            mask, mask_geometry = None, None
+    case = CaseData(image_path, mask_path, image, image_geometry, mask, mask_geometry)
+    if preview_cache is not None:
+        try:
+            # previews are keyed by file, so an edited mask has none
+            preview_cache.store_case(case if revision is None else CaseData(image_path, mask_path, image, image_geometry))
+        except OSError as e:
+            logger.info(f'Cannot store the preview of {image_path}: {e}')
+    return case
+
+
+class CasePrefetcher:
+    """Reads upcoming cases on a thread pool, within a bounded memory budget.
+
+    Cases are identified by their index in the case list. ``schedule`` is called with the
+    cases that will be needed next (nearest first); ``take`` hands over a case that was
+    read ahead, or returns None so the caller falls back to reading from disk.
+    ``cancel`` drops everything, e.g. when the dataset directory changes.
+    Cases are read through ``volume_cache`` (a VolumeCache) when it is set, and their
+    previews are stored in ``preview_cache`` (a PreviewCache). Masks are resampled to the
+    grid of their image through ``resample_cache`` (a ResampleCache) when it is set, and
+    masks edited as revisions are read from the revisions in ``dataset_directory``.
+    With ``crop_margin_mm`` above 0 only the region around the mask is read (see
+    crop.read_cropped_case), without volume cache or previews.
+    """
+
+    def __init__(self, depth=2, max_bytes=2 * 1024 ** 3, workers=2, volume_cache=None, preview_cache=None,
+                 resample_cache=None, dataset_directory=None, crop_margin_mm=0):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.volume_cache = volume_cache
+        self.preview_cache = preview_cache
+        self.resample_cache = resample_cache
+        self.dataset_directory = dataset_directory
+        self.crop_margin_mm = crop_margin_mm
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="SegmentationReviewPrefetch")
+        self._lock = threading.RLock()
+        self._futures = {}  # index -> Future
+        self._resident = {}  # index -> bytes held by finished reads
+        self._case_bytes = 0  # size of the last case read, used to estimate the next ones
+        self._generation = 0
+
+    @property
+    def resident_bytes(self):
+        with self._lock:
+            return sum(self._resident.values())
+
+    def schedule(self, cases):
+        """Read ahead the given ``(index, image_path, mask_path)`` cases, nearest first."""
+        wanted = list(islice(cases, self.depth))
+        wanted_indexes = {index for index, _, _ in wanted}
+        with self._lock:
+            for index in list(self._futures):
+                if index not in wanted_indexes:
+                    self._drop(index)
+            for index, image_path, mask_path in wanted:
+                if index in self._futures:
+                    continue
+                if sum(self._resident.values()) + self._case_bytes * (1 + len(self._futures) - len(self._resident)) > self.max_bytes:
+                    break
+                future = self._submit(image_path, mask_path)
+                self._futures[index] = future
+                # runs right here, under the lock, if the read has already finished
+                future.add_done_callback(self._make_done_callback(index, self._generation))
+
+    def scheduled(self, index):
+        with self._lock:
+            return index in self._futures
+
+    def ready(self, index):
+        """True once the read of case ``index`` has finished (or failed), so ``take`` does not wait."""
+        with self._lock:
+            future = self._futures.get(index)
+        return future is not None and future.done()
+
+    def take(self, index):
+        """Return the prefetched CaseData for ``index`` (waiting for a running read), or None."""
+        with self._lock:
+            future = self._futures.pop(index, None)
+            self._resident.pop(index, None)
+        if future is None or future.cancelled():
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.info(f'Prefetch of case {index} failed, reading it from disk: {e}')
+            return None
+
+    def cancel(self):
+        """Drop all prefetched and pending cases."""
+        with self._lock:
+            self._generation += 1
+            for index in list(self._futures):
+                self._drop(index)
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, image_path, mask_path):
+        if self.crop_margin_mm:
+            # imported here: crop imports this module
+            from .crop import read_cropped_case
+            return self._executor.submit(read_cropped_case, image_path, mask_path, self.crop_margin_mm,
+                                         self.resample_cache, self.dataset_directory)
+        return self._executor.submit(read_case, image_path, mask_path, self.volume_cache, self.preview_cache,
+                                     self.resample_cache, self.dataset_directory)
+
+    def _drop(self, index):
+        future = self._futures.pop(index)
+        future.cancel()
+        self._resident.pop(index, None)
+
+    def _make_done_callback(self, index, generation):
+        def done(future):
+            if future.cancelled() or future.exception() is not None:
+                return
+            nbytes = future.result().nbytes
+            with self._lock:
+                self._case_bytes = nbytes
+                if generation != self._generation or self._futures.get(index) is not future:
+                    return
+                self._resident[index] = nbytes
+                # over budget: forget the case that is needed last
+                while sum(self._resident.values()) > self.max_bytes and self._resident:
+                    self._drop(max(self._resident))
+        return done
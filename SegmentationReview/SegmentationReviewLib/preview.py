@@ -0,0 +1,60 @@
+"""Downsampled previews of the cases, cached next to the dataset.
+
+A preview keeps every ``factor``-th voxel along each axis, i.e. 1/64 of the data for the
+default factor of 4, which is enough to triage bad images or invisible structures. It is
+shown while the full resolution case is read in the background. Previews are made
+whenever a case is read at full resolution (by the prefetcher or on demand) and stored
+in the PREVIEW_DIRECTORY folder of the dataset, so they are shared by all reviewers.
+"""
+import os
+
+import numpy as np
+
+from .common import joinpath
+from .prefetch import CaseData
+from .volume_cache import VolumeCache
+
+PREVIEW_DIRECTORY = ".segmentation_review_previews"
+
+
+def downsample(array, geometry, factor):
+    """Every ``factor``-th voxel of ``array`` and the matching geometry.
+
+    Voxels are picked rather than averaged, so labelmaps keep their label values and the
+    first voxel, hence the origin, stays the same.
+    """
+    preview = np.ascontiguousarray(array[::factor, ::factor, ::factor])
+    preview_geometry = {"spacing": [spacing * factor for spacing in geometry["spacing"]],
+                        "origin": list(geometry["origin"]),
+                        "direction": list(geometry["direction"])}
+    return preview, preview_geometry
+
+
+class PreviewCache(VolumeCache):
+    """Previews of the images and masks of a dataset directory, downsampled by ``factor``."""
+
+    def __init__(self, dataset_directory, factor=4, max_bytes=4 * 1024 ** 3):
+        super().__init__(joinpath(dataset_directory, PREVIEW_DIRECTORY), max_bytes)
+        self.factor = factor
+
+    def _key(self, path):
+        return f"{super()._key(path)}-x{self.factor}"
+
+    def read_case(self, image_path, mask_path):
+        """CaseData of the previews of a case, or None if the image or its mask has no preview yet."""
+        image = self.get(image_path)
+        if image is None:
+            return None
+        mask = (None, None)
+        if mask_path and os.path.exists(mask_path):
+            mask = self.get(mask_path)
+            if mask is None:
+                return None
+        return CaseData(image_path, mask_path, *image, *mask, downsampling=self.factor)
+
+    def store_case(self, case):
+        """Make the missing previews of a case read at full resolution."""
+        for path, array, geometry in [(case.image_path, case.image, case.image_geometry),
+                                      (case.mask_path, case.mask, case.mask_geometry)]:
+            if array is not None and self.get(path) is None:
+                self.put(path, *downsample(array, geometry, self.factor))
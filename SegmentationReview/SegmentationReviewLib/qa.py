@@ -0,0 +1,238 @@
+"""Batch QA pre-pass: per-case mask metrics computed on a process pool before the review.
+
+For every case the mask is read once and its labels, voxel counts, volumes, centroids
+and bounding boxes are computed (see centroids.label_statistics), together with flags
+for masks that cannot be read, empty masks and masks whose geometry does not match the
+image (read from the image header only). The results are written to qa_metrics.csv in
+the dataset directory; rows of unchanged files are reused when the pre-pass runs again.
+"""
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from .centroids import LabelStatistics, label_statistics
+from .common import joinpath
+from .prefetch import read_image
+
+logger = logging.getLogger('SegmentationReview')
+
+QA_METRICS_FILENAME = "qa_metrics.csv"
+# columns holding lists, stored as JSON
+LIST_COLUMNS = ["labels", "counts", "volumes_mm3", "centroids_ijk", "centroids_ras", "bbox_min_ijk", "bbox_max_ijk",
+                "mask_spacing", "mask_origin", "mask_direction"]
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    except (OSError, ValueError):
+        return -1, -1
+
+
+def _image_information(path):
+    """Size (IJK) and geometry from the image header, without reading the voxels."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader.GetSize(), {"spacing": reader.GetSpacing(), "origin": reader.GetOrigin(), "direction": reader.GetDirection()}
+
+
+def case_metrics(image_path, mask_path):
+    """QA metrics of one case as a dict (one row of the metrics table)."""
+    image_size, image_mtime_ns = _signature(image_path)
+    mask_size, mask_mtime_ns = _signature(mask_path) if mask_path else (-1, -1)
+    row = {"img_path": image_path, "mask_path": mask_path, "img_size": image_size, "img_mtime_ns": image_mtime_ns,
+           "mask_size": mask_size, "mask_mtime_ns": mask_mtime_ns, "image_load_failed": False,
+           "mask_load_failed": False, "empty_mask": False, "geometry_match": True, "n_labels": 0, "error": ""}
+    try:
+        image_shape, image_geometry = _image_information(image_path)
+    except Exception as e:
+        row.update(image_load_failed=True, error=f"image: {e}")
+        image_shape, image_geometry = None, None
+    if not mask_path:
+        return row
+    try:
+        mask, mask_geometry = read_image(mask_path)
+    except Exception as e:
+        row.update(mask_load_failed=True, error=f"mask: {e}")
+        return row
+
+    statistics = label_statistics(mask, mask_geometry)
+    voxel_volume = float(np.prod(mask_geometry["spacing"]))
+    row.update(n_labels=len(statistics), empty_mask=len(statistics) == 0,
+               labels=statistics.labels.tolist(), counts=statistics.counts.tolist(),
+               volumes_mm3=(statistics.counts * voxel_volume).tolist(),
+               centroids_ijk=statistics.centroids_ijk.tolist(), centroids_ras=statistics.centroids_ras.tolist(),
+               bbox_min_ijk=statistics.bbox_min_ijk.tolist(), bbox_max_ijk=statistics.bbox_max_ijk.tolist(),
+               mask_spacing=list(mask_geometry["spacing"]), mask_origin=list(mask_geometry["origin"]),
+               mask_direction=list(mask_geometry["direction"]))
+    if image_geometry is not None:
+        row["geometry_match"] = bool(tuple(image_shape) == tuple(reversed(mask.shape)) and all(
+            np.allclose(image_geometry[key], mask_geometry[key], atol=1e-3) for key in ("spacing", "origin", "direction")))
+    return row
+
+
+def _chunk_metrics(cases):
+    # runs in the worker processes
+    return [case_metrics(image_path, mask_path) for image_path, mask_path in cases]
+
+
+def read_metrics(path):
+    """The metrics table written by QualityPrePass, with the list columns decoded."""
+    table = pd.read_csv(path, keep_default_na=False, na_values=[], dtype={"img_path": str, "mask_path": str, "error": str})
+    for column in LIST_COLUMNS:
+        if column in table:
+            table[column] = [json.loads(value) if value else None for value in table[column]]
+    return table
+
+
+class QualityPrePass:
+    """Computes the metrics table of the ``(image path, mask path)`` cases of a dataset in the background.
+
+    ``start`` returns immediately: a thread reuses the rows of unchanged files from the
+    previous qa_metrics.csv and runs case_metrics for the others on a process pool, in
+    chunks of ``chunk_size`` cases. ``progress`` and ``row`` can be used meanwhile;
+    the table is saved when all cases are done. ``mp_context`` is passed to the process
+    pool (inside Slicer, to run the workers with PythonSlicer).
+    """
+
+    def __init__(self, directory, cases, workers=None, mp_context=None, chunk_size=16):
+        self.path = joinpath(directory, QA_METRICS_FILENAME)
+        self.cases = list(cases)
+        self.workers = workers
+        self.mp_context = mp_context
+        self.chunk_size = chunk_size
+        self._rows = {}  # image path -> metrics row
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._cancelled = False
+        self._executor = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="SegmentationReviewQA", daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def progress(self):
+        """(cases with metrics, total cases)"""
+        with self._lock:
+            return len(self._rows), len(self.cases)
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        self._cancelled = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _reusable_rows(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            previous = read_metrics(self.path)
+        except (OSError, ValueError) as e:
+            logger.info(f'Ignoring {self.path}: {e}')
+            return {}
+        rows = {}
+        for row in previous.to_dict("records"):
+            if ((row["img_size"], row["img_mtime_ns"]) == _signature(row["img_path"])
+                    and (not row["mask_path"] or (row["mask_size"], row["mask_mtime_ns"]) == _signature(row["mask_path"]))):
+                rows[(row["img_path"], row["mask_path"])] = row
+        return rows
+
+    def _run(self):
+        try:
+            reusable = self._reusable_rows()
+            todo = []
+            for image_path, mask_path in self.cases:
+                row = reusable.get((image_path, mask_path))
+                if row is not None:
+                    self._rows[image_path] = row
+                else:
+                    todo.append((image_path, mask_path))
+            logger.info(f'QA pre-pass: {len(self.cases) - len(todo)} cases unchanged, computing {len(todo)}')
+            if todo and not self._cancelled:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context)
+                futures = [self._executor.submit(_chunk_metrics, todo[i:i + self.chunk_size])
+                           for i in range(0, len(todo), self.chunk_size)]
+                for future in as_completed(futures):
+                    if self._cancelled:
+                        return
+                    with self._lock:
+                        for row in future.result():
+                            self._rows[row["img_path"]] = row
+                self._executor.shutdown()
+            self.save()
+            logger.info(self.summary())
+        except Exception as e:
+            if not self._cancelled:
+                logger.error(f'QA pre-pass failed: {e}')
+        finally:
+            self._done.set()
+
+    def metrics(self):
+        """The metrics computed so far, as read_metrics returns them."""
+        with self._lock:
+            return pd.DataFrame(list(self._rows.values()))
+
+    def table(self):
+        table = self.metrics()
+        for column in LIST_COLUMNS:
+            if column in table:
+                table[column] = [json.dumps(value) if isinstance(value, list) else "" for value in table[column]]
+        return table
+
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        self.table().to_csv(temporary_path, index=False)
+        os.replace(temporary_path, self.path)
+
+    def summary(self):
+        table = pd.DataFrame(list(self._rows.values()), columns=["image_load_failed", "mask_load_failed", "empty_mask", "geometry_match"])
+        return (f'QA pre-pass: {len(table)} cases, {int(table["image_load_failed"].sum())} images and '
+                f'{int(table["mask_load_failed"].sum())} masks cannot be loaded, {int(table["empty_mask"].sum())} empty masks, '
+                f'{int((~table["geometry_match"].astype(bool)).sum())} masks not matching the image geometry')
+
+    def row(self, image_path):
+        """Metrics of a case, or None if not computed (yet)."""
+        with self._lock:
+            return self._rows.get(image_path)
+
+    def issues(self, image_path):
+        """Short descriptions of the problems found in a case."""
+        row = self.row(image_path)
+        if row is None:
+            return []
+        flags = [("image_load_failed", "image cannot be loaded"), ("mask_load_failed", "mask cannot be loaded"),
+                 ("empty_mask", "empty mask")]
+        issues = [text for column, text in flags if row[column]]
+        if not row["geometry_match"]:
+            issues.append("mask does not match the image geometry")
+        return issues
+
+    def statistics(self, image_path, mask_path):
+        """LabelStatistics of the mask of a case, or None if unknown or the mask changed since."""
+        row = self.row(image_path)
+        if (row is None or row["mask_path"] != mask_path or row["mask_load_failed"] or not row["mask_path"]
+                or (row["mask_size"], row["mask_mtime_ns"]) != _signature(mask_path)):
+            return None
+        geometry = {"spacing": row["mask_spacing"], "origin": row["mask_origin"], "direction": row["mask_direction"]}
+        n_labels = row["n_labels"]
+        as_array = lambda values, dtype: np.asarray(values, dtype=dtype).reshape(n_labels, -1) if n_labels else np.empty((0, 3), dtype)
+        return LabelStatistics(np.asarray(row["labels"] or []), np.asarray(row["counts"] or [], dtype=np.int64),
+                               as_array(row["centroids_ijk"], float), as_array(row["bbox_min_ijk"], np.int64),
+                               as_array(row["bbox_max_ijk"], np.int64), geometry)
@@ -0,0 +1,190 @@
+"""Masks resampled to the grid of their image, cached next to the dataset.
+
+Model outputs are often at another resolution than the image, and Slicer resamples such
+masks every time they are loaded or exported. Here a mask whose size, spacing, origin or
+direction differs from its image is resampled once, with nearest neighbour interpolation
+so labels stay labels, and stored in the RESAMPLE_DIRECTORY folder of the dataset. Entries
+are keyed by the content hash of the mask file and the target grid, so a renamed or copied
+mask is not resampled again, and an edited mask is. ``ResamplePass`` fills the cache for
+all cases of a dataset on a process pool in the background.
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import SimpleITK as sitk
+
+from .centroids import file_digest
+from .common import joinpath
+from .prefetch import read_image
+from .volume_cache import VolumeCache
+
+logger = logging.getLogger('SegmentationReview')
+
+RESAMPLE_DIRECTORY = ".segmentation_review_resampled"
+
+
+def same_grid(shape, geometry, other_shape, other_geometry, tolerance=1e-4):
+    """True if two arrays (KJI shapes) with their geometries cover the same voxels."""
+    return tuple(shape) == tuple(other_shape) and all(
+        np.allclose(geometry[key], other_geometry[key], atol=tolerance) for key in ("spacing", "origin", "direction"))
+
+
+def _image(array, geometry):
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing([float(value) for value in geometry["spacing"]])
+    image.SetOrigin([float(value) for value in geometry["origin"]])
+    image.SetDirection([float(value) for value in geometry["direction"]])
+    return image
+
+
+def resample_mask(mask, mask_geometry, shape, geometry):
+    """``mask`` resampled with nearest neighbour interpolation to the grid ``shape`` (KJI) / ``geometry``;
+    voxels outside of the mask are 0."""
+    resampled = sitk.Resample(_image(mask, mask_geometry), [int(size) for size in reversed(shape)], sitk.Transform(),
+                              sitk.sitkNearestNeighbor, [float(value) for value in geometry["origin"]],
+                              [float(value) for value in geometry["spacing"]],
+                              [float(value) for value in geometry["direction"]], 0)
+    return sitk.GetArrayFromImage(resampled), {key: tuple(geometry[key]) for key in ("spacing", "origin", "direction")}
+
+
+def _header_grid(path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return tuple(reversed(reader.GetSize())), {"spacing": reader.GetSpacing(), "origin": reader.GetOrigin(),
+                                               "direction": reader.GetDirection()}
+
+
+class ResampleCache(VolumeCache):
+    """Masks of a dataset directory resampled to the grid of their image."""
+
+    def __init__(self, dataset_directory, max_bytes=16 * 1024 ** 3):
+        super().__init__(joinpath(dataset_directory, RESAMPLE_DIRECTORY), max_bytes)
+        self._lock = threading.Lock()
+        self._digests = {}  # (path, size, mtime) -> content hash, so unchanged files are hashed once
+
+    def _digest(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            digest = file_digest(path)
+            with self._lock:
+                self._digests[key] = digest
+        return digest
+
+    def _grid_key(self, mask_path, shape, geometry):
+        # + 0.0 turns -0.0 into 0.0: headers and full reads of the same file differ in the sign of zeros
+        grid = [tuple(int(size) for size in shape)] + [tuple(float(value) + 0.0 for value in np.round(geometry[key], 4))
+                                                       for key in ("spacing", "origin", "direction")]
+        source = f"{self._digest(mask_path)}\0{grid}"
+        return hashlib.blake2b(source.encode("utf-8"), digest_size=16).hexdigest()
+
+    def read(self, mask_path, shape, geometry, read=read_image):
+        """``(array, geometry)`` of a mask on the grid ``shape`` / ``geometry`` of its image.
+
+        A mask already on that grid is read with ``read`` (e.g. VolumeCache.read); others come
+        from the cache, or are read, resampled and cached.
+        """
+        if same_grid(*_header_grid(mask_path), shape, geometry):
+            return read(mask_path)
+        key = self._grid_key(mask_path, shape, geometry)
+        cached = self._get(key)
+        if cached is not None:
+            return cached
+        mask, mask_geometry = read_image(mask_path)
+        if not np.issubdtype(mask.dtype, np.integer):
+            mask = np.rint(mask).astype(np.int16)
+        resampled = resample_mask(mask, mask_geometry, shape, geometry)
+        try:
+            return self._put(key, mask_path, *resampled)
+        except OSError as e:
+            logger.info(f'Cannot cache the resampled {mask_path} in {self.directory}: {e}')
+            return resampled
+
+    def prepare(self, image_path, mask_path):
+        """Resample the mask of a case ahead of time if it is not on the grid of its image; returns True if it was not."""
+        if not mask_path or not os.path.exists(mask_path):
+            return False
+        shape, geometry = _header_grid(image_path)
+        if same_grid(*_header_grid(mask_path), shape, geometry):
+            return False
+        key = self._grid_key(mask_path, shape, geometry)
+        if self._get(key) is None:
+            self.read(mask_path, shape, geometry)
+        return True
+
+
+def _prepare_chunk(dataset_directory, max_bytes, cases):
+    # runs in the worker processes
+    cache = ResampleCache(dataset_directory, max_bytes)
+    n_resampled = 0
+    for image_path, mask_path in cases:
+        try:
+            n_resampled += cache.prepare(image_path, mask_path)
+        except Exception as e:
+            logger.info(f'Cannot resample {mask_path}: {e}')
+    return len(cases), n_resampled
+
+
+class ResamplePass:
+    """Fills a ResampleCache for the ``(image path, mask path)`` cases of a dataset on a process pool.
+
+    Only headers are read for masks that are on the grid of their image. ``start`` returns
+    immediately; ``mp_context`` is passed to the process pool as in qa.QualityPrePass.
+    """
+
+    def __init__(self, cache, cases, workers=None, mp_context=None, chunk_size=8):
+        self.cache = cache
+        self.cases = list(cases)
+        self.workers = workers
+        self.mp_context = mp_context
+        self.chunk_size = chunk_size
+        self.n_done = 0
+        self.n_resampled = 0
+        self._done = threading.Event()
+        self._cancelled = False
+        self._executor = None
+
+    def start(self):
+        threading.Thread(target=self._run, name="SegmentationReviewResample", daemon=True).start()
+        return self
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        self._cancelled = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        dataset_directory = os.path.dirname(self.cache.directory)
+        try:
+            if self.cases and not self._cancelled:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context)
+                futures = [self._executor.submit(_prepare_chunk, dataset_directory, self.cache.max_bytes,
+                                                 self.cases[i:i + self.chunk_size])
+                           for i in range(0, len(self.cases), self.chunk_size)]
+                for future in as_completed(futures):
+                    if self._cancelled:
+                        return
+                    n_done, n_resampled = future.result()
+                    self.n_done += n_done
+                    self.n_resampled += n_resampled
+                self._executor.shutdown()
+            logger.info(f'Resampled {self.n_resampled} of {len(self.cases)} masks to the grid of their image')
+        except Exception as e:
+            if not self._cancelled:
+                logger.error(f'Resampling of the masks failed: {e}')
+        finally:
+            self._done.set()
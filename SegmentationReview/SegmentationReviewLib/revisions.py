@@ -0,0 +1,236 @@
+"""Edited masks stored as sparse revisions of the original mask.
+
+Instead of a full ``*_edited_mask_<timestamp>.nii.gz`` per edit, each revision of a
+case is stored as the bounding box of the voxels that differ from the original mask,
+with the edited values inside it (compressed .npz). The original mask is left in place,
+and a case with revisions is loaded from its latest revision (see read_latest_revision).
+Any revision is rebuilt from the original and its own delta, and ``compact`` writes the
+latest revision as a regular mask file. From the command line::
+
+    python -m SegmentationReviewLib.revisions /path/to/dataset
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+from .common import joinpath, split_extension
+from .crop import mask_bounding_box
+from .mask_writer import save_mask, write_mask
+from .prefetch import read_image
+
+logger = logging.getLogger('SegmentationReview')
+
+REVISIONS_DIRECTORY = "mask_revisions"
+MANIFEST_FILENAME = "revisions.json"
+
+
+class MaskRevisions:
+    """Revisions of the mask of one case, kept in ``directory`` (see revisions_directory).
+
+    ``base_path`` is the original mask, or "" if the case had none (revisions are then
+    stored against an empty mask); ``image_path`` is the image of the case, which names
+    the compacted mask.
+    """
+
+    def __init__(self, directory, base_path="", image_path=""):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+        # the original mask is referenced relative to the revisions, so the dataset can be moved
+        self.manifest = {"base": self._relative(base_path), "image": self._relative(image_path), "shape": None,
+                         "geometry": None, "revisions": []}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+            if base_path and os.path.normcase(os.path.abspath(base_path)) != os.path.normcase(self.base_path):
+                raise ValueError(f'{directory} holds revisions of {self.base_path}, not of {base_path}')
+
+    def _relative(self, path):
+        if not path:
+            return ""
+        try:
+            return os.path.relpath(path, self.directory)
+        except ValueError:
+            # another drive (Windows)
+            return os.path.abspath(path)
+
+    def _absolute(self, path):
+        if not path:
+            return ""
+        return os.path.normpath(os.path.join(self.directory, path))
+
+    @property
+    def base_path(self):
+        return self._absolute(self.manifest["base"])
+
+    @property
+    def image_path(self):
+        """The image of the case, "" for revisions stored before it was recorded."""
+        return self._absolute(self.manifest.get("image", ""))
+
+    def __len__(self):
+        return len(self.manifest["revisions"])
+
+    def _base(self, shape=None, dtype=np.uint8):
+        """The original mask and its geometry (an empty mask of ``shape`` if there is none)."""
+        if self.manifest["base"]:
+            return read_image(self.base_path)
+        shape = self.manifest["shape"] or shape
+        return np.zeros(shape, dtype=dtype), self.manifest["geometry"]
+
+    def add(self, mask, geometry):
+        """Store ``mask`` as a new revision and return its number (1 for the first one).
+
+        Raises ValueError if the mask does not have the size and position of the original,
+        in which case it has to be saved as a full mask instead.
+        """
+        base, base_geometry = self._base(mask.shape, mask.dtype)
+        if base.shape != mask.shape or (base_geometry is not None and not all(
+                np.allclose(base_geometry[key], geometry[key], atol=1e-4) for key in ("spacing", "origin", "direction"))):
+            raise ValueError("the edited mask does not have the geometry of the original mask")
+        # the voxels that differ from the original, None if there are none
+        bounds = mask_bounding_box(mask != base)
+        if bounds is None:
+            start, values = (0, 0, 0), mask[:0, :0, :0]
+        else:
+            start, stop = bounds
+            values = mask[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+
+        os.makedirs(self.directory, exist_ok=True)
+        number = len(self) + 1
+        filename = f"revision_{number:04d}.npz"
+        with open(os.path.join(self.directory, filename), "wb") as f:
+            np.savez_compressed(f, start=np.asarray(start), values=values)
+        self.manifest["shape"] = list(mask.shape)
+        self.manifest["geometry"] = {key: list(map(float, value)) for key, value in geometry.items()}
+        self.manifest["revisions"].append({"file": filename, "created_at": time.time(), "box_voxels": int(values.size)})
+        self._write_manifest()
+        return number
+
+    def _write_manifest(self):
+        temporary_path = self.manifest_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(temporary_path, self.manifest_path)
+
+    def reconstruct(self, revision=None):
+        """The mask array and geometry of a revision (by default the latest one)."""
+        if not len(self):
+            raise ValueError(f'No revisions in {self.directory}')
+        revision = revision or len(self)
+        with np.load(os.path.join(self.directory, self.manifest["revisions"][revision - 1]["file"])) as delta:
+            start, values = delta["start"], delta["values"]
+        base, _ = self._base(dtype=values.dtype)
+        mask = base.astype(np.result_type(base, values))
+        k, j, i = start
+        mask[k:k + values.shape[0], j:j + values.shape[1], i:i + values.shape[2]] = values
+        return mask, self.manifest["geometry"]
+
+    def compact(self, path, compression_level=1, remove_revisions=True):
+        """Write the latest revision to ``path`` as a regular mask file, and drop the revisions."""
+        mask, geometry = self.reconstruct()
+        write_mask(mask, geometry, path, compression_level)
+        if remove_revisions:
+            shutil.rmtree(self.directory)
+        return path
+
+
+def revisions_directory(dataset_directory, mask_path, image_path=""):
+    """Folder of the revisions of a mask of the dataset: ``mask_revisions/<mask path>/``, with the
+    path of the mask relative to the dataset directory (of the image for a case without mask).
+    Files outside of the dataset directory are kept under ``mask_revisions/external/<full path>/``."""
+    path = os.path.abspath(mask_path or image_path)
+    if _is_within(path, dataset_directory):
+        relative = os.path.relpath(path, os.path.abspath(dataset_directory))
+    else:
+        relative = os.path.join("external", os.path.splitdrive(path)[1].lstrip("\\/"))
+    return os.path.join(joinpath(dataset_directory, REVISIONS_DIRECTORY), relative)
+
+
+def _is_within(path, directory):
+    try:
+        relative = os.path.relpath(path, os.path.abspath(directory))
+    except ValueError:
+        # another drive (Windows)
+        return False
+    return relative != os.pardir and not relative.startswith(os.pardir + os.sep)
+
+
+def has_revisions(directory):
+    return os.path.exists(os.path.join(directory, MANIFEST_FILENAME))
+
+
+def read_latest_revision(dataset_directory, mask_path, image_path=""):
+    """The latest revision ``(mask, geometry)`` of the mask of a case, None if it was never edited as revisions."""
+    directory = revisions_directory(dataset_directory, mask_path, image_path)
+    if not has_revisions(directory):
+        return None
+    revisions = MaskRevisions(directory)
+    if not len(revisions):
+        return None
+    return revisions.reconstruct()
+
+
+def save_revision(mask, geometry, directory, base_path="", image_path=""):
+    """Add a revision, see MaskRevisions.add; returns the revision file."""
+    revisions = MaskRevisions(directory, base_path, image_path)
+    number = revisions.add(mask, geometry)
+    logger.info(f'Saved mask revision {number} to {directory}')
+    return os.path.join(directory, revisions.manifest["revisions"][-1]["file"])
+
+
+def save_edit(mask, geometry, directory, base_path, fallback_path, backup_path=None, compression_level=1, image_path=""):
+    """Save an edited mask as a revision, or in full with save_mask if it does not match the
+    geometry of the original mask. Returns the revision file or ``fallback_path``."""
+    try:
+        return save_revision(mask, geometry, directory, base_path, image_path)
+    except ValueError as e:
+        logger.info(f'Saving the edited mask in full to {fallback_path}: {e}')
+        return save_mask(mask, geometry, fallback_path, base_path, backup_path, compression_level)
+
+
+def compacted_path(revisions, dataset_directory):
+    """``<image name>_edited_mask.nii.gz`` next to the image of the revisions (in the dataset directory
+    for revisions stored before the image was recorded, named after their folder)."""
+    if revisions.image_path:
+        directory, name = os.path.split(revisions.image_path)
+        return os.path.join(directory, split_extension(name)[0] + "_edited_mask.nii.gz")
+    return joinpath(dataset_directory, os.path.basename(revisions.directory) + "_edited_mask.nii.gz")
+
+
+def compact_dataset(dataset_directory, compression_level=1, remove_revisions=True):
+    """Write the latest revision of every edited case as a mask file, see compacted_path."""
+    root = joinpath(dataset_directory, REVISIONS_DIRECTORY)
+    if not os.path.isdir(root):
+        return []
+    directories = []
+    for directory, subdirectories, filenames in os.walk(root):
+        if MANIFEST_FILENAME in filenames:
+            directories.append(directory)
+            subdirectories[:] = []
+        subdirectories.sort()
+    written = []
+    for directory in directories:
+        revisions = MaskRevisions(directory)
+        path = compacted_path(revisions, dataset_directory)
+        written.append(revisions.compact(path, compression_level, remove_revisions))
+        logger.info(f'Compacted the mask revisions of {os.path.relpath(directory, root)} into {path}')
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the latest mask revisions of a dataset as mask files")
+    parser.add_argument("directory", help="dataset directory")
+    parser.add_argument("--compression-level", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the revisions after writing the masks")
+    args = parser.parse_args(argv)
+    for path in compact_dataset(args.directory, args.compression_level, not args.keep):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
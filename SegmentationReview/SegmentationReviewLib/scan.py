@@ -0,0 +1,158 @@
+"""Recursive discovery of the cases of a dataset directory without mapping file.
+
+Every directory of the tree is listed by its own task on a thread pool, which keeps
+many listings in flight on network filesystems. Images are paired with their masks by
+file name patterns, and the cases of each directory are handed over as soon as it is
+listed, so the review can start while the rest of the tree is still being scanned.
+"""
+import fnmatch
+import glob
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import MASK_LOADED, NO_MASK, is_valid_extension, split_extension
+
+logger = logging.getLogger('SegmentationReview')
+
+# mask file name of an image, "{stem}" is the image file name without extension; may contain * and ?
+DEFAULT_MASK_PATTERNS = ("{stem}_mask.nii.gz", "{stem}_mask.nii", "{stem}_mask.nrrd")
+
+
+def parse_mask_patterns(text):
+    """Mask patterns from a comma separated string, the default patterns if it is empty."""
+    patterns = tuple(pattern.strip() for pattern in text.split(",") if pattern.strip())
+    return patterns or DEFAULT_MASK_PATTERNS
+
+
+def pair_masks(names, mask_patterns=DEFAULT_MASK_PATTERNS):
+    """Pair the images among the file ``names`` of one directory with their masks.
+
+    Files with a valid extension that match a mask pattern are masks, the other ones are
+    images. Returns sorted ``(image name, mask name)`` pairs, with ``""`` for images without
+    mask; the first pattern that matches an existing mask wins.
+    """
+    valid = [name for name in names if is_valid_extension(name)]
+    any_stem = [pattern.format(stem="*") for pattern in mask_patterns]
+    masks = {name for name in valid if any(fnmatch.fnmatchcase(name, pattern) for pattern in any_stem)}
+    pairs = []
+    for name in sorted(valid):
+        if name in masks:
+            continue
+        stem = split_extension(name)[0]
+        mask = ""
+        for pattern in mask_patterns:
+            if glob.has_magic(pattern):
+                matches = sorted(m for m in masks if fnmatch.fnmatchcase(m, pattern.format(stem=glob.escape(stem))))
+                if matches:
+                    mask = matches[0]
+                    break
+            elif pattern.format(stem=stem) in masks:
+                mask = pattern.format(stem=stem)
+                break
+        pairs.append((name, mask))
+    return pairs
+
+
+class DirectoryScanner:
+    """Walks a directory tree on a thread pool and collects ``(image path, mask path, mask status)`` cases.
+
+    ``poll`` returns the cases found since the previous call without waiting; ``done``
+    tells whether every directory was listed. Hidden directories and symbolic links to
+    directories are not entered. Directories that cannot be listed are counted and
+    reported in one line at the end of the scan.
+    """
+
+    def __init__(self, directory, mask_patterns=DEFAULT_MASK_PATTERNS, workers=8):
+        self.directory = directory
+        self.mask_patterns = tuple(mask_patterns)
+        self.workers = workers
+        self._found = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0  # directories submitted but not listed yet
+        self.n_listed = 0
+        self.unreadable = []  # (directory, error) of the directories that cannot be listed
+        self._done = threading.Event()
+        self._cancelled = False
+        self._executor = None
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="SegmentationReviewScan")
+        self._submit(self.directory)
+        return self
+
+    def poll(self):
+        cases = []
+        while True:
+            try:
+                cases.extend(self._found.get_nowait())
+            except queue.Empty:
+                return cases
+
+    def wait(self, timeout=None):
+        """Wait for the end of the scan; returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        self._cancelled = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._done.set()
+
+    def _submit(self, directory):
+        with self._lock:
+            self._pending += 1
+        try:
+            self._executor.submit(self._scan, directory)
+        except RuntimeError:
+            # cancelled while scanning
+            self._finished()
+
+    def _finished(self):
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0
+        if done:
+            self._executor.shutdown(wait=False)
+            if self.unreadable:
+                directory, error = self.unreadable[0]
+                logger.info(f'Scan: {self.n_listed} folders listed, {len(self.unreadable)} cannot be listed '
+                            f'(first: {directory}: {error})')
+            self._done.set()
+
+    def _scan(self, directory):
+        try:
+            if self._cancelled:
+                return
+            names, subdirectories = [], []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith("."):
+                                subdirectories.append(entry.path)
+                        else:
+                            names.append(entry.name)
+                    except OSError:
+                        continue
+            # subdirectories are submitted before this one counts as listed, so the scan cannot end early
+            for subdirectory in sorted(subdirectories):
+                self._submit(subdirectory)
+            prefix = os.path.join(directory, "")
+            cases = [(prefix + image, prefix + mask if mask else "", MASK_LOADED if mask else NO_MASK)
+                     for image, mask in pair_masks(names, self.mask_patterns)]
+            if cases:
+                self._found.put(cases)
+            with self._lock:
+                self.n_listed += 1
+        except OSError as e:
+            with self._lock:
+                self.unreadable.append((directory, e))
+        finally:
+            self._finished()
@@ -0,0 +1,54 @@
+"""Review order of the cases of a session.
+
+A scheduler is a callable that gets a signals table with one row per case (see
+ReviewSession.case_signals) and returns the positions of its rows in review order.
+``sequential`` keeps the order of the mapping file or of the directory listing;
+PriorityScheduler puts the cases most likely to need attention first.
+"""
+import numpy as np
+import pandas as pd
+
+from .common import CANNOT_LOAD_MASK, NO_MASK
+
+
+def sequential(signals):
+    """Cases in discovery order."""
+    return np.arange(len(signals))
+
+
+class PriorityScheduler:
+    """Cases most likely to need correction first.
+
+    Cases are grouped in tiers: masks that are missing or cannot be loaded, then empty
+    masks (from the QA metrics), then all others. Within a tier, the cases with the highest
+    value of ``uncertainty_column`` (a column of the mapping file, e.g. the uncertainty of
+    the model that produced the mask) come first; without it, the masks whose total volume
+    is furthest from the median volume, in either direction, come first. Ties keep the
+    discovery order.
+    """
+
+    def __init__(self, uncertainty_column="uncertainty"):
+        self.uncertainty_column = uncertainty_column
+
+    def __call__(self, signals):
+        n = len(signals)
+        tier = np.full(n, 2)
+        if "empty_mask" in signals:
+            tier[signals["empty_mask"].fillna(False).astype(bool).to_numpy()] = 1
+        tier[signals["mask_status"].isin([NO_MASK, CANNOT_LOAD_MASK]).to_numpy()] = 0
+
+        score = np.zeros(n)
+        # cells that are not numbers (e.g. "n/a") rank as unknown, as empty ones
+        uncertainty = pd.to_numeric(signals[self.uncertainty_column], errors="coerce") if self.uncertainty_column in signals else None
+        if uncertainty is not None and uncertainty.notna().any():
+            score = uncertainty.astype(float).fillna(-np.inf).to_numpy()
+        elif "volume_mm3" in signals:
+            volume = signals["volume_mm3"].astype(float).to_numpy()
+            known = volume > 0
+            if known.any():
+                score[known] = np.abs(np.log(volume[known] / np.median(volume[known])))
+        # lexsort sorts by the last key first and is stable
+        return np.lexsort((-score, tier))
+
+
+SCHEDULERS = {"sequential": sequential, "priority": PriorityScheduler()}
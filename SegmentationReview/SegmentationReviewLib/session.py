@@ -0,0 +1,416 @@
+"""Headless review session: case discovery, restore of previous annotations, the
+next-unchecked cursor and persistence of ratings.
+
+The widget drives a ReviewSession, but the session can equally be driven (and
+benchmarked) from plain Python, without the Slicer GUI.
+"""
+import json
+import logging
+import os
+from itertools import compress
+
+import numpy as np
+import pandas as pd
+
+from .common import ANNOTATION_COLUMNS, CANNOT_LOAD_MASK, MASK_LOADED, joinpath, numerical_status_to_str, rating_to_str
+from .scan import DEFAULT_MASK_PATTERNS, DirectoryScanner
+from .case_index import LISTING, discover
+from .ingest import PREDICTION_PREFIX, mapping_predictions
+from .qa import QA_METRICS_FILENAME, read_metrics
+from .scheduler import sequential
+from .shards import CaseLeases, annotation_filename, read_all_annotations
+from .store import open_annotation_store
+
+logger = logging.getLogger('SegmentationReview')
+
+
+class ReviewSession:
+    """State of the review of one dataset directory.
+
+    The case list is kept as parallel lists: ``nifti_files``, ``segmentation_files``,
+    ``seg_mask_status`` and, for mapping_unique.csv datasets, ``id_subs``.
+    ``current_index`` points at the case under review.
+
+    The pending cases are kept in review order: ``scheduler`` (see scheduler) reorders
+    them after the previous annotations are restored, so ``current_index`` is also the
+    number of cases passed in this session.
+
+    With a ``reviewer`` name the session is one shard of a multi-reviewer review (see
+    shards): ratings go to the reviewer's own annotation file, the cases rated by any
+    reviewer are skipped, and a case is claimed with a lease before it is reviewed.
+
+    With ``recursive``, a directory without mapping file is scanned with its subfolders in
+    the background (see scan.DirectoryScanner); ``poll_scan`` adds the cases found so far.
+    """
+
+    def __init__(self, annotation_backend="csv", use_case_index=True, recursive=False, mask_patterns=DEFAULT_MASK_PATTERNS,
+                 scheduler=sequential, reviewer=None):
+        self.directory = None
+        self.annotation_backend = annotation_backend
+        self.use_case_index = use_case_index  # reuse the cached case table, see case_index
+        self.recursive = recursive
+        self.mask_patterns = mask_patterns
+        self.scheduler = scheduler
+        self.metrics = None  # QA metrics of the cases (see qa), a signal of the scheduler
+        self.reviewer = reviewer
+        self.leases = None  # case leases of a sharded session
+        self.scanner = None  # running recursive scan, None once all its cases were added
+        self._checked_keys = set()  # path keys of the annotated cases, to filter the scanned ones
+        self.store = None
+        self.nifti_files = []
+        self.segmentation_files = []
+        self.seg_mask_status = []  # 0 - no mask, 1 - mask path, cannot load , 2 - mask loaded, 3- mask edited
+        self.id_subs = []
+        self.id_subs_checked = set()
+        self.mappings = None
+        self.predictions = {}  # image path -> {prediction name: mask path}, from the mask_path_<name> mapping columns
+        self.with_mapper_flag = False
+        self.unique_case_flag = False
+        self.finish_flag = False
+        self.current_index = 0
+        self.n_files = 0
+        self.likert_scores = []
+        self._skip = [0]  # skip pointers over cases of settled subjects, see next_pending
+        self._subject_cases = {}  # subj_id -> indexes of its cases that are still pending
+
+    @property
+    def annotations_path(self):
+        return joinpath(self.directory, "annotations.csv")
+
+    def open(self, directory):
+        """Discover the cases of ``directory`` and skip the ones annotated in a previous session."""
+        self.directory = os.path.normpath(directory)
+        filename = None
+        if self.reviewer:
+            filename = annotation_filename(self.reviewer, ".sqlite" if self.annotation_backend == "sqlite" else ".csv")
+            self.leases = CaseLeases(self.directory, self.reviewer)
+        self.store = open_annotation_store(self.directory, self.annotation_backend, filename)
+        self.discover_cases()
+
+        self.restore_annotations()
+        if self.scheduler is not sequential:
+            self._load_metrics()
+            self._schedule(0)
+        self.current_index = self._claim_from(0)
+        logger.info(f'Total Images Loaded: {len(self.nifti_files)}, Images with Masks: {len(self.segmentation_files)}')
+        return self
+
+    def restore_annotations(self):
+        """Skip the cases annotated in a previous session, if any."""
+        self.current_index = 0
+        self._checked_keys = set()
+        if self.reviewer:
+            # the ratings of all reviewers
+            self.store.flush()
+            ann_csv = read_all_annotations(self.directory)[ANNOTATION_COLUMNS[:2]]
+        else:
+            ann_csv = self.store.read_checked()
+        if len(ann_csv):
+            self._restore_index(ann_csv)
+            logger.info(f'Found session, restoring annotations {len(self.nifti_files)} files left')
+        self.n_files = len(self.nifti_files)
+        self._build_pending_index()
+
+    def discover_cases(self):
+        """Build the case list from mapping_unique.csv, mapping.csv or the directory listing."""
+        directory = self.directory
+        self.nifti_files, self.segmentation_files, self.seg_mask_status, self.id_subs = [], [], [], []
+        self.predictions = {}
+        self.unique_case_flag = False
+        self.with_mapper_flag = False
+        # case 0: searching for one unique nifti file for id
+        if os.path.exists(joinpath(directory, "mapping_unique.csv")):
+            # mapping file contains id and nifti file name
+            self.unique_case_flag = True
+            self._read_mapping(joinpath(directory, "mapping_unique.csv"))
+        # case 1: mapper cvs is present
+        elif os.path.exists(joinpath(directory, "mapping.csv")):
+            logger.info('Found mappings between files and masks')
+            self.with_mapper_flag = True
+            self._read_mapping(joinpath(directory, "mapping.csv"))
+        # case 2: mapper cvs is not present; list files from file
+        elif self.recursive:
+            logger.info('No mappings between files and masks, scanning subfolders')
+            self.scanner = DirectoryScanner(directory, self.mask_patterns).start()
+        else:
+            logger.info('No mappings between files and masks')
+            self._list_directory()
+
+    def _read_mapping(self, mapping_path):
+        self.mappings = pd.read_csv(mapping_path)
+        self.predictions = mapping_predictions(self.mappings, self.directory)
+        self._set_cases(discover(self.directory, os.path.basename(mapping_path), self.mappings, self.use_case_index))
+
+    def _list_directory(self):
+        self._set_cases(discover(self.directory, LISTING, use_index=self.use_case_index))
+
+    def _set_cases(self, cases):
+        cases = cases[cases["img_valid"]]
+        self.nifti_files = cases["img_path"].tolist()
+        self.segmentation_files = cases["mask_path"].tolist()
+        self.seg_mask_status = cases["mask_status"].tolist()
+        if self.unique_case_flag:
+            self.id_subs = cases["subj_id"].tolist()
+
+    def _construct_full_path(self, path):
+        if os.path.isabs(path):
+            return path
+        else:
+            return joinpath(self.directory, path)
+
+    def _path_key(self, path):
+        """Normalized full path, used to match cases against annotations.csv entries"""
+        return os.path.normcase(os.path.normpath(self._construct_full_path(path)))
+
+    def _annotation_name(self, path):
+        """Name of a file in the annotations: its path relative to the dataset directory with "/"
+        separators (the file name for cases in the directory itself), the file name for files outside of it."""
+        if not path:
+            return ""
+        try:
+            relative = os.path.relpath(path, self.directory)
+        except ValueError:
+            # another drive
+            return os.path.basename(path)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return os.path.basename(path)
+        return relative.replace(os.sep, "/")
+
+    def _is_checked(self, path):
+        """True if the case of image ``path`` is annotated. Annotations written before cases in subfolders
+        were stored by relative path name the file only; such a row matches a case in a subfolder
+        unless the dataset directory has a file of the same name."""
+        key = self._path_key(path)
+        if key in self._checked_keys:
+            return True
+        name = os.path.basename(path)
+        flat_key = self._path_key(name)
+        return (flat_key != key and flat_key in self._checked_keys
+                and not os.path.isfile(self._construct_full_path(name)))
+
+    def _restore_index(self, ann_csv):
+        """Remove the annotated cases from the case list.
+
+        Annotations are looked up in a set keyed by normalized path (and, in unique mode,
+        subjects in a set of ``subj_id``), so restoring is linear in the number of cases.
+        In unique mode a subject with any annotated case is settled and all its cases are
+        skipped, as the module always restored such sessions.
+        """
+        files = ann_csv['file'].dropna().astype(str)
+        self._checked_keys = {self._path_key(f) for f in files.unique()}
+        checked = [self._is_checked(f) for f in self.nifti_files]
+
+        if self.unique_case_flag:
+            self.id_subs_checked = set(compress(self.id_subs, checked))
+            keep = [subj not in self.id_subs_checked for subj in self.id_subs]
+            self.id_subs = list(compress(self.id_subs, keep))
+        else:
+            keep = [not is_checked for is_checked in checked]
+        self.nifti_files = list(compress(self.nifti_files, keep))
+        self.segmentation_files = list(compress(self.segmentation_files, keep))
+        self.seg_mask_status = list(compress(self.seg_mask_status, keep))
+
+    def _load_metrics(self):
+        path = joinpath(self.directory, QA_METRICS_FILENAME)
+        if os.path.exists(path):
+            try:
+                self.metrics = read_metrics(path)
+            except (OSError, ValueError) as e:
+                logger.info(f'Ignoring {path}: {e}')
+
+    def case_signals(self, start=0):
+        """Signals table of the cases from ``start`` on, as given to the scheduler."""
+        return self._signals(self.nifti_files[start:], self.seg_mask_status[start:])
+
+    def _signals(self, image_paths, mask_statuses):
+        """One row per case: ``img_path``, ``mask_status``, ``empty_mask`` and ``volume_mm3`` (total of
+        all labels) from the QA metrics if known, and the extra columns of the mapping file."""
+        signals = pd.DataFrame({"img_path": image_paths, "mask_status": mask_statuses})
+        if self.metrics is not None and len(self.metrics):
+            metrics = self.metrics.drop_duplicates("img_path").set_index("img_path")
+            volumes = metrics["volumes_mm3"].map(lambda values: float(sum(values)) if isinstance(values, list) else np.nan)
+            signals["empty_mask"] = signals["img_path"].map(metrics["empty_mask"])
+            signals["volume_mm3"] = signals["img_path"].map(volumes)
+        if self.mappings is not None:
+            extra = [column for column in self.mappings if column not in ("img_path", "mask_path", "subj_id")
+                     and not column.startswith(PREDICTION_PREFIX)]
+            if extra:
+                keys = [self._path_key(path) for path in self.mappings["img_path"].fillna("").astype(str)]
+                rows = pd.Series(range(len(keys)), index=keys)
+                rows = rows[~rows.index.duplicated()]
+                positions = pd.Series([self._path_key(path) for path in image_paths]).map(rows)
+                for column in extra:
+                    values = self.mappings[column].reset_index(drop=True)
+                    signals[column] = positions.map(values).to_numpy()
+        return signals
+
+    def _schedule(self, start):
+        """Put the cases from ``start`` on in the order of the scheduler."""
+        if self.n_files - start < 2:
+            return
+        order = list(range(start)) + [start + int(i) for i in self.scheduler(self.case_signals(start))]
+        self.nifti_files = [self.nifti_files[i] for i in order]
+        self.segmentation_files = [self.segmentation_files[i] for i in order]
+        self.seg_mask_status = [self.seg_mask_status[i] for i in order]
+        if self.unique_case_flag:
+            self.id_subs = [self.id_subs[i] for i in order]
+        self._build_pending_index()
+
+    def reschedule(self, metrics=None):
+        """Reorder the cases after the current one, e.g. once new QA ``metrics`` are known."""
+        if metrics is not None:
+            self.metrics = metrics
+        if self.scheduler is not sequential:
+            self._schedule(self.current_index + 1)
+
+    def poll_scan(self):
+        """Add the cases found by the recursive scan since the last call; returns how many were added."""
+        if self.scanner is None:
+            return 0
+        done = self.scanner.done
+        waiting = self.current_index >= self.n_files
+        n_added = self.add_cases(self.scanner.poll())
+        if waiting and n_added:
+            self.current_index = self._claim_from(self.current_index)
+        if done:
+            self.scanner = None
+            logger.info(f'Scan finished, {self.n_files} cases to review')
+            if self.current_index >= self.n_files:
+                self.finish_flag = True
+        return n_added
+
+    def wait_for_scan(self):
+        """Block until the recursive scan has finished and add all its cases."""
+        if self.scanner is not None:
+            self.scanner.wait()
+            self.poll_scan()
+
+    def add_cases(self, cases):
+        """Append ``(image path, mask path, mask status)`` cases that have no annotation yet."""
+        cases = [case for case in cases if not self._is_checked(case[0])]
+        if self.scheduler is not sequential and len(cases) > 1:
+            # the new cases are appended, so only they are ordered and the pending index stays valid
+            order = self.scheduler(self._signals([case[0] for case in cases], [case[2] for case in cases]))
+            cases = [cases[int(i)] for i in order]
+        for image_path, mask_path, mask_status in cases:
+            self.nifti_files.append(image_path)
+            self.segmentation_files.append(mask_path)
+            self.seg_mask_status.append(mask_status)
+        # the former end of the case list becomes the first new case, which is pending
+        self._skip.extend(range(self.n_files + 1, self.n_files + len(cases) + 1))
+        self.n_files += len(cases)
+        return len(cases)
+
+    def mark_unloadable_masks(self, mask_paths):
+        """Set the status of the cases whose mask is among ``mask_paths`` to 'cannot load' (see qa.QualityPrePass)."""
+        mask_paths = set(mask_paths)
+        n_marked = 0
+        for index, mask_path in enumerate(self.segmentation_files):
+            if mask_path in mask_paths and self.seg_mask_status[index] == MASK_LOADED:
+                self.seg_mask_status[index] = CANNOT_LOAD_MASK
+                n_marked += 1
+        return n_marked
+
+    def subject_checked(self, index):
+        """True if the subject of case ``index`` already has an accepted case (mapping_unique.csv only)."""
+        return self.unique_case_flag and self.id_subs[index] in self.id_subs_checked
+
+    def _build_pending_index(self):
+        """Index the cases per subject, so that settling a subject and skipping its cases is cheap.
+
+        ``_skip[i]`` points at a case that is at most as far as the next pending case at or
+        after ``i``; it is ``i`` itself while case ``i`` is pending. ``_skip[n_files]`` is the end.
+        """
+        self._skip = list(range(self.n_files + 1))
+        self._subject_cases = {}
+        if self.unique_case_flag:
+            for index, id_subj in enumerate(self.id_subs):
+                self._subject_cases.setdefault(id_subj, []).append(index)
+            for id_subj in self.id_subs_checked:
+                self._settle_subject(id_subj)
+
+    def _settle_subject(self, id_subj):
+        # each case is settled at most once, so settling all subjects is linear overall
+        for index in self._subject_cases.pop(id_subj, ()):
+            self._skip[index] = index + 1
+
+    def next_pending(self, index):
+        """First case at or after ``index`` that needs review, or ``n_files`` if there is none."""
+        skip = self._skip
+        index = min(index, self.n_files)
+        pending = index
+        while skip[pending] != pending:
+            pending = skip[pending]
+        # path compression: later lookups from these cases jump straight to the pending one
+        while skip[index] != pending:
+            skip[index], index = pending, skip[index]
+        return pending
+
+    def pending_indexes(self, start):
+        """Indexes of the cases that need review, from ``start`` on."""
+        index = self.next_pending(start)
+        while index < self.n_files:
+            yield index
+            index = self.next_pending(index + 1)
+
+    def _claim_from(self, index):
+        """First pending case at or after ``index`` that is not taken by another reviewer, claimed for this one."""
+        index = self.next_pending(index)
+        if self.leases is None:
+            return index
+        while index < self.n_files and not self.leases.claim(self.nifti_files[index]):
+            # rated or under review elsewhere: skipped like the cases of a settled subject
+            self._skip[index] = index + 1
+            index = self.next_pending(index + 1)
+        return index
+
+    def advance(self):
+        """Move the cursor to the next case that needs review. Returns False once all cases are checked."""
+        if self.leases is not None and self.current_index < self.n_files:
+            # not rated: another reviewer may take it
+            self.leases.release(self.nifti_files[self.current_index])
+        self.current_index = self._claim_from(self.current_index + 1)
+        if self.current_index >= self.n_files:
+            # while scanning, more cases may still come in
+            self.finish_flag = self.scanner is None
+            return False
+        return True
+
+    def prediction_files(self, index):
+        """``{prediction name: mask path}`` of case ``index``, empty outside of comparison mode."""
+        return self.predictions.get(self.nifti_files[index], {})
+
+    def record_rating(self, likert_score, comment="", metrics=None):
+        """Store the rating of the current case, with the comparison ``metrics`` of its predictions if given."""
+        index = self.current_index
+        if index >= self.n_files:
+            # all cases checked, or waiting for the scan to find more
+            return
+        self.likert_scores.append([index, likert_score, comment])
+        if self.unique_case_flag and likert_score == 1:
+            # a case accepted with no changes settles its subject
+            self.id_subs_checked.add(self.id_subs[index])
+            self._settle_subject(self.id_subs[index])
+        if self.finish_flag:
+            return
+        self.store.append({'file': self._annotation_name(self.nifti_files[index]),
+                           'annotation': rating_to_str(likert_score),
+                           'comment': comment,
+                           'mask_path': self._annotation_name(self.segmentation_files[index]),
+                           'mask_status': numerical_status_to_str(self.seg_mask_status[index]),
+                           'subj_id': self.id_subs[index] if self.unique_case_flag else None,
+                           'metrics': json.dumps(metrics) if metrics else ""})
+        if self.leases is not None:
+            self.leases.complete(self.nifti_files[index])
+
+    def close(self):
+        """Commit pending ratings, refresh annotations.csv if another backend is used and release the store."""
+        if self.scanner is not None:
+            self.scanner.cancel()
+            self.scanner = None
+        if self.leases is not None:
+            self.leases.release()
+        if self.store is not None:
+            self.store.export_csv()
+            self.store.close()
+            self.store = None
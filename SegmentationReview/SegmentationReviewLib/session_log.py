@@ -0,0 +1,63 @@
+"""Log file of a review session.
+
+The ``SegmentationReview`` logger gets a single QueueHandler; a QueueListener thread
+writes the records to ``segmentation_review.log`` in the dataset directory, so no file I/O
+happens on the GUI thread. Opening another directory swaps the file handler instead of
+adding one, and handlers left over by a previous instance of the module (e.g. after
+reloading it in Slicer) are removed.
+"""
+import logging
+import logging.handlers
+import queue
+
+from .common import joinpath
+
+LOG_FILENAME = "segmentation_review.log"
+LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+
+
+class SessionLog:
+    """Routes the records of ``logger_name`` to the log file of the current dataset directory."""
+
+    def __init__(self, logger_name='SegmentationReview', level=logging.DEBUG):
+        self.logger = logging.getLogger(logger_name)
+        self.level = level
+        self.path = None
+        self._queue = queue.SimpleQueue()
+        self._queue_handler = logging.handlers.QueueHandler(self._queue)
+        self._queue_handler._segmentation_review = True  # recognized by later instances, see _remove_stale_handlers
+        self._listener = None
+        self._file_handler = None
+
+    def _remove_stale_handlers(self):
+        for handler in list(self.logger.handlers):
+            if handler is not self._queue_handler and (getattr(handler, "_segmentation_review", False)
+                                                        or isinstance(handler, logging.FileHandler)):
+                self.logger.removeHandler(handler)
+                if isinstance(handler, logging.FileHandler):
+                    handler.close()
+
+    def open(self, directory):
+        """Log to the log file of ``directory`` from now on; returns its path."""
+        self.close()
+        self._remove_stale_handlers()
+        self.path = joinpath(directory, LOG_FILENAME)
+        self._file_handler = logging.FileHandler(self.path, delay=True)
+        self._file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        self._listener = logging.handlers.QueueListener(self._queue, self._file_handler, respect_handler_level=True)
+        self._listener.start()
+        self.logger.setLevel(self.level)
+        if self._queue_handler not in self.logger.handlers:
+            self.logger.addHandler(self._queue_handler)
+        return self.path
+
+    def close(self):
+        """Write the queued records and close the log file."""
+        self.logger.removeHandler(self._queue_handler)
+        if self._listener is not None:
+            # stop() processes the records still in the queue
+            self._listener.stop()
+            self._listener = None
+        if self._file_handler is not None:
+            self._file_handler.close()
+            self._file_handler = None
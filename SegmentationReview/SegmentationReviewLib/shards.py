@@ -0,0 +1,215 @@
+"""Several reviewers on one dataset directory.
+
+In a sharded session each reviewer writes the ratings to their own annotation file
+(``annotations.<reviewer>.csv`` or ``.sqlite``) and claims a case before reviewing it
+with a lease file in LEASE_DIRECTORY, created with O_CREAT | O_EXCL so that exactly one
+reviewer gets it, also over SMB/NFS shares. A rated case keeps a ``.done`` marker; the
+lease of a case that was not rated (reviewer moved on, crashed) expires after
+``ttl`` seconds and can be taken over. ``merge_annotations`` combines the annotation
+files of all reviewers afterwards. From the command line::
+
+    python -m SegmentationReviewLib.shards /path/to/dataset
+"""
+import argparse
+import getpass
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import sqlite3
+import time
+
+import pandas as pd
+
+from .common import joinpath
+from .store import ANNOTATION_FILE_COLUMNS, read_annotation_csv, sqlite_annotation_columns
+
+logger = logging.getLogger('SegmentationReview')
+
+LEASE_DIRECTORY = ".segmentation_review_leases"
+MERGED_FILENAME = "annotations_merged.csv"
+
+
+def default_reviewer():
+    """``user@host``, which tells apart the reviewers and their machines."""
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = "reviewer"
+    return reviewer_name(f"{user}@{socket.gethostname()}")
+
+
+def reviewer_name(name):
+    """``name`` reduced to the characters allowed in the annotation file names."""
+    return re.sub(r"[^A-Za-z0-9_.@-]+", "_", name.strip()).strip(".") or "reviewer"
+
+
+def annotation_filename(reviewer, extension):
+    return f"annotations.{reviewer}{extension}"
+
+
+class CaseLeases:
+    """Leases of the cases of ``directory`` held by ``reviewer``.
+
+    Cases are identified by their path relative to the dataset directory, so that
+    machines mounting the share at different places agree on them.
+    """
+
+    def __init__(self, directory, reviewer, ttl=2 * 3600):
+        self.directory = directory
+        self.reviewer = reviewer
+        self.ttl = ttl
+        self.lease_directory = joinpath(directory, LEASE_DIRECTORY)
+        os.makedirs(self.lease_directory, exist_ok=True)
+        self.held = set()  # lease paths created by this reviewer and not completed or released
+
+    def _path(self, case_path, suffix=".lease"):
+        relative = os.path.relpath(os.path.abspath(case_path), os.path.abspath(self.directory))
+        key = relative.replace(os.sep, "/")
+        return os.path.join(self.lease_directory, hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest() + suffix)
+
+    def is_done(self, case_path):
+        return os.path.exists(self._path(case_path, ".done"))
+
+    def claim(self, case_path):
+        """Take the lease of a case; False if it is rated or leased by another reviewer."""
+        path = self._path(case_path)
+        if path in self.held:
+            return True
+        if self.is_done(case_path):
+            return False
+        if not self._create(path, case_path) and not self._take_over(path, case_path):
+            return False
+        # the case may have been rated between the check above and the creation of the lease
+        if self.is_done(case_path):
+            self._remove(path)
+            return False
+        self.held.add(path)
+        return True
+
+    def _create(self, path, case_path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"reviewer": self.reviewer, "case": os.path.basename(case_path), "time": time.time()}, f)
+        return True
+
+    def _take_over(self, path, case_path):
+        """Replace the lease of a case if it expired; only one reviewer can succeed."""
+        try:
+            if time.time() - os.stat(path).st_mtime < self.ttl:
+                return False
+        except FileNotFoundError:
+            # released meanwhile
+            return self._create(path, case_path)
+        # moving the expired lease away is atomic: of several reviewers, one gets it
+        stale_path = f"{path}.{self.reviewer}.stale"
+        try:
+            os.rename(path, stale_path)
+        except OSError:
+            return False
+        if time.time() - os.stat(stale_path).st_mtime < self.ttl:
+            # another reviewer replaced the lease just before: put theirs back
+            try:
+                os.link(stale_path, path)
+            except OSError:
+                pass
+            self._remove(stale_path)
+            return False
+        self._remove(stale_path)
+        logger.info(f'Took over the expired lease of {case_path}')
+        return self._create(path, case_path)
+
+    def complete(self, case_path):
+        """Mark a claimed case as rated."""
+        path = self._path(case_path)
+        try:
+            os.replace(path, self._path(case_path, ".done"))
+        except OSError:
+            # the lease expired and was taken over: the marker is still written
+            with open(self._path(case_path, ".done"), "w", encoding="utf-8") as f:
+                json.dump({"reviewer": self.reviewer, "case": os.path.basename(case_path), "time": time.time()}, f)
+        self.held.discard(path)
+
+    def release(self, case_path=None):
+        """Give back the lease of a case that was not rated, by default of all held cases."""
+        paths = [self._path(case_path)] if case_path is not None else list(self.held)
+        for path in paths:
+            if path in self.held:
+                self._remove(path)
+                self.held.discard(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def annotation_files(directory):
+    """annotations.csv and the annotation files of all reviewers, as ``(reviewer, path)``; "" is the unsharded file."""
+    files = []
+    for extension in (".csv", ".sqlite"):
+        path = joinpath(directory, "annotations" + extension)
+        if os.path.exists(path):
+            files.append(("", path))
+        for path in sorted(glob.glob(joinpath(directory, glob.escape("annotations.") + "*" + extension))):
+            files.append((os.path.basename(path)[len("annotations."):-len(extension)], path))
+    return files
+
+
+def read_annotation_file(path):
+    """The ratings of an annotation file (CSV without header, or SQLite) with the annotations.csv columns and metrics."""
+    if path.endswith(".sqlite"):
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            return pd.read_sql_query(
+                f"SELECT {sqlite_annotation_columns(connection)} FROM annotations ORDER BY id", connection)
+        finally:
+            connection.close()
+    return read_annotation_csv(path)
+
+
+def read_all_annotations(directory):
+    """Ratings of all reviewers with a ``reviewer`` column. A reviewer's SQLite file wins over its CSV export."""
+    tables = {}
+    for reviewer, path in annotation_files(directory):
+        try:
+            table = read_annotation_file(path)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            logger.info(f'Cannot read {path}: {e}')
+            continue
+        if reviewer not in tables or path.endswith(".sqlite"):
+            tables[reviewer] = table.assign(reviewer=reviewer)
+    if not tables:
+        return pd.DataFrame(columns=ANNOTATION_FILE_COLUMNS + ["reviewer"])
+    return pd.concat(tables.values(), ignore_index=True)
+
+
+def merge_annotations(directory, path=None):
+    """Write the ratings of all reviewers to annotations_merged.csv (with a header and a reviewer column)."""
+    path = path or joinpath(directory, MERGED_FILENAME)
+    merged = read_all_annotations(directory)
+    temporary_path = path + ".tmp"
+    merged.to_csv(temporary_path, index=False)
+    os.replace(temporary_path, path)
+    logger.info(f'Merged {len(merged)} ratings of {merged["reviewer"].nunique()} reviewers into {path}')
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge the annotation files of all reviewers of a dataset")
+    parser.add_argument("directory", help="dataset directory")
+    parser.add_argument("--output", help=f"merged file (default: {MERGED_FILENAME} in the dataset directory)")
+    args = parser.parse_args(argv)
+    print(merge_annotations(args.directory, args.output))
+
+
+if __name__ == "__main__":
+    main()
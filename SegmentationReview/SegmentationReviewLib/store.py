@@ -0,0 +1,315 @@
+"""Annotation storage backends.
+
+``CsvAnnotationStore`` appends to annotations.csv as the module always did.
+``SqliteAnnotationStore`` keeps the annotations in an SQLite database in WAL mode,
+indexed by case file and subject id, and commits in batches from a writer thread, so
+the cost of a rating and of a restore does not grow with the session. Both can export
+the annotations.csv layout (``file, annotation, comment, mask_path, mask_status``), followed
+by the ``metrics`` of the case in comparison mode (see compare).
+"""
+import logging
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import pandas as pd
+
+from .common import ANNOTATION_COLUMNS, METRICS_COLUMN, joinpath
+
+logger = logging.getLogger('SegmentationReview')
+
+ANNOTATION_FILE_COLUMNS = ANNOTATION_COLUMNS + [METRICS_COLUMN]
+
+
+def _read_csv_chunks(path, chunksize, **options):
+    # the fast parser fails on rows with more fields than the metrics column; the python parser
+    # drops them, from the row where the fast one stopped on
+    n_rows = 0
+    try:
+        for chunk in pd.read_csv(path, header=None, index_col=False, names=ANNOTATION_FILE_COLUMNS, chunksize=chunksize, **options):
+            n_rows += len(chunk)
+            yield chunk
+    except pd.errors.ParserError:
+        yield from pd.read_csv(path, header=None, index_col=False, names=ANNOTATION_FILE_COLUMNS, chunksize=chunksize,
+                               skiprows=n_rows, engine="python", usecols=ANNOTATION_FILE_COLUMNS, **options)
+
+
+def read_annotation_csv(path, columns=ANNOTATION_FILE_COLUMNS, chunksize=None, dtype=None):
+    """Read ``columns`` of an annotations.csv file. Rows may have the metrics column or not, and
+    fields after it are ignored; missing metrics are read as ""."""
+    fill = {METRICS_COLUMN: ""} if METRICS_COLUMN in columns else {}
+    chunks = (chunk[list(columns)].fillna(fill) for chunk in _read_csv_chunks(path, chunksize or 1000000, dtype=dtype))
+    if chunksize:
+        return chunks
+    return pd.concat(chunks, ignore_index=True)
+
+
+def write_annotation_csv(table, path, mode="w"):
+    """Write annotations without header; the metrics column is left out if no row has metrics."""
+    if METRICS_COLUMN in table and not (table[METRICS_COLUMN].fillna("") != "").any():
+        table = table.drop(columns=METRICS_COLUMN)
+    table.to_csv(path, mode=mode, index=False, header=False)
+
+
+def sqlite_annotation_columns(connection):
+    """SELECT list of the annotations.csv columns (and metrics) of an annotations.sqlite database,
+    which has no metrics column if it was created before comparison mode."""
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(annotations)")}
+    metrics = f"COALESCE({METRICS_COLUMN}, '')" if METRICS_COLUMN in columns else "''"
+    return ", ".join(ANNOTATION_COLUMNS) + f", {metrics} AS {METRICS_COLUMN}"
+
+
+def _row_key(values):
+    # annotation rows compared as text, with empty and missing fields alike
+    return tuple("" if value is None or (isinstance(value, float) and math.isnan(value)) else str(value) for value in values)
+
+
+class CsvAnnotationStore:
+    """annotations.csv in the dataset directory, one appended row per rating."""
+
+    filename = "annotations.csv"
+
+    def __init__(self, directory, filename=None):
+        self.path = joinpath(directory, filename or self.filename)
+        self._checked = None
+
+    def append(self, record):
+        """Store one rating, given as a dict with the annotations.csv columns (and optionally subj_id and metrics)."""
+        row = {column: record[column] for column in ANNOTATION_COLUMNS}
+        row[METRICS_COLUMN] = record.get(METRICS_COLUMN) or ""
+        write_annotation_csv(pd.DataFrame([row], columns=ANNOTATION_FILE_COLUMNS), self.path, mode='a')
+        if self._checked is not None:
+            self._checked.add(record["file"])
+
+    def read_annotations(self):
+        """All stored ratings as a DataFrame with the annotations.csv columns and metrics, oldest first."""
+        if not os.path.exists(self.path):
+            return pd.DataFrame(columns=ANNOTATION_FILE_COLUMNS)
+        return read_annotation_csv(self.path)
+
+    def read_checked(self):
+        """The ``file`` and ``annotation`` columns only, which is all a restore needs."""
+        if not os.path.exists(self.path):
+            return pd.DataFrame(columns=ANNOTATION_COLUMNS[:2])
+        return read_annotation_csv(self.path, ANNOTATION_COLUMNS[:2])
+
+    def is_checked(self, file):
+        if self._checked is None:
+            self._checked = set(self.read_annotations()["file"].dropna().astype(str))
+        return file in self._checked
+
+    def export_csv(self, path=None):
+        """Write the annotations in the annotations.csv layout (a no-op for the file itself)."""
+        if path is not None and os.path.abspath(path) != os.path.abspath(self.path):
+            write_annotation_csv(self.read_annotations(), path)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteAnnotationStore:
+    """annotations.sqlite in the dataset directory, written in batches by a background thread.
+
+    Ratings are queued by ``append`` and committed in one transaction every
+    ``batch_size`` ratings or ``flush_interval`` seconds, whichever comes first; with WAL
+    journaling a crash loses at most the last uncommitted batch and never corrupts the
+    database. On opening, the rows of annotations.csv that the database does not have are
+    imported, e.g. the ratings of a session reviewed with the csv backend in between, so the
+    session continues where it was and exporting never drops a rating. With another
+    ``filename``, the CSV file of the same name is used instead of annotations.csv.
+    """
+
+    filename = "annotations.sqlite"
+
+    def __init__(self, directory, filename=None, batch_size=32, flush_interval=1.0):
+        self.path = joinpath(directory, filename or self.filename)
+        self.csv_filename = os.path.splitext(os.path.basename(self.path))[0] + ".csv"
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._connection = self._connect()
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS annotations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file TEXT NOT NULL,
+                subj_id TEXT,
+                annotation TEXT,
+                comment TEXT,
+                mask_path TEXT,
+                mask_status TEXT,
+                created_at REAL,
+                metrics TEXT
+            );
+            CREATE INDEX IF NOT EXISTS annotations_file ON annotations (file);
+            CREATE INDEX IF NOT EXISTS annotations_subj_id ON annotations (subj_id);
+            CREATE TABLE IF NOT EXISTS csv_imports (
+                filename TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER
+            );
+        """)
+        if METRICS_COLUMN not in {row[1] for row in self._connection.execute("PRAGMA table_info(annotations)")}:
+            # database created before comparison mode
+            self._connection.execute(f"ALTER TABLE annotations ADD COLUMN {METRICS_COLUMN} TEXT")
+        self._connection.commit()
+        # ratings queued but not committed yet, so that lookups see them immediately
+        self._pending_files = set()
+        self._pending_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="SegmentationReviewAnnotations", daemon=True)
+        self._writer.start()
+
+        self._import_csv()
+
+    def _csv_signature(self, csv_path):
+        stat = os.stat(csv_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _import_csv(self):
+        """Import the rows of the CSV file that are not in the database, unless the file is unchanged
+        since it was last imported or exported."""
+        csv_path = joinpath(self.directory, self.csv_filename)
+        if not os.path.exists(csv_path):
+            return
+        signature = self._csv_signature(csv_path)
+        known = self._connection.execute("SELECT size, mtime_ns FROM csv_imports WHERE filename = ?",
+                                         (self.csv_filename,)).fetchone()
+        if known is not None and tuple(known) == signature:
+            return
+        # rows are matched as a multiset, so repeated ratings of a case are kept as often as they were given
+        stored = Counter(map(_row_key, self.read_annotations().itertuples(index=False)))
+        missing = []
+        for record in read_annotation_csv(csv_path, dtype=str).to_dict("records"):
+            key = _row_key(record[column] for column in ANNOTATION_FILE_COLUMNS)
+            if stored[key]:
+                stored[key] -= 1
+            else:
+                missing.append(record)
+        for record in missing:
+            self.append(record)
+        self.flush()
+        self._record_csv_signature(signature)
+        if missing:
+            logger.info(f'Imported {len(missing)} annotations from {csv_path}')
+
+    def _record_csv_signature(self, signature):
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO csv_imports (filename, size, mtime_ns) VALUES (?, ?, ?)",
+                                     (self.csv_filename, *signature))
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def append(self, record):
+        """Queue one rating; it is committed with the next batch."""
+        row = (str(record["file"]), record.get("subj_id"), record["annotation"], record["comment"],
+               record["mask_path"], record["mask_status"], record.get("created_at", time.time()),
+               record.get(METRICS_COLUMN) or "")
+        with self._pending_lock:
+            self._pending_files.add(row[0])
+        self._queue.put(row)
+
+    def flush(self):
+        """Block until all queued ratings are committed."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self._connection.close()
+
+    def _write_loop(self):
+        # the writer owns its own connection; reads go through self._connection
+        connection = self._connect()
+        batch, waiters, deadline = [], [], None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False  # flush interval elapsed
+            stop = item is None
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+            elif isinstance(item, tuple):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch and (stop or waiters or item is False or len(batch) >= self.batch_size):
+                try:
+                    with connection:
+                        connection.executemany(
+                            "INSERT INTO annotations (file, subj_id, annotation, comment, mask_path, mask_status, created_at, metrics)"
+                            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                except sqlite3.Error as e:
+                    logger.error(f'Cannot write {len(batch)} annotations to {self.path}: {e}')
+                else:
+                    with self._pending_lock:
+                        self._pending_files.difference_update(row[0] for row in batch)
+                batch, deadline = [], None
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+            if stop:
+                connection.close()
+                return
+
+    def read_annotations(self):
+        self.flush()
+        return pd.read_sql_query(
+            f"SELECT {sqlite_annotation_columns(self._connection)} FROM annotations ORDER BY id", self._connection)
+
+    def read_checked(self):
+        self.flush()
+        rows = self._connection.execute("SELECT file, annotation FROM annotations ORDER BY id").fetchall()
+        return pd.DataFrame(rows, columns=ANNOTATION_COLUMNS[:2])
+
+    def is_checked(self, file):
+        """Indexed lookup of whether ``file`` (as stored in the file column) has a rating."""
+        with self._pending_lock:
+            if file in self._pending_files:
+                return True
+        return self._connection.execute("SELECT 1 FROM annotations WHERE file = ? LIMIT 1", (file,)).fetchone() is not None
+
+    def export_csv(self, path=None):
+        """Write all ratings in the annotations.csv layout (by default to annotations.csv itself).
+
+        Before annotations.csv is replaced, rows added to it since it was imported are merged in.
+        """
+        csv_path = joinpath(self.directory, self.csv_filename)
+        path = path or csv_path
+        is_own_csv = os.path.abspath(path) == os.path.abspath(csv_path)
+        if is_own_csv:
+            self._import_csv()
+        temporary_path = path + ".tmp"
+        write_annotation_csv(self.read_annotations(), temporary_path)
+        os.replace(temporary_path, path)
+        if is_own_csv:
+            self._record_csv_signature(self._csv_signature(path))
+        return path
+
+
+ANNOTATION_STORES = {"csv": CsvAnnotationStore, "sqlite": SqliteAnnotationStore}
+
+
+def open_annotation_store(directory, backend="csv", filename=None):
+    """Open the annotation store of a dataset directory; ``backend`` is "csv" or "sqlite".
+
+    ``filename`` replaces annotations.csv / annotations.sqlite, e.g. for the annotations
+    of one reviewer of a sharded session.
+    """
+    return ANNOTATION_STORES[backend](directory, filename)
@@ -0,0 +1,97 @@
+"""Timing of the stages of the review, written as JSON lines.
+
+``StageTimer.stage`` is a context manager around one stage of a case (volume read,
+segmentation load, editor setup, ...). Each stage is appended to TIMINGS_FILENAME in the
+dataset directory as ``{"time", "case", "stage", "seconds"}``. A disabled timer returns one
+shared no-op context manager, so instrumented code costs a method call per stage. The
+p50/p95 per stage are printed with::
+
+    python -m SegmentationReviewLib.timing /path/to/dataset/segmentation_review_timings.jsonl
+"""
+import argparse
+import contextlib
+import json
+import threading
+import time
+
+import pandas as pd
+
+TIMINGS_FILENAME = "segmentation_review_timings.jsonl"
+
+_DISABLED = contextlib.nullcontext()
+
+
+class StageTimer:
+    """Times stages to the JSON lines file ``path``; disabled if ``path`` is None."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.case = ""  # case the next stages belong to
+        self._file = open(path, "a", encoding="utf-8") if path else None
+        self._lock = threading.Lock()  # stages can also be timed from worker threads
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def stage(self, name):
+        if self._file is None:
+            return _DISABLED
+        return self._timed(name, self.case)
+
+    @contextlib.contextmanager
+    def _timed(self, name, case):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, case)
+
+    def record(self, name, seconds, case=None):
+        """Write the duration of a stage measured elsewhere."""
+        if self._file is None:
+            return
+        line = json.dumps({"time": time.time(), "case": self.case if case is None else case, "stage": name,
+                           "seconds": round(seconds, 6)})
+        with self._lock:
+            # closed meanwhile by another thread
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def flush(self):
+        if self._file is not None:
+            with self._lock:
+                self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            with self._lock:
+                self._file.close()
+                self._file = None
+
+
+def read_timings(path):
+    return pd.read_json(path, lines=True)
+
+
+def summarize(timings):
+    """Count, p50, p95, mean and total seconds per stage, slowest p95 first."""
+    grouped = timings.groupby("stage")["seconds"]
+    summary = pd.DataFrame({"count": grouped.size(),
+                            "p50": grouped.quantile(0.5),
+                            "p95": grouped.quantile(0.95),
+                            "mean": grouped.mean(),
+                            "total": grouped.sum()})
+    return summary.sort_values("p95", ascending=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize a SegmentationReview timing log")
+    parser.add_argument("path", help=TIMINGS_FILENAME + " file")
+    args = parser.parse_args(argv)
+    with pd.option_context("display.float_format", "{:.4f}".format):
+        print(summarize(read_timings(args.path)).to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Local cache of decompressed voxel data, read back as memory-mapped arrays.
+
+Decoding a .nii.gz costs a full gunzip every time a case is opened. The cache stores the
+voxels of each image once as an uncompressed .npy file (with its geometry in a JSON
+sidecar) and later maps that file instead: revisiting a case, or a second reviewer on
+the same workstation, then only reads the pages that are actually displayed, and those
+pages belong to the OS file cache rather than to the process.
+
+The arrays are mapped copy-on-write: they can be handed to a volume node as they are,
+and only the pages written to (e.g. by an edit) become private memory of the process;
+the cache files are never modified.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from .prefetch import read_image
+
+logger = logging.getLogger('SegmentationReview')
+
+
+class VolumeCache:
+    """Memory-mapped copies of image files in ``directory``, at most ``max_bytes`` in total.
+
+    Entries are keyed by the path, size and modification time of the source file, so a
+    changed file is read again. The least recently used entries are evicted first. Entries
+    are written to a temporary file and renamed, so several processes can share a cache.
+    """
+
+    def __init__(self, directory, max_bytes=16 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _key(self, path):
+        stat = os.stat(path)
+        source = f"{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        return hashlib.blake2b(source.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.directory, key + ".npy"), os.path.join(self.directory, key + ".json")
+
+    def get(self, path):
+        """Return the cached ``(array, geometry)`` of ``path``, or None. The array is a copy-on-write np.memmap."""
+        return self._get(self._key(path))
+
+    def _get(self, key):
+        data_path, info_path = self._paths(key)
+        try:
+            with open(info_path, encoding="utf-8") as f:
+                geometry = json.load(f)["geometry"]
+            array = np.load(data_path, mmap_mode="c")
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            # the sidecar mtime is the last use, see evict
+            os.utime(info_path)
+        except OSError:
+            pass
+        return array, geometry
+
+    def put(self, path, array, geometry):
+        """Store the voxels of ``path`` and return them memory-mapped from the cache."""
+        return self._put(self._key(path), path, array, geometry)
+
+    def _put(self, key, path, array, geometry):
+        data_path, info_path = self._paths(key)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(data_path + suffix, "wb") as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(data_path + suffix, data_path)
+        # the sidecar is written last: an entry without it is incomplete and ignored
+        with open(info_path + suffix, "w", encoding="utf-8") as f:
+            json.dump({"source": os.path.abspath(path), "geometry": {key: list(value) for key, value in geometry.items()}}, f)
+        os.replace(info_path + suffix, info_path)
+        self.evict()
+        return np.load(data_path, mmap_mode="c"), geometry
+
+    def read(self, path):
+        """Like prefetch.read_image, but from the cache when possible; images are cached on first read."""
+        cached = self.get(path)
+        if cached is not None:
+            return cached
+        array, geometry = read_image(path)
+        if array.nbytes > self.max_bytes:
+            return array, geometry
+        try:
+            return self.put(path, array, geometry)
+        except OSError as e:
+            logger.info(f'Cannot cache {path} in {self.directory}: {e}')
+            return array, geometry
+
+    def _entries(self):
+        """(last use, bytes, key) of every entry of the cache."""
+        entries = []
+        with os.scandir(self.directory) as listing:
+            for entry in listing:
+                if not entry.name.endswith(".json"):
+                    continue
+                key = entry.name[:-len(".json")]
+                try:
+                    last_use = entry.stat().st_mtime_ns
+                    nbytes = os.stat(self._paths(key)[0]).st_size
+                except OSError:
+                    continue
+                entries.append((last_use, nbytes, key))
+        return entries
+
+    @property
+    def total_bytes(self):
+        return sum(nbytes for _, nbytes, _ in self._entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in ``max_bytes``."""
+        entries = sorted(self._entries())
+        total = sum(nbytes for _, nbytes, _ in entries)
+        for _, nbytes, key in entries:
+            if total <= self.max_bytes:
+                break
+            data_path, info_path = self._paths(key)
+            try:
+                os.remove(info_path)
+                os.remove(data_path)
+            except OSError:
+                # removed by another process, or still mapped (Windows)
+                continue
+            total -= nbytes
+
+    def clear(self):
+        max_bytes, self.max_bytes = self.max_bytes, 0
+        try:
+            self.evict()
+        finally:
+            self.max_bytes = max_bytes
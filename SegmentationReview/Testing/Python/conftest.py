@@ -0,0 +1,36 @@
+"""Fixtures of the tests of SegmentationReviewLib, which run with plain pytest (no Slicer)::
+
+    python -m pytest SegmentationReview/Testing/Python
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+# the module folder, so that SegmentationReviewLib is importable without Slicer
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+
+
+@pytest.fixture
+def write_image(tmp_path):
+    """Write an array (KJI order) as an image file under tmp_path; returns the full path."""
+    def write(name, array, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0)):
+        path = os.path.join(str(tmp_path), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        image = sitk.GetImageFromArray(np.asarray(array))
+        image.SetSpacing([float(value) for value in spacing])
+        image.SetOrigin([float(value) for value in origin])
+        sitk.WriteImage(image, path)
+        return path
+    return write
+
+
+@pytest.fixture
+def box_mask():
+    """A 12x16x20 labelmap with label 1 in a box and label 2 in a smaller box next to it."""
+    mask = np.zeros((12, 16, 20), dtype=np.uint8)
+    mask[3:9, 4:12, 5:15] = 1
+    mask[3:9, 12:14, 5:15] = 2
+    return mask
@@ -0,0 +1,100 @@
+import logging
+import os
+import time
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from SegmentationReviewLib.case_index import CASE_INDEX_FILENAME, LISTING, discover
+from SegmentationReviewLib.session import ReviewSession
+
+
+def touch(directory, *names):
+    for name in names:
+        path = os.path.join(str(directory), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+
+
+def bump_mtime(path):
+    # directory mtimes can be coarse: make the change visible whatever the filesystem
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def normalized(table):
+    return table.reset_index(drop=True).astype({"img_valid": bool, "mask_status": int})
+
+
+def write_mapping(directory):
+    touch(directory, "x/a1.nii.gz", "x/a1_seg.nii.gz", "x/b1.nii.gz", "y/a2.nii.gz", "y/c1.nii.gz", "y/b2.nii.gz")
+    mappings = pd.DataFrame({
+        "subj_id": ["a", "b", "a", "c", "b", "d"],
+        "img_path": ["x/a1.nii.gz", "x/b1.nii.gz", "y/a2.nii.gz", "y/c1.nii.gz", "y/b2.nii.gz", "y/d1.nii.gz"],
+        "mask_path": ["x/a1_seg.nii.gz", None, "y/a2_seg.nii.gz", None, None, None],
+    })
+    mappings.to_csv(os.path.join(str(directory), "mapping_unique.csv"), index=False)
+    return mappings
+
+
+def test_discover_writes_and_reuses_the_index(tmp_path):
+    mappings = write_mapping(tmp_path)
+    table = discover(str(tmp_path), "mapping_unique.csv", mappings)
+    assert os.path.exists(os.path.join(str(tmp_path), CASE_INDEX_FILENAME))
+    assert table["img_valid"].tolist() == [True, True, True, True, True, False]
+    assert (table.loc[table["img_valid"], "size"] == 0).all()
+    cached = discover(str(tmp_path), "mapping_unique.csv", mappings)
+    assert_frame_equal(normalized(cached), normalized(table), check_dtype=False)
+
+
+def test_revalidating_a_changed_directory_matches_a_cold_rebuild(tmp_path):
+    mappings = write_mapping(tmp_path)
+    discover(str(tmp_path), "mapping_unique.csv", mappings)
+    # one file of y appears, another one goes away
+    touch(tmp_path, "y/d1.nii.gz", "y/a2_seg.nii.gz")
+    os.remove(os.path.join(str(tmp_path), "y", "c1.nii.gz"))
+    bump_mtime(os.path.join(str(tmp_path), "y"))
+    revalidated = discover(str(tmp_path), "mapping_unique.csv", mappings)
+    cold = discover(str(tmp_path), "mapping_unique.csv", mappings, use_index=False)
+    assert_frame_equal(normalized(revalidated), normalized(cold), check_dtype=False)
+    assert revalidated["subj_index"].tolist() == [0, 1, 0, 2, 1, 3]
+    assert revalidated["subj_case"].tolist() == [0, 0, 1, 0, 1, 0]
+    assert revalidated["img_valid"].tolist() == [True, True, True, False, True, True]
+
+
+def test_listing_index_picks_up_new_images(tmp_path):
+    touch(tmp_path, "a.nii.gz", "a_mask.nii.gz")
+    assert len(discover(str(tmp_path), LISTING)) == 1
+    time.sleep(0.01)
+    touch(tmp_path, "b.nii.gz")
+    bump_mtime(str(tmp_path))
+    table = discover(str(tmp_path), LISTING)
+    cold = discover(str(tmp_path), LISTING, use_index=False)
+    key = "img_path"
+    assert_frame_equal(normalized(table.sort_values(key)), normalized(cold.sort_values(key)), check_dtype=False)
+
+
+def test_files_other_than_images_do_not_revalidate(tmp_path, caplog):
+    mappings = write_mapping(tmp_path)
+    discover(str(tmp_path), "mapping_unique.csv", mappings)
+    touch(tmp_path, "x/notes.txt")
+    bump_mtime(os.path.join(str(tmp_path), "x"))
+    with caplog.at_level(logging.INFO, logger="SegmentationReview"):
+        discover(str(tmp_path), "mapping_unique.csv", mappings)
+    assert "no changed directories" in caplog.text
+
+
+def test_reopening_after_a_rating_does_not_revalidate(tmp_path, caplog):
+    touch(tmp_path, "a.nii.gz", "b.nii.gz")
+    pd.DataFrame({"img_path": ["a.nii.gz", "b.nii.gz"], "mask_path": [None, None]}).to_csv(tmp_path / "mapping.csv", index=False)
+    for backend in ("sqlite", "csv"):
+        session = ReviewSession(annotation_backend=backend).open(str(tmp_path))
+        session.record_rating(2)
+        session.close()
+        # the annotations, the sqlite journal and the exported annotations.csv change the directory
+        bump_mtime(str(tmp_path))
+        caplog.clear()
+        with caplog.at_level(logging.INFO, logger="SegmentationReview"):
+            ReviewSession(annotation_backend=backend).open(str(tmp_path)).close()
+        assert "no changed directories" in caplog.text
+        assert "revalidated" not in caplog.text
@@ -0,0 +1,48 @@
+import shutil
+
+import numpy as np
+
+from SegmentationReviewLib.centroids import CentroidCache, label_statistics
+
+
+def test_label_statistics_of_box_labels(box_mask):
+    statistics = label_statistics(box_mask)
+    assert statistics.labels.tolist() == [1, 2]
+    assert statistics.counts.tolist() == [6 * 8 * 10, 6 * 2 * 10]
+    # IJK order: i is the last array axis
+    np.testing.assert_allclose(statistics.centroids_ijk, [[9.5, 7.5, 5.5], [9.5, 12.5, 5.5]])
+    assert statistics.bbox_min_ijk.tolist() == [[5, 4, 3], [5, 12, 3]]
+    assert statistics.bbox_max_ijk.tolist() == [[14, 11, 8], [14, 13, 8]]
+    assert statistics.centroids_ras is None
+
+
+def test_label_statistics_single_label_and_empty():
+    mask = np.zeros((4, 5, 6), dtype=np.uint8)
+    assert len(label_statistics(mask)) == 0
+    mask[1, 2, 3] = 7
+    statistics = label_statistics(mask)
+    assert statistics.labels.tolist() == [7]
+    assert statistics.bbox_min_ijk.tolist() == statistics.bbox_max_ijk.tolist() == [[3, 2, 1]]
+
+
+def test_label_statistics_ras_centroids(box_mask):
+    geometry = {"spacing": (2.0, 1.0, 1.0), "origin": (10.0, 0.0, 0.0), "direction": (1, 0, 0, 0, 1, 0, 0, 0, 1)}
+    statistics = label_statistics(box_mask, geometry)
+    # LPS origin and spacing applied, then L and P flipped to R and A
+    np.testing.assert_allclose(statistics.centroids_ras[0], [-(10.0 + 2.0 * 9.5), -7.5, 5.5])
+
+
+def test_centroid_cache_reuses_statistics_by_content(write_image, box_mask, tmp_path):
+    path = write_image("mask.nii.gz", box_mask)
+    cache = CentroidCache(max_entries=1)
+    statistics = cache.get(path)
+    assert statistics.labels.tolist() == [1, 2]
+    assert cache.get(path) is statistics
+    # an identical copy has the same content hash
+    copy = str(tmp_path / "copy.nii.gz")
+    shutil.copyfile(path, copy)
+    assert cache.get(copy) is statistics
+    other = write_image("other.nii.gz", (box_mask == 1).astype(np.uint8))
+    assert cache.get(other).labels.tolist() == [1]
+    # only one entry is kept
+    assert cache.get(path) is not statistics
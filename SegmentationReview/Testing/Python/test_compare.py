@@ -0,0 +1,140 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from SegmentationReviewLib.compare import (COMPARISON_FILENAME, ComparisonPass, compare_case, compare_masks, prediction_metrics,
+                                           read_comparison)
+from SegmentationReviewLib.ingest import mapping_predictions
+from SegmentationReviewLib.prefetch import read_image
+from SegmentationReviewLib.revisions import revisions_directory, save_revision
+from SegmentationReviewLib.session import ReviewSession
+from SegmentationReviewLib.store import read_annotation_csv
+
+
+def without_label_2(mask):
+    prediction = mask.copy()
+    prediction[prediction == 2] = 0
+    return prediction
+
+
+def test_compare_identical_masks(box_mask):
+    metrics = compare_masks(box_mask, box_mask, (1.0, 1.0, 2.0))
+    assert metrics["dice"] == 1.0
+    assert metrics["label_dice"] == {"1": 1.0, "2": 1.0}
+    assert metrics["volume_mask_ml"] == pytest.approx(600 * 2.0 / 1000)
+    assert metrics["volume_difference_ml"] == 0
+    assert metrics["hd95_mm"] == 0 and metrics["assd_mm"] == 0
+
+
+def test_compare_masks_overlap_and_distances(box_mask):
+    metrics = compare_masks(box_mask, without_label_2(box_mask), (1.0, 1.0, 2.0))
+    # 480 of 600 foreground voxels predicted
+    assert metrics["dice"] == pytest.approx(2 * 480 / (600 + 480))
+    assert metrics["label_dice"] == {"1": 1.0, "2": 0.0}
+    assert metrics["volume_difference_ml"] == pytest.approx(-120 * 2.0 / 1000)
+    # label 2 is 2 voxels (1 mm each) thick along J
+    assert 0 < metrics["hd95_mm"] <= 2.0 + 1e-6
+    assert 0 < metrics["assd_mm"] < metrics["hd95_mm"]
+
+
+def test_compare_masks_with_large_labels(box_mask):
+    reference = box_mask.astype(np.int32) * 5000
+    metrics = compare_masks(reference, reference, (1.0, 1.0, 1.0))
+    assert metrics["label_dice"] == {"5000": 1.0, "10000": 1.0}
+
+
+def test_compare_masks_with_an_empty_prediction(box_mask):
+    metrics = compare_masks(box_mask, np.zeros_like(box_mask), (1.0, 1.0, 1.0))
+    assert metrics["dice"] == 0
+    assert np.isnan(metrics["hd95_mm"]) and np.isnan(metrics["assd_mm"])
+
+
+def test_compare_case(write_image, box_mask, tmp_path):
+    image = write_image("image.nii.gz", box_mask)
+    mask = write_image("image_mask.nii.gz", box_mask)
+    # at twice the spacing: resampled to the grid of the mask
+    coarse = write_image("coarse.nii.gz", box_mask[::2, ::2, ::2], spacing=(2.0, 2.0, 2.0), origin=(0.5, 0.5, 0.5))
+    rows = compare_case(image, mask, {"same": mask, "coarse": coarse, "missing": str(tmp_path / "missing.nii.gz")})
+    assert [row["prediction"] for row in rows] == ["coarse", "missing", "same"]
+    assert rows[2]["dice"] == 1.0 and rows[2]["error"] == ""
+    assert 0.5 < rows[0]["dice"] < 1.0
+    assert rows[1]["error"] and "dice" not in rows[1]
+    assert compare_case(image, "", {"same": mask})[0]["error"] == "no mask to compare with"
+
+    metrics = prediction_metrics(rows)
+    assert sorted(metrics) == ["coarse", "same"]
+    assert metrics["same"] == {"dice": 1.0, "volume_difference_ml": 0.0, "hd95_mm": 0.0, "assd_mm": 0.0}
+
+
+def test_mapping_predictions(tmp_path):
+    mappings = pd.DataFrame({"img_path": ["a.nii.gz", "b.nii.gz"], "mask_path": ["a_mask.nii.gz", "b_mask.nii.gz"],
+                             "mask_path_v1": ["a_v1.nii.gz", None], "mask_path_v2": ["", "sub/b_v2.nii.gz"]})
+    predictions = mapping_predictions(mappings, str(tmp_path))
+    assert sorted(predictions) == [os.path.join(str(tmp_path), "a.nii.gz"), os.path.join(str(tmp_path), "b.nii.gz")]
+    assert predictions[os.path.join(str(tmp_path), "a.nii.gz")] == {"v1": os.path.join(str(tmp_path), "a_v1.nii.gz")}
+    assert predictions[os.path.join(str(tmp_path), "b.nii.gz")] == {"v2": os.path.join(str(tmp_path), "sub/b_v2.nii.gz")}
+    assert mapping_predictions(mappings[["img_path", "mask_path"]], str(tmp_path)) == {}
+
+
+def test_comparison_pass_reuses_unchanged_rows(write_image, box_mask, tmp_path):
+    cases = [(write_image(f"case{i}.nii.gz", box_mask), write_image(f"case{i}_mask.nii.gz", box_mask),
+              {"v1": write_image(f"case{i}_v1.nii.gz", without_label_2(box_mask) if i else box_mask)}) for i in range(3)]
+    # cases without predictions are left out
+    cases.append((write_image("case3.nii.gz", box_mask), "", {}))
+    comparison = ComparisonPass(str(tmp_path), cases, workers=1, chunk_size=2).start()
+    assert comparison.wait(60) and comparison.progress == (3, 3)
+    table = read_comparison(os.path.join(str(tmp_path), COMPARISON_FILENAME))
+    assert table["dice"].tolist() == pytest.approx([1.0, 2 * 480 / 1080, 2 * 480 / 1080])
+    assert table["label_dice"][0] == {"1": 1.0, "2": 1.0}
+    assert comparison.metrics(cases[0][0], cases[0][1])["v1"]["dice"] == 1.0
+    assert "median Dice v1 0.889" in comparison.summary()
+
+    # an edited mask: its metrics are out of date until it is compared again
+    write_image("case1_mask.nii.gz", without_label_2(box_mask))
+    stat = os.stat(cases[1][1])
+    os.utime(cases[1][1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert comparison.metrics(cases[1][0], cases[1][1]) is None
+    comparison = ComparisonPass(str(tmp_path), cases, workers=1).start()
+    assert comparison.wait(60)
+    assert comparison.metrics(cases[1][0], cases[1][1])["v1"]["dice"] == 1.0
+    assert comparison.metrics(cases[2][0], cases[2][1])["v1"]["dice"] == pytest.approx(0.8889)
+
+
+def test_comparison_of_a_mask_edited_as_revisions(write_image, box_mask, tmp_path):
+    image = write_image("case.nii.gz", box_mask)
+    mask = write_image("case_mask.nii.gz", box_mask)
+    cases = [(image, mask, {"v1": write_image("case_v1.nii.gz", without_label_2(box_mask))})]
+    comparison = ComparisonPass(str(tmp_path), cases, workers=1).start()
+    assert comparison.wait(60)
+    assert comparison.metrics(image, mask)["v1"]["dice"] == pytest.approx(0.8889)
+
+    # the edit removes label 2 as the prediction does; the mask file itself is not changed
+    save_revision(without_label_2(box_mask), read_image(mask)[1], revisions_directory(str(tmp_path), mask, image), mask, image)
+    assert comparison.metrics(image, mask) is None
+    assert compare_case(image, mask, cases[0][2], str(tmp_path))[0]["dice"] == 1.0
+    comparison = ComparisonPass(str(tmp_path), cases, workers=1).start()
+    assert comparison.wait(60)
+    assert comparison.metrics(image, mask)["v1"]["dice"] == 1.0
+    # a further revision makes these metrics out of date again
+    save_revision(box_mask, read_image(mask)[1], revisions_directory(str(tmp_path), mask, image), mask, image)
+    assert comparison.metrics(image, mask) is None
+
+
+def test_metrics_are_stored_with_the_rating(write_image, box_mask, tmp_path):
+    write_image("a.nii.gz", box_mask)
+    write_image("a_mask.nii.gz", box_mask)
+    write_image("a_v1.nii.gz", without_label_2(box_mask))
+    pd.DataFrame({"img_path": ["a.nii.gz"], "mask_path": ["a_mask.nii.gz"],
+                  "mask_path_v1": ["a_v1.nii.gz"]}).to_csv(tmp_path / "mapping.csv", index=False)
+    session = ReviewSession(use_case_index=False).open(str(tmp_path))
+    try:
+        assert session.prediction_files(0) == {"v1": os.path.join(str(tmp_path), "a_v1.nii.gz")}
+        rows = compare_case(session.nifti_files[0], session.segmentation_files[0], session.prediction_files(0))
+        session.record_rating(2, metrics=prediction_metrics(rows))
+    finally:
+        session.close()
+    annotations = read_annotation_csv(os.path.join(str(tmp_path), "annotations.csv"))
+    assert json.loads(annotations["metrics"][0])["v1"]["dice"] == pytest.approx(0.8889)
@@ -0,0 +1,108 @@
+import numpy as np
+
+from SegmentationReviewLib.crop import (mask_bounding_box, padded_region, read_cropped_case, read_region, save_uncropped,
+                                        uncrop)
+from SegmentationReviewLib.prefetch import CasePrefetcher, read_image
+from SegmentationReviewLib.revisions import revisions_directory, save_revision
+
+
+def image_array(shape):
+    return np.arange(np.prod(shape), dtype=np.int16).reshape(shape)
+
+
+def test_mask_bounding_box(box_mask):
+    assert mask_bounding_box(box_mask) == ((3, 4, 5), (9, 14, 15))
+    assert mask_bounding_box(np.zeros_like(box_mask)) is None
+
+
+def test_padded_region_uses_the_spacing_of_each_axis():
+    # spacing is IJK: 2 mm along the last KJI axis, 0.5 mm along the first
+    start, stop = padded_region(((3, 4, 5), (9, 14, 15)), (12, 16, 20), (2.0, 1.0, 0.5), 2)
+    assert start == (0, 2, 4)
+    assert stop == (12, 16, 16)
+
+
+def test_read_region(write_image):
+    array = image_array((12, 16, 20))
+    path = write_image("image.nrrd", array, spacing=(0.5, 1.0, 2.0), origin=(1.0, 2.0, 3.0))
+    region, geometry = read_region(path, (1, 2, 3), (4, 6, 8))
+    np.testing.assert_array_equal(region, array[1:4, 2:6, 3:8])
+    np.testing.assert_allclose(geometry["origin"], (1.0 + 3 * 0.5, 2.0 + 2 * 1.0, 3.0 + 1 * 2.0))
+
+
+def test_read_cropped_case(write_image, box_mask):
+    array = image_array(box_mask.shape)
+    image = write_image("image.nrrd", array)
+    mask = write_image("image_mask.nii.gz", box_mask)
+    case = read_cropped_case(image, mask, 1)
+    assert case.crop.start == (2, 3, 4)
+    assert case.crop.full_shape == box_mask.shape
+    np.testing.assert_array_equal(case.image, array[2:10, 3:15, 4:16])
+    np.testing.assert_array_equal(case.mask, box_mask[2:10, 3:15, 4:16])
+
+
+def test_read_cropped_case_without_mask_is_read_in_full(write_image, box_mask):
+    image = write_image("image.nrrd", image_array(box_mask.shape))
+    case = read_cropped_case(image, "", 1)
+    assert case.crop is None
+    assert case.image.shape == box_mask.shape
+    empty = write_image("empty_mask.nii.gz", np.zeros_like(box_mask))
+    assert read_cropped_case(image, empty, 1).crop is None
+
+
+def test_uncrop_round_trip(write_image, box_mask):
+    image = write_image("image.nrrd", image_array(box_mask.shape), origin=(1.0, 2.0, 3.0))
+    mask = write_image("image_mask.nii.gz", box_mask, origin=(1.0, 2.0, 3.0))
+    case = read_cropped_case(image, mask, 1)
+    full, geometry = uncrop(case.mask, case.mask_geometry, case.crop)
+    np.testing.assert_array_equal(full, box_mask)
+    assert geometry == case.crop.full_geometry
+
+    edited = case.mask.copy()
+    edited[edited == 2] = 0
+    saved = {}
+    save_uncropped(lambda m, g, name: saved.update({name: (m, g)}), edited, case.mask_geometry, case.crop, mask, "edit")
+    expected = box_mask.copy()
+    expected[expected == 2] = 0
+    np.testing.assert_array_equal(saved["edit"][0], expected)
+
+
+def test_uncrop_without_base_mask_fills_zeros(write_image, box_mask):
+    image = write_image("image.nrrd", image_array(box_mask.shape))
+    mask = write_image("image_mask.nii.gz", box_mask)
+    case = read_cropped_case(image, mask, 0)
+    full, _ = uncrop(case.mask, case.mask_geometry, case.crop, base_path="")
+    np.testing.assert_array_equal(full, box_mask)
+
+
+def test_uncrop_pastes_into_the_latest_revision(tmp_path, write_image, box_mask):
+    image = write_image("image.nrrd", image_array(box_mask.shape))
+    mask = write_image("image_mask.nii.gz", box_mask)
+    revisions = revisions_directory(str(tmp_path), mask, image)
+    # the revision removes label 2 and adds a voxel in a corner, which grows the cropped region
+    revised = box_mask.copy()
+    revised[revised == 2] = 0
+    revised[0, 0, 0] = 3
+    save_revision(revised, read_image(mask)[1], revisions, mask, image)
+    case = read_cropped_case(image, mask, 0, dataset_directory=str(tmp_path))
+    np.testing.assert_array_equal(case.mask, revised[0:9, 0:12, 0:15])
+    full, _ = uncrop(case.mask, case.mask_geometry, case.crop, revisions=revisions)
+    np.testing.assert_array_equal(full, revised)
+
+
+def test_prefetcher_reads_regions_in_crop_mode(write_image, box_mask):
+    array = image_array(box_mask.shape)
+    image = write_image("image.nrrd", array)
+    mask = write_image("image_mask.nii.gz", box_mask)
+    prefetcher = CasePrefetcher(depth=1, workers=1, crop_margin_mm=1)
+    try:
+        prefetcher.schedule([(0, image, mask)])
+        case = prefetcher.take(0)
+        assert case.crop is not None and case.crop.start == (2, 3, 4)
+        np.testing.assert_array_equal(case.image, array[2:10, 3:15, 4:16])
+        prefetcher.crop_margin_mm = 0
+        prefetcher.schedule([(1, image, mask)])
+        case = prefetcher.take(1)
+        assert case.crop is None and case.image.shape == box_mask.shape
+    finally:
+        prefetcher.shutdown()
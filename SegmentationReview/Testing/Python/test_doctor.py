@@ -0,0 +1,69 @@
+import os
+import shutil
+
+import numpy as np
+
+from SegmentationReviewLib.doctor import DOCTOR_FILENAME, DatasetDoctor, check_case, check_file_encoding, read_report
+
+
+def test_check_file_encoding(write_image, box_mask, tmp_path):
+    assert check_file_encoding(write_image("a.nii.gz", box_mask)) == (False, False, "")
+    assert check_file_encoding(write_image("a.nrrd", box_mask)) == (False, False, "")
+    plain = write_image("plain.nii", box_mask)
+    renamed = str(tmp_path / "plain_renamed.nii.gz")
+    shutil.copy(plain, renamed)
+    assert check_file_encoding(renamed)[:2] == (True, False)
+    compressed = str(tmp_path / "compressed.nii")
+    shutil.copy(write_image("b.nii.gz", box_mask), compressed)
+    assert check_file_encoding(compressed)[:2] == (True, False)
+
+
+def test_check_file_encoding_finds_truncated_gzip(write_image, tmp_path):
+    # random voxels, so that the stream does not compress to a few bytes
+    path = write_image("noise.nii.gz", np.random.default_rng(0).integers(0, 255, (20, 20, 20), dtype=np.uint8))
+    with open(path, "rb") as file:
+        data = file.read()
+    truncated = str(tmp_path / "truncated.nii.gz")
+    with open(truncated, "wb") as file:
+        file.write(data[:len(data) // 2])
+    bad_extension, corrupt_gzip, message = check_file_encoding(truncated)
+    assert not bad_extension and corrupt_gzip
+    assert "truncated" in message
+
+
+def test_check_case_flags(write_image, box_mask):
+    image = write_image("image.nii.gz", box_mask.astype(np.int16), spacing=(1.0, 1.0, 2.0))
+    row = check_case(image, write_image("ok_mask.nii.gz", box_mask, spacing=(1.0, 1.0, 2.0)))
+    assert row["issues"] == "" and row["img_dims"] == "20x16x12"
+
+    row = check_case(image, write_image("float_mask.nii.gz", box_mask.astype(np.float32), spacing=(1.0, 1.0, 2.0)))
+    assert row["non_integer_labels"] and row["mask_pixel_type"] == "32-bit float"
+
+    row = check_case(image, write_image("other_mask.nii.gz", box_mask[:, :, :10], origin=(5.0, 0.0, 0.0)))
+    assert row["size_mismatch"] and row["spacing_mismatch"] and row["origin_mismatch"]
+    assert not row["direction_mismatch"] and not row["non_integer_labels"]
+
+
+def test_check_case_unreadable_files(write_image, box_mask, tmp_path):
+    image = write_image("image.nii.gz", box_mask)
+    row = check_case(image, str(tmp_path / "missing_mask.nii.gz"))
+    assert row["unreadable_mask"] and not row["unreadable_image"]
+    broken = str(tmp_path / "broken.nrrd")
+    with open(broken, "wb") as file:
+        file.write(b"NRRD0004\nnot a header")
+    row = check_case(broken, "")
+    assert row["unreadable_image"] and row["issues"].startswith("image header cannot be read")
+
+
+def test_dataset_doctor_writes_the_report(write_image, box_mask, tmp_path):
+    cases = [(write_image(f"case{i}.nii.gz", box_mask), write_image(f"case{i}_mask.nii.gz", box_mask.astype(dtype)))
+             for i, dtype in enumerate([np.uint8, np.float64, np.int16])]
+    doctor = DatasetDoctor(str(tmp_path), cases, workers=1, chunk_size=2).start()
+    assert doctor.wait(60) and doctor.progress == (3, 3)
+    report = read_report(os.path.join(str(tmp_path), DOCTOR_FILENAME))
+    assert report["img_path"].tolist() == [image for image, _ in cases]
+    assert report["non_integer_labels"].tolist() == [False, True, False]
+    assert doctor.issues(cases[0][0]) == []
+    assert doctor.issues(cases[1][0]) == ["mask voxels are 64-bit float, not integer labels"]
+    assert doctor.unloadable_masks() == []
+    assert "1 of 3 cases with problems" in doctor.summary()
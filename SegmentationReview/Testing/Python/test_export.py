@@ -0,0 +1,58 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from SegmentationReviewLib.common import rating_to_str
+from SegmentationReviewLib.export import cohen_kappa, export_annotations, fleiss_kappa, read_latest
+from SegmentationReviewLib.store import CsvAnnotationStore
+
+
+def rate(directory, filename, ratings, metrics=None):
+    store = CsvAnnotationStore(directory, filename)
+    for file, rating in ratings:
+        store.append({"file": file, "annotation": rating_to_str(rating), "comment": "", "mask_path": "",
+                      "mask_status": "No mask found", "metrics": json.dumps(metrics.get(file)) if metrics and file in metrics else ""})
+
+
+def test_cohen_kappa():
+    assert cohen_kappa(np.array([1, 1, 2, 2]), np.array([1, 2, 2, 2])) == pytest.approx(0.5)
+    assert cohen_kappa(np.array([3, 3]), np.array([3, 3])) == 1.0
+    assert np.isnan(cohen_kappa(np.array([], dtype=np.int64), np.array([], dtype=np.int64)))
+
+
+def test_fleiss_kappa():
+    # the example of Fleiss (1971): 10 cases, 14 ratings each
+    counts = np.array([[0, 0, 0, 0, 14], [0, 2, 6, 4, 2], [0, 0, 3, 5, 6], [0, 3, 9, 2, 0], [2, 2, 8, 1, 1],
+                       [7, 7, 0, 0, 0], [3, 2, 6, 3, 0], [2, 5, 3, 2, 2], [6, 5, 2, 1, 0], [0, 2, 2, 3, 7]])
+    assert fleiss_kappa(counts) == pytest.approx(0.210, abs=1e-3)
+    # cases with a single rating are left out
+    assert fleiss_kappa(np.vstack([counts, [[1, 0, 0, 0, 0]]])) == pytest.approx(0.210, abs=1e-3)
+
+
+def test_read_latest_keeps_the_last_rating_across_chunks(tmp_path):
+    directory = str(tmp_path)
+    rate(directory, "annotations.csv", [("a.nii.gz", 1), ("b.nii.gz", 2), ("a.nii.gz", 4)])
+    latest = read_latest({"": os.path.join(directory, "annotations.csv")}, chunksize=1)
+    assert dict(zip(latest["file"], latest["rating"])) == {"a.nii.gz": 4, "b.nii.gz": 2}
+
+
+def test_export_annotations(tmp_path):
+    directory = str(tmp_path)
+    rate(directory, "annotations.alice.csv", [("a.nii.gz", 1), ("b.nii.gz", 2), ("sub/c.nii.gz", 3)],
+         metrics={"a.nii.gz": {"v1": {"dice": 0.75, "per_label": {"1": {"dice": 0.75}}}}})
+    rate(directory, "annotations.bob.csv", [("a.nii.gz", 1), ("b.nii.gz", 3), ("sub/c.nii.gz", 3)])
+    paths = export_annotations(directory, chunksize=2)
+    cases, reviewers, agreement = (pd.read_csv(path, keep_default_na=False, na_values=[""]) for path in paths)
+
+    cases = cases.set_index("file")
+    assert cases.loc["sub/c.nii.gz", "img_path"] == os.path.join(directory, "sub", "c.nii.gz")
+    assert cases.loc["b.nii.gz", "agreement"] == 0.5
+    assert cases.loc["a.nii.gz", "majority_rating"] == 1 and cases.loc["a.nii.gz", "dice_v1"] == 0.75
+    assert reviewers.set_index("reviewer").loc["alice", "n_cases"] == 3
+    kappas = agreement.set_index("statistic")["kappa"]
+    # alice 1,2,3 against bob 1,3,3: observed 2/3, expected 1/3
+    assert kappas["cohen_kappa"] == pytest.approx(0.5)
+    assert agreement.set_index("statistic").loc["fleiss_kappa", "n_cases"] == 3
@@ -0,0 +1,74 @@
+import os
+
+import pandas as pd
+
+from SegmentationReviewLib.common import CANNOT_LOAD_MASK, MASK_LOADED, NO_MASK, joinpath
+from SegmentationReviewLib.ingest import classify_listing, classify_mapping, list_existing
+
+
+def touch(directory, *names):
+    for name in names:
+        path = os.path.join(str(directory), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+
+
+def test_list_existing_lists_each_directory(tmp_path):
+    touch(tmp_path, "a.nii.gz", "sub/b.nii.gz")
+    directory = str(tmp_path) + os.sep
+    existing = list_existing([directory, directory + "sub" + os.sep, directory + "missing" + os.sep])
+    assert joinpath(str(tmp_path), "a.nii.gz") in existing
+    assert joinpath(joinpath(str(tmp_path), "sub"), "b.nii.gz") in existing
+
+
+def test_classify_mapping(tmp_path):
+    touch(tmp_path, "img1.nii.gz", "img1_seg.nii.gz", "sub/img2.nrrd", "img3.nii.gz", "notes.txt")
+    mappings = pd.DataFrame({
+        "img_path": ["img1.nii.gz", "sub/img2.nrrd", "img3.nii.gz", "missing.nii.gz", "notes.txt"],
+        "mask_path": ["img1_seg.nii.gz", None, "img3_seg.nii.gz", "", "img1_seg.nii.gz"],
+    })
+    cases = classify_mapping(mappings, str(tmp_path))
+    assert cases["img_valid"].tolist() == [True, True, True, False, False]
+    assert cases["mask_status"].tolist()[:3] == [MASK_LOADED, NO_MASK, CANNOT_LOAD_MASK]
+    assert cases["img_path"][1] == joinpath(str(tmp_path), "sub/img2.nrrd")
+    # a mask that does not exist is referenced but not loaded
+    assert cases["mask_path"][2] == ""
+    assert cases["mask_ref"][2] == joinpath(str(tmp_path), "img3_seg.nii.gz")
+    assert "subj_id" not in cases
+
+
+def test_classify_mapping_keeps_absolute_paths(tmp_path):
+    touch(tmp_path, "data/img.nii.gz")
+    absolute = os.path.join(str(tmp_path), "data", "img.nii.gz")
+    cases = classify_mapping(pd.DataFrame({"img_path": [absolute], "mask_path": [None]}), os.path.join(str(tmp_path), "other"))
+    assert cases["img_path"][0] == absolute
+    assert cases["img_valid"][0]
+
+
+def test_classify_mapping_numbers_the_subjects(tmp_path):
+    touch(tmp_path, "a1.nii.gz", "a2.nii.gz", "b1.nii.gz")
+    mappings = pd.DataFrame({"subj_id": ["a", "b", "a"], "img_path": ["a1.nii.gz", "b1.nii.gz", "a2.nii.gz"],
+                             "mask_path": [None, None, None]})
+    cases = classify_mapping(mappings, str(tmp_path))
+    assert cases["subj_index"].tolist() == [0, 1, 0]
+    assert cases["subj_case"].tolist() == [0, 0, 1]
+
+
+def test_classify_listing(tmp_path):
+    touch(tmp_path, "a.nii.gz", "a_mask.nii.gz", "b.nii", "readme.md")
+    cases = classify_listing(str(tmp_path)).set_index("img_path")
+    assert sorted(map(os.path.basename, cases.index)) == ["a.nii.gz", "b.nii"]
+    a, b = joinpath(str(tmp_path), "a.nii.gz"), joinpath(str(tmp_path), "b.nii")
+    assert cases.loc[a, "mask_status"] == MASK_LOADED
+    assert cases.loc[a, "mask_path"] == joinpath(str(tmp_path), "a_mask.nii.gz")
+    assert cases.loc[b, "mask_status"] == NO_MASK
+    assert cases.loc[b, "mask_path"] == ""
+
+
+def test_classify_mapping_accepts_the_alternate_separator(tmp_path, monkeypatch):
+    # as "/" in a mapping file on Windows: "\\" stands in for the separator that is not os.sep
+    monkeypatch.setattr(os, "altsep", "\\")
+    touch(tmp_path, "sub/img.nii.gz", "sub/img_seg.nii.gz")
+    cases = classify_mapping(pd.DataFrame({"img_path": ["sub\\img.nii.gz"], "mask_path": ["sub\\img_seg.nii.gz"]}), str(tmp_path))
+    assert cases["img_valid"][0]
+    assert cases["mask_status"][0] == MASK_LOADED
@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pytest
+
+from SegmentationReviewLib.mask_writer import MaskWriter, save_mask, write_mask
+from SegmentationReviewLib.prefetch import read_image
+
+GEOMETRY = {"spacing": (0.5, 1.0, 2.0), "origin": (1.0, 2.0, 3.0), "direction": (1, 0, 0, 0, 1, 0, 0, 0, 1)}
+
+
+@pytest.mark.parametrize("name, level", [("mask.nii.gz", 1), ("mask.nii.gz", 0), ("mask.nrrd", 1), ("mask.nii", 0)])
+def test_write_mask(tmp_path, box_mask, name, level):
+    path = str(tmp_path / name)
+    write_mask(box_mask, GEOMETRY, path, level)
+    array, geometry = read_image(path)
+    np.testing.assert_array_equal(array, box_mask)
+    np.testing.assert_allclose(geometry["spacing"], GEOMETRY["spacing"])
+    np.testing.assert_allclose(geometry["origin"], GEOMETRY["origin"])
+    # no temporary file is left
+    assert os.listdir(str(tmp_path)) == [name]
+
+
+def test_save_mask_moves_the_previous_mask(tmp_path, box_mask, write_image):
+    previous = write_image("image_mask.nii.gz", box_mask)
+    path = str(tmp_path / "image_edited_mask.nii.gz")
+    backup = str(tmp_path / "backup" / "image_mask.nii.gz")
+    assert save_mask(box_mask * 2, GEOMETRY, path, previous, backup) == path
+    assert not os.path.exists(previous)
+    np.testing.assert_array_equal(read_image(backup)[0], box_mask)
+    np.testing.assert_array_equal(read_image(path)[0], box_mask * 2)
+
+
+def test_mask_writer_saves_in_order(tmp_path, box_mask):
+    writer = MaskWriter(compression_level=1)
+    path = str(tmp_path / "mask.nii.gz")
+    order = []
+    try:
+        first = writer.submit(box_mask, GEOMETRY, path)
+        writer.run(order.append, "second")
+        last = writer.submit(box_mask * 3, GEOMETRY, path)
+    finally:
+        writer.shutdown()
+    assert first.result() == last.result() == path
+    assert order == ["second"]
+    np.testing.assert_array_equal(read_image(path)[0], box_mask * 3)
@@ -0,0 +1,84 @@
+import time
+
+import numpy as np
+
+from SegmentationReviewLib.prefetch import CasePrefetcher, geometry_from_ijk_to_ras, ijk_to_ras, read_case, read_image
+
+
+def test_read_image_returns_kji_array_and_geometry(write_image, box_mask):
+    path = write_image("mask.nii.gz", box_mask, spacing=(0.5, 1.0, 2.0), origin=(1.0, 2.0, 3.0))
+    array, geometry = read_image(path)
+    assert array.shape == box_mask.shape
+    np.testing.assert_array_equal(array, box_mask)
+    assert geometry["spacing"] == (0.5, 1.0, 2.0)
+    assert geometry["origin"] == (1.0, 2.0, 3.0)
+
+
+def test_ijk_to_ras_round_trip():
+    geometry = {"spacing": (0.5, 1.0, 2.0), "origin": (1.0, 2.0, 3.0), "direction": (0, 1, 0, -1, 0, 0, 0, 0, 1)}
+    matrix = ijk_to_ras(geometry)
+    # LPS to RAS flips the first two axes
+    np.testing.assert_allclose(matrix[:3, 3], [-1.0, -2.0, 3.0])
+    back = geometry_from_ijk_to_ras(matrix)
+    for key in ("spacing", "origin", "direction"):
+        np.testing.assert_allclose(back[key], geometry[key], atol=1e-12)
+
+
+def test_read_case_with_missing_mask(write_image, box_mask):
+    image_path = write_image("image.nii.gz", box_mask.astype(np.float32))
+    case = read_case(image_path, image_path.replace("image", "missing"))
+    assert case.mask is None
+    assert case.image.shape == box_mask.shape
+    assert case.nbytes == case.image.nbytes
+
+
+def test_prefetcher_reads_ahead_and_hands_over(write_image, box_mask):
+    paths = [(write_image(f"image{i}.nii.gz", box_mask.astype(np.int16)), write_image(f"image{i}_mask.nii.gz", box_mask))
+             for i in range(3)]
+    prefetcher = CasePrefetcher(depth=2, workers=2)
+    try:
+        prefetcher.schedule((index, image, mask) for index, (image, mask) in enumerate(paths))
+        assert prefetcher.scheduled(0) and prefetcher.scheduled(1)
+        # beyond the prefetch depth
+        assert not prefetcher.scheduled(2)
+        case = prefetcher.take(1)
+        assert case.image_path == paths[1][0]
+        np.testing.assert_array_equal(case.mask, box_mask)
+        # handed over once only
+        assert prefetcher.take(1) is None
+        prefetcher.cancel()
+        assert not prefetcher.scheduled(0)
+        assert prefetcher.take(0) is None
+    finally:
+        prefetcher.shutdown()
+
+
+def test_prefetcher_drops_cases_that_are_no_longer_needed(write_image, box_mask):
+    image, mask = write_image("image.nii.gz", box_mask), write_image("image_mask.nii.gz", box_mask)
+    prefetcher = CasePrefetcher(depth=1, workers=1)
+    try:
+        prefetcher.schedule([(0, image, mask)])
+        prefetcher.schedule([(1, image, mask)])
+        assert not prefetcher.scheduled(0)
+        assert prefetcher.take(1) is not None
+    finally:
+        prefetcher.shutdown()
+
+
+def test_prefetcher_memory_budget(write_image, box_mask):
+    image, mask = write_image("image.nii.gz", box_mask), write_image("image_mask.nii.gz", box_mask)
+    prefetcher = CasePrefetcher(depth=4, max_bytes=0, workers=1)
+    try:
+        prefetcher.schedule([(0, image, mask)])
+        deadline = time.monotonic() + 10
+        # over budget once read: the case is dropped again
+        while prefetcher.scheduled(0) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not prefetcher.scheduled(0)
+        assert prefetcher.resident_bytes == 0
+        assert prefetcher.take(0) is None
+        # the size of the last case read now keeps further cases from being scheduled
+        prefetcher.schedule([(1, image, mask)])
+        assert not prefetcher.scheduled(1)
+    finally:
+        prefetcher.shutdown()
@@ -0,0 +1,41 @@
+import numpy as np
+
+from SegmentationReviewLib.prefetch import read_case
+from SegmentationReviewLib.preview import PREVIEW_DIRECTORY, PreviewCache, downsample
+
+
+def test_downsample_picks_voxels(box_mask):
+    geometry = {"spacing": (0.5, 1.0, 2.0), "origin": (1.0, 2.0, 3.0), "direction": (1, 0, 0, 0, 1, 0, 0, 0, 1)}
+    preview, preview_geometry = downsample(box_mask, geometry, 4)
+    assert preview.shape == (3, 4, 5)
+    assert preview.flags.c_contiguous
+    np.testing.assert_array_equal(preview, box_mask[::4, ::4, ::4])
+    # label values are kept, not averaged
+    assert set(np.unique(preview)) <= {0, 1, 2}
+    assert preview_geometry["spacing"] == [2.0, 4.0, 8.0]
+    assert preview_geometry["origin"] == [1.0, 2.0, 3.0]
+
+
+def test_preview_cache_stores_cases_read_at_full_resolution(write_image, box_mask, tmp_path):
+    image = write_image("image.nii.gz", box_mask.astype(np.int16))
+    mask = write_image("image_mask.nii.gz", box_mask)
+    previews = PreviewCache(str(tmp_path), factor=2)
+    assert previews.directory.rstrip("/").endswith(PREVIEW_DIRECTORY)
+    assert previews.read_case(image, mask) is None
+    read_case(image, mask, preview_cache=previews)
+    case = previews.read_case(image, mask)
+    assert case.downsampling == 2
+    assert case.image.shape == case.mask.shape == (6, 8, 10)
+    np.testing.assert_array_equal(case.mask, box_mask[::2, ::2, ::2])
+    assert list(case.image_geometry["spacing"]) == [2.0, 2.0, 2.0]
+    # another factor has its own previews
+    assert PreviewCache(str(tmp_path), factor=4).read_case(image, mask) is None
+
+
+def test_preview_cache_needs_the_mask_preview(write_image, box_mask, tmp_path):
+    image = write_image("image.nii.gz", box_mask)
+    mask = write_image("image_mask.nii.gz", box_mask)
+    previews = PreviewCache(str(tmp_path))
+    read_case(image, "", preview_cache=previews)
+    assert previews.read_case(image, "").mask is None
+    assert previews.read_case(image, mask) is None
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+
+from SegmentationReviewLib.qa import QA_METRICS_FILENAME, QualityPrePass, case_metrics, read_metrics
+
+
+def test_case_metrics(write_image, box_mask):
+    image = write_image("a.nii.gz", box_mask.astype(np.int16), spacing=(1.0, 1.0, 2.0))
+    mask = write_image("a_mask.nii.gz", box_mask, spacing=(1.0, 1.0, 2.0))
+    row = case_metrics(image, mask)
+    assert row["n_labels"] == 2 and not row["empty_mask"] and row["geometry_match"]
+    assert row["labels"] == [1, 2]
+    assert row["volumes_mm3"] == [480 * 2.0, 120 * 2.0]
+    assert row["bbox_min_ijk"] == [[5, 4, 3], [5, 12, 3]]
+
+
+def test_case_metrics_flags(write_image, box_mask, tmp_path):
+    image = write_image("a.nii.gz", box_mask)
+    assert case_metrics(image, write_image("empty.nii.gz", np.zeros_like(box_mask)))["empty_mask"]
+    assert not case_metrics(image, write_image("shifted.nii.gz", box_mask, origin=(5, 0, 0)))["geometry_match"]
+    broken = str(tmp_path / "broken.nii.gz")
+    with open(broken, "wb") as f:
+        f.write(b"not an image")
+    row = case_metrics(image, broken)
+    assert row["mask_load_failed"] and row["error"].startswith("mask:")
+    assert case_metrics(str(tmp_path / "missing.nii.gz"), "")["image_load_failed"]
+
+
+def test_quality_pre_pass_writes_and_reuses_metrics(write_image, box_mask, tmp_path):
+    cases = [(write_image(f"case{i}.nii.gz", box_mask), write_image(f"case{i}_mask.nii.gz", box_mask * (i % 2)))
+             for i in range(3)]
+    qa = QualityPrePass(str(tmp_path), cases, workers=1, chunk_size=2).start()
+    assert qa.wait(60) and qa.progress == (3, 3)
+    table = read_metrics(os.path.join(str(tmp_path), QA_METRICS_FILENAME))
+    assert sorted(table["empty_mask"].tolist()) == [False, True, True]
+    assert qa.issues(cases[0][0]) == ["empty mask"]
+    statistics = qa.statistics(*cases[1])
+    assert statistics.labels.tolist() == [1, 2]
+    np.testing.assert_allclose(statistics.centroids_ijk[0], [9.5, 7.5, 5.5])
+
+    # a changed mask is computed again, the other rows are reused from the file
+    write_image("case0_mask.nii.gz", box_mask)
+    stat = os.stat(cases[0][1])
+    os.utime(cases[0][1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert qa.statistics(*cases[0]) is None
+    qa = QualityPrePass(str(tmp_path), cases, workers=1).start()
+    assert qa.wait(60)
+    assert qa.issues(cases[0][0]) == []
+    assert qa.row(cases[2][0])["empty_mask"]
@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import numpy as np
+
+from SegmentationReviewLib.prefetch import read_case, read_image
+from SegmentationReviewLib.resample import RESAMPLE_DIRECTORY, ResampleCache, ResamplePass, resample_mask, same_grid
+
+
+def coarse_mask():
+    """A mask at twice the spacing of box_mask, covering its label 1 box."""
+    mask = np.zeros((6, 8, 10), dtype=np.uint8)
+    mask[1:4, 2:6, 2:7] = 1
+    return mask
+
+
+def test_same_grid():
+    geometry = {"spacing": (1.0, 1.0, 1.0), "origin": (0.0, 0.0, 0.0), "direction": (1, 0, 0, 0, 1, 0, 0, 0, 1)}
+    assert same_grid((2, 3, 4), geometry, (2, 3, 4), dict(geometry, origin=(0.0, 0.0, 1e-6)))
+    assert not same_grid((2, 3, 4), geometry, (2, 3, 5), geometry)
+    assert not same_grid((2, 3, 4), geometry, (2, 3, 4), dict(geometry, spacing=(1.0, 1.0, 2.0)))
+
+
+def test_resample_mask_keeps_labels():
+    identity = (1, 0, 0, 0, 1, 0, 0, 0, 1)
+    coarse = {"spacing": (2.0, 2.0, 2.0), "origin": (0.0, 0.0, 0.0), "direction": identity}
+    fine = {"spacing": (1.0, 1.0, 1.0), "origin": (0.0, 0.0, 0.0), "direction": identity}
+    resampled, geometry = resample_mask(coarse_mask() * 3, coarse, (12, 16, 20), fine)
+    assert resampled.shape == (12, 16, 20)
+    assert set(np.unique(resampled)) == {0, 3}
+    assert geometry["spacing"] == (1.0, 1.0, 1.0)
+    # nearest neighbour: each coarse voxel covers 2x2x2 fine voxels, from one voxel before to one after its center
+    assert resampled[2:7, 4:11, 4:13].all()
+    assert not resampled[8:].any()
+
+
+def test_resample_cache_resamples_once(write_image, box_mask, tmp_path):
+    image = write_image("image.nii.gz", box_mask)
+    mask = write_image("image_mask.nii.gz", coarse_mask(), spacing=(2.0, 2.0, 2.0))
+    cache = ResampleCache(str(tmp_path))
+    assert cache.directory == os.path.join(str(tmp_path), RESAMPLE_DIRECTORY)
+    shape, geometry = read_image(image)[0].shape, read_image(image)[1]
+    first, first_geometry = cache.read(mask, shape, geometry)
+    assert first.shape == box_mask.shape and same_grid(first.shape, first_geometry, shape, geometry)
+    assert cache.total_bytes > 0
+    # a copy of the mask has the same content: it is read from the cache
+    copy = str(tmp_path / "copy_mask.nii.gz")
+    shutil.copy(mask, copy)
+    second, _ = cache.read(copy, shape, geometry)
+    assert isinstance(second, np.memmap)
+    np.testing.assert_array_equal(second, first)
+    assert cache.prepare(image, copy)
+    # a mask on the grid of its image is not cached
+    assert not cache.prepare(image, image)
+
+
+def test_read_case_resamples_the_mask(write_image, box_mask, tmp_path):
+    image = write_image("image.nii.gz", box_mask.astype(np.int16))
+    mask = write_image("image_mask.nii.gz", coarse_mask().astype(np.float32), spacing=(2.0, 2.0, 2.0))
+    case = read_case(image, mask, resample_cache=ResampleCache(str(tmp_path)))
+    assert case.mask.shape == box_mask.shape and np.issubdtype(case.mask.dtype, np.integer)
+    assert same_grid(case.mask.shape, case.mask_geometry, case.image.shape, case.image_geometry)
+
+
+def test_resample_pass_fills_the_cache(write_image, box_mask, tmp_path):
+    cases = [(write_image(f"case{i}.nii.gz", box_mask), write_image(f"case{i}_mask.nii.gz", coarse_mask() * i, spacing=(2.0, 2.0, 2.0)))
+             for i in (1, 2)]
+    # on the grid of its image, and without mask
+    cases.append((write_image("case0.nii.gz", box_mask), write_image("case0_mask.nii.gz", box_mask)))
+    cases.append((write_image("case3.nii.gz", box_mask), ""))
+    cache = ResampleCache(str(tmp_path))
+    resample = ResamplePass(cache, cases, workers=1, chunk_size=2).start()
+    assert resample.wait(60)
+    assert resample.n_done == 4 and resample.n_resampled == 2
+    # the masks resampled in the background are found when the case is read, nothing is added to the cache
+    total_bytes = cache.total_bytes
+    loaded = read_case(*cases[1], resample_cache=cache)
+    assert cache.total_bytes == total_bytes
+    np.testing.assert_array_equal(loaded.mask[2:7, 4:11, 4:13], 2)
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pytest
+
+from SegmentationReviewLib.crop import read_cropped_case, uncrop
+from SegmentationReviewLib.prefetch import read_case, read_image
+from SegmentationReviewLib.revisions import (REVISIONS_DIRECTORY, MaskRevisions, compact_dataset, read_latest_revision,
+                                             revisions_directory, save_edit)
+
+GEOMETRY = {"spacing": (1.0, 1.0, 1.0), "origin": (0.0, 0.0, 0.0), "direction": (1, 0, 0, 0, 1, 0, 0, 0, 1)}
+
+
+def test_revisions_store_the_changed_region(tmp_path, write_image, box_mask):
+    base = write_image("image_mask.nii.gz", box_mask)
+    revisions = MaskRevisions(str(tmp_path / "revisions"), base)
+    first = box_mask.copy()
+    first[0, 0, 0] = 3
+    second = box_mask.copy()
+    second[3:9, 12:14, 5:15] = 0
+    assert revisions.add(first, GEOMETRY) == 1
+    assert revisions.add(second, GEOMETRY) == 2
+    assert revisions.manifest["revisions"][0]["box_voxels"] == 1
+    np.testing.assert_array_equal(revisions.reconstruct(1)[0], first)
+    np.testing.assert_array_equal(revisions.reconstruct()[0], second)
+    # reopened from the manifest
+    assert len(MaskRevisions(str(tmp_path / "revisions"))) == 2
+    with pytest.raises(ValueError):
+        revisions.add(box_mask[:-1], GEOMETRY)
+
+
+def test_revisions_directory_is_keyed_by_the_relative_mask_path(tmp_path):
+    dataset = str(tmp_path)
+    root = os.path.join(dataset, REVISIONS_DIRECTORY)
+    folders = {revisions_directory(dataset, os.path.join(dataset, path), os.path.join(dataset, "image.nii.gz"))
+               for path in ("a.v1.nii.gz", "a.v2.nii.gz", "sub1/a.nii.gz", "sub2/a.nii.gz")}
+    assert len(folders) == 4
+    assert revisions_directory(dataset, os.path.join(dataset, "sub1", "a.nii.gz")) == os.path.join(root, "sub1", "a.nii.gz")
+    # a case without mask is keyed by its image
+    assert revisions_directory(dataset, "", os.path.join(dataset, "sub1", "b.nii.gz")) == os.path.join(root, "sub1", "b.nii.gz")
+    outside = revisions_directory(os.path.join(dataset, "data"), os.path.join(dataset, "masks", "a.nii.gz"))
+    assert outside.startswith(os.path.join(dataset, "data", REVISIONS_DIRECTORY, "external"))
+
+
+def test_cases_are_read_from_their_latest_revision(tmp_path, write_image, box_mask):
+    dataset = str(tmp_path)
+    image = write_image("sub1/a.nii.gz", box_mask.astype(np.int16))
+    mask = write_image("sub1/a_mask.nii.gz", box_mask)
+    other_mask = write_image("sub2/a_mask.nii.gz", box_mask)
+    edited = box_mask.copy()
+    edited[edited == 2] = 0
+    directory = revisions_directory(dataset, mask, image)
+    save_edit(edited, GEOMETRY, directory, mask, os.path.join(dataset, "fallback.nii.gz"), image_path=image)
+
+    np.testing.assert_array_equal(read_latest_revision(dataset, mask, image)[0], edited)
+    assert read_latest_revision(dataset, other_mask) is None
+    np.testing.assert_array_equal(read_case(image, mask, dataset_directory=dataset).mask, edited)
+    # without the dataset directory, or for the mask of the same name elsewhere, the mask file is read
+    np.testing.assert_array_equal(read_case(image, mask).mask, box_mask)
+    np.testing.assert_array_equal(read_case(image, other_mask, dataset_directory=dataset).mask, box_mask)
+    cropped = read_cropped_case(image, mask, 0, dataset_directory=dataset)
+    assert cropped.mask.max() == 1 and cropped.mask.shape == (6, 8, 10)
+    # the original mask is left in place
+    np.testing.assert_array_equal(read_image(mask)[0], box_mask)
+
+
+def test_save_edit_falls_back_to_a_full_mask(tmp_path, write_image, box_mask):
+    mask = write_image("a_mask.nii.gz", box_mask)
+    fallback = str(tmp_path / "a_edited_mask.nii.gz")
+    saved = save_edit(box_mask[1:], GEOMETRY, revisions_directory(str(tmp_path), mask), mask, fallback,
+                      str(tmp_path / "backup" / "a_mask.nii.gz"))
+    assert saved == fallback
+    np.testing.assert_array_equal(read_image(fallback)[0], box_mask[1:])
+
+
+def test_uncrop_pastes_into_the_latest_revision(tmp_path, write_image, box_mask):
+    dataset = str(tmp_path)
+    image = write_image("a.nii.gz", box_mask.astype(np.int16))
+    mask = write_image("a_mask.nii.gz", box_mask)
+    directory = revisions_directory(dataset, mask, image)
+    # the first edit removes label 2, so the case is cropped to label 1
+    edited = np.where(box_mask == 2, 0, box_mask).astype(np.uint8)
+    save_edit(edited, GEOMETRY, directory, mask, "", image_path=image)
+    case = read_cropped_case(image, mask, 0, dataset_directory=dataset)
+    assert case.crop.start == (3, 4, 5)
+    full, _ = uncrop(np.full_like(case.mask, 3), case.mask_geometry, case.crop, mask, revisions=directory)
+    assert (full[3:9, 4:12, 5:15] == 3).all()
+    # outside of the region the voxels come from the latest revision, not from the original mask
+    assert not full[3:9, 12:14, 5:15].any()
+
+
+def test_compact_dataset_writes_next_to_the_image(tmp_path, write_image, box_mask):
+    dataset = str(tmp_path)
+    image = write_image("sub1/a.v1.nii.gz", box_mask.astype(np.int16))
+    mask = write_image("sub1/a.v1_mask.nii.gz", box_mask)
+    edited = box_mask * 2
+    save_edit(edited, GEOMETRY, revisions_directory(dataset, mask, image), mask, "", image_path=image)
+    # revisions stored before the image was recorded, in a folder named after the image
+    legacy = MaskRevisions(os.path.join(dataset, REVISIONS_DIRECTORY, "b"))
+    legacy.add(box_mask, GEOMETRY)
+    del legacy.manifest["image"]
+    legacy._write_manifest()
+
+    written = compact_dataset(dataset)
+    assert sorted(written) == [os.path.join(dataset, "b_edited_mask.nii.gz"),
+                               os.path.join(dataset, "sub1", "a.v1_edited_mask.nii.gz")]
+    np.testing.assert_array_equal(read_image(os.path.join(dataset, "sub1", "a.v1_edited_mask.nii.gz"))[0], edited)
+    assert read_latest_revision(dataset, mask, image) is None
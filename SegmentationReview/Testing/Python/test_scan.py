@@ -0,0 +1,86 @@
+import os
+
+from SegmentationReviewLib.common import MASK_LOADED, NO_MASK
+from SegmentationReviewLib.scan import DEFAULT_MASK_PATTERNS, DirectoryScanner, pair_masks, parse_mask_patterns
+from SegmentationReviewLib.session import ReviewSession
+from SegmentationReviewLib.store import read_annotation_csv
+
+
+def touch(directory, *names):
+    for name in names:
+        path = os.path.join(str(directory), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+
+
+def test_parse_mask_patterns():
+    assert parse_mask_patterns(" {stem}_seg.nii.gz, {stem}-*.nrrd ,") == ("{stem}_seg.nii.gz", "{stem}-*.nrrd")
+    assert parse_mask_patterns("") == DEFAULT_MASK_PATTERNS
+
+
+def test_pair_masks():
+    names = ["b.nii.gz", "a.nii", "a_mask.nii", "b_mask.nii.gz", "c.nrrd", "notes.txt"]
+    assert pair_masks(names) == [("a.nii", "a_mask.nii"), ("b.nii.gz", "b_mask.nii.gz"), ("c.nrrd", "")]
+    # wildcards: the first match in name order wins
+    names = ["t1.nii.gz", "t1-label-2.nii.gz", "t1-label-1.nii.gz"]
+    assert pair_masks(names, ("{stem}-label-*.nii.gz",)) == [("t1.nii.gz", "t1-label-1.nii.gz")]
+
+
+def test_directory_scanner_walks_subfolders(tmp_path):
+    touch(tmp_path, "a.nii.gz", "a_mask.nii.gz", "sub1/b.nii.gz", "sub1/deeper/c.nrrd", ".hidden/d.nii.gz")
+    scanner = DirectoryScanner(str(tmp_path), workers=2).start()
+    assert scanner.wait(10)
+    cases = sorted(scanner.poll())
+    assert cases == [(os.path.join(str(tmp_path), "a.nii.gz"), os.path.join(str(tmp_path), "a_mask.nii.gz"), MASK_LOADED),
+                     (os.path.join(str(tmp_path), "sub1", "b.nii.gz"), "", NO_MASK),
+                     (os.path.join(str(tmp_path), "sub1", "deeper", "c.nrrd"), "", NO_MASK)]
+    assert scanner.n_listed == 3 and not scanner.unreadable
+
+
+def open_recursive(directory):
+    session = ReviewSession(use_case_index=False, recursive=True).open(str(directory))
+    session.wait_for_scan()
+    return session
+
+
+def test_recursive_session_resumes_nested_cases(tmp_path):
+    touch(tmp_path, "a.nii.gz", "sub1/sub1_img.nii.gz", "sub1/sub1_img_mask.nii.gz", "sub2/sub1_img.nii.gz",
+          "sub2/x/c.nii.gz")
+    session = open_recursive(tmp_path)
+    try:
+        assert session.n_files == 4
+        rated = []
+        for _ in range(3):
+            rated.append(session.nifti_files[session.current_index])
+            session.record_rating(2)
+            session.advance()
+    finally:
+        session.close()
+    annotations = read_annotation_csv(os.path.join(str(tmp_path), "annotations.csv"))
+    names = [os.path.relpath(path, str(tmp_path)).replace(os.sep, "/") for path in rated]
+    assert annotations["file"].tolist() == names
+    if "sub1/sub1_img.nii.gz" in names:
+        assert annotations.loc[names.index("sub1/sub1_img.nii.gz"), "mask_path"] == "sub1/sub1_img_mask.nii.gz"
+
+    session = open_recursive(tmp_path)
+    try:
+        # only the case that was not rated comes back
+        assert session.n_files == 1
+        assert session.nifti_files[0] not in rated
+    finally:
+        session.close()
+
+
+def test_recursive_session_reads_file_name_only_annotations(tmp_path):
+    touch(tmp_path, "a.nii.gz", "sub1/b.nii.gz", "sub2/a.nii.gz", "sub2/c.nii.gz")
+    # annotations written before relative paths were stored
+    with open(os.path.join(str(tmp_path), "annotations.csv"), "w") as f:
+        f.write("a.nii.gz,Bad images,,,No mask\n")
+        f.write("b.nii.gz,Bad images,,,No mask\n")
+    session = open_recursive(tmp_path)
+    try:
+        # a.nii.gz in the dataset directory owns the a.nii.gz row; sub2/a.nii.gz is still to review
+        remaining = sorted(os.path.relpath(path, str(tmp_path)) for path in session.nifti_files)
+        assert remaining == [os.path.join("sub2", "a.nii.gz"), os.path.join("sub2", "c.nii.gz")]
+    finally:
+        session.close()
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from SegmentationReviewLib.common import CANNOT_LOAD_MASK, MASK_LOADED, NO_MASK
+from SegmentationReviewLib.scheduler import PriorityScheduler, sequential
+from SegmentationReviewLib.session import ReviewSession
+
+
+def test_sequential_keeps_the_discovery_order():
+    assert sequential(pd.DataFrame({"mask_status": [2, 0, 1]})).tolist() == [0, 1, 2]
+
+
+def test_priority_tiers_and_volume_outliers():
+    signals = pd.DataFrame({
+        "mask_status": [MASK_LOADED, MASK_LOADED, NO_MASK, MASK_LOADED, CANNOT_LOAD_MASK, MASK_LOADED, MASK_LOADED],
+        "empty_mask": [False, True, None, False, None, False, None],
+        "volume_mm3": [100.0, 0.0, np.nan, 1000.0, np.nan, 10.0, np.nan],
+    })
+    # missing masks first, then empty masks, then by distance to the median volume; ties in discovery order
+    assert PriorityScheduler()(signals).tolist() == [2, 4, 1, 3, 5, 0, 6]
+
+
+def test_priority_uncertainty_column_wins_over_volume():
+    signals = pd.DataFrame({"mask_status": [MASK_LOADED] * 4, "volume_mm3": [1.0, 100.0, 10.0, 1000.0],
+                            "score": [0.1, np.nan, 0.9, 0.5]})
+    assert PriorityScheduler("score")(signals).tolist() == [2, 3, 0, 1]
+
+
+def test_priority_non_numeric_uncertainty_ranks_as_unknown():
+    signals = pd.DataFrame({"mask_status": [MASK_LOADED] * 4, "score": ["0.1", "n/a", "0.9", ""]})
+    assert PriorityScheduler("score")(signals).tolist() == [2, 0, 1, 3]
+    # no number at all: ordered by volume
+    signals = pd.DataFrame({"mask_status": [MASK_LOADED] * 3, "volume_mm3": [10.0, 1000.0, 12.0], "score": ["n/a", "", "?"]})
+    assert PriorityScheduler("score")(signals).tolist() == [1, 0, 2]
+
+
+def test_session_opens_with_a_non_numeric_uncertainty(tmp_path):
+    names = ["a.nii.gz", "b.nii.gz", "c.nii.gz"]
+    for name in names:
+        open(os.path.join(str(tmp_path), name), "w").close()
+    pd.DataFrame({"img_path": names, "mask_path": [None] * 3, "uncertainty": ["0.2", "unknown", "0.5"]}).to_csv(
+        tmp_path / "mapping.csv", index=False)
+    session = ReviewSession(use_case_index=False, scheduler=PriorityScheduler()).open(str(tmp_path))
+    try:
+        assert [os.path.basename(path) for path in session.nifti_files] == ["c.nii.gz", "a.nii.gz", "b.nii.gz"]
+    finally:
+        session.close()
+
+
+def test_session_reviews_in_priority_order(tmp_path):
+    names = ["a.nii.gz", "b.nii.gz", "c.nii.gz", "d.nii.gz"]
+    for name in names:
+        open(os.path.join(str(tmp_path), name), "w").close()
+    pd.DataFrame({"img_path": names, "mask_path": [None] * 4, "uncertainty": [0.2, 0.8, np.nan, 0.5]}).to_csv(
+        tmp_path / "mapping.csv", index=False)
+    session = ReviewSession(use_case_index=False, scheduler=PriorityScheduler()).open(str(tmp_path))
+    try:
+        assert [os.path.basename(path) for path in session.nifti_files] == ["b.nii.gz", "d.nii.gz", "a.nii.gz", "c.nii.gz"]
+        session.record_rating(1)
+    finally:
+        session.close()
+    session = ReviewSession(use_case_index=False, scheduler=PriorityScheduler()).open(str(tmp_path))
+    try:
+        assert [os.path.basename(path) for path in session.nifti_files] == ["d.nii.gz", "a.nii.gz", "c.nii.gz"]
+    finally:
+        session.close()
@@ -0,0 +1,144 @@
+import os
+
+import pandas as pd
+
+from SegmentationReviewLib.common import rating_to_str
+from SegmentationReviewLib.session import ReviewSession
+from SegmentationReviewLib.store import read_annotation_csv
+
+
+def touch(directory, *names):
+    # discovery only looks at names and existence, the files can be empty
+    for name in names:
+        path = os.path.join(str(directory), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+
+
+def review(session, ratings):
+    """Rate the next cases of a session; returns the names of the rated images."""
+    rated = []
+    for rating in ratings:
+        rated.append(os.path.basename(session.nifti_files[session.current_index]))
+        session.record_rating(rating)
+        session.advance()
+    return rated
+
+
+def test_listing_session_rates_and_finishes(tmp_path):
+    touch(tmp_path, "a.nii.gz", "a_mask.nii.gz", "b.nii.gz")
+    session = ReviewSession(use_case_index=False).open(str(tmp_path))
+    try:
+        assert session.n_files == 2
+        statuses = dict(zip(map(os.path.basename, session.nifti_files), session.seg_mask_status))
+        assert statuses == {"a.nii.gz": 2, "b.nii.gz": 0}
+        review(session, [2])
+        assert session.current_index == 1 and not session.finish_flag
+        review(session, [3])
+        assert session.finish_flag
+        # nothing is stored once all cases are checked
+        session.record_rating(1)
+    finally:
+        session.close()
+    annotations = read_annotation_csv(os.path.join(str(tmp_path), "annotations.csv"))
+    assert len(annotations) == 2
+    assert annotations["annotation"].tolist() == [rating_to_str(2), rating_to_str(3)]
+
+
+def test_resume_skips_the_annotated_cases(tmp_path):
+    touch(tmp_path, "a.nii.gz", "b.nii.gz", "c.nii.gz")
+    session = ReviewSession(use_case_index=False).open(str(tmp_path))
+    rated = review(session, [1, 4])
+    session.close()
+
+    session = ReviewSession(use_case_index=False).open(str(tmp_path))
+    try:
+        assert session.n_files == 1
+        assert os.path.basename(session.nifti_files[0]) not in rated
+        assert session.current_index == 0
+    finally:
+        session.close()
+
+
+def test_mapping_session(tmp_path):
+    touch(tmp_path, "img1.nii.gz", "seg1.nii.gz", "img2.nii.gz")
+    pd.DataFrame({"img_path": ["img1.nii.gz", "img2.nii.gz", "missing.nii.gz"],
+                  "mask_path": ["seg1.nii.gz", "seg2.nii.gz", None]}).to_csv(tmp_path / "mapping.csv", index=False)
+    session = ReviewSession(use_case_index=False).open(str(tmp_path))
+    try:
+        assert session.with_mapper_flag and not session.unique_case_flag
+        assert [os.path.basename(path) for path in session.nifti_files] == ["img1.nii.gz", "img2.nii.gz"]
+        # seg2 is named but missing: "cannot load"
+        assert session.seg_mask_status == [2, 1]
+        assert session.segmentation_files[1] == ""
+    finally:
+        session.close()
+
+
+def write_unique_mapping(directory):
+    touch(directory, "a1.nii.gz", "a2.nii.gz", "b1.nii.gz", "b2.nii.gz", "c1.nii.gz")
+    pd.DataFrame({"subj_id": ["a", "a", "b", "b", "c"],
+                  "img_path": ["a1.nii.gz", "a2.nii.gz", "b1.nii.gz", "b2.nii.gz", "c1.nii.gz"],
+                  "mask_path": [None] * 5}).to_csv(os.path.join(str(directory), "mapping_unique.csv"), index=False)
+
+
+def test_unique_mode_accepted_case_settles_its_subject(tmp_path):
+    write_unique_mapping(tmp_path)
+    session = ReviewSession(use_case_index=False).open(str(tmp_path))
+    try:
+        assert session.unique_case_flag
+        # minor changes: the next case of the subject is still shown
+        assert review(session, [2]) == ["a1.nii.gz"]
+        assert os.path.basename(session.nifti_files[session.current_index]) == "a2.nii.gz"
+        # accepted: the other case of b is skipped
+        assert review(session, [3, 1]) == ["a2.nii.gz", "b1.nii.gz"]
+        assert os.path.basename(session.nifti_files[session.current_index]) == "c1.nii.gz"
+        assert session.subject_checked(2) and session.subject_checked(3)
+        assert not session.subject_checked(0)
+    finally:
+        session.close()
+
+
+def test_unique_mode_restore_skips_subjects_with_any_annotated_case(tmp_path):
+    write_unique_mapping(tmp_path)
+    session = ReviewSession(use_case_index=False).open(str(tmp_path))
+    review(session, [2])
+    session.close()
+
+    session = ReviewSession(use_case_index=False).open(str(tmp_path))
+    try:
+        # as the module always restored: a2 is not shown again although a1 was not accepted
+        assert [os.path.basename(path) for path in session.nifti_files] == ["b1.nii.gz", "b2.nii.gz", "c1.nii.gz"]
+        assert session.id_subs == ["b", "b", "c"]
+    finally:
+        session.close()
+
+
+def test_unique_mode_skips_ahead_over_settled_subjects(tmp_path):
+    subjects = ["a", "b", "a", "c", "b", "a", "d"]
+    names = [f"{subj}{i}.nii.gz" for i, subj in enumerate(subjects)]
+    touch(tmp_path, *names)
+    pd.DataFrame({"subj_id": subjects, "img_path": names, "mask_path": [None] * 7}).to_csv(tmp_path / "mapping_unique.csv", index=False)
+    session = ReviewSession(use_case_index=False).open(str(tmp_path))
+    try:
+        assert list(session.pending_indexes(0)) == list(range(7))
+        # accepting a0 settles a2 and a5
+        session.record_rating(1)
+        assert list(session.pending_indexes(0)) == [1, 3, 4, 6]
+        assert session.next_pending(2) == 3 and session.next_pending(5) == 6
+        session.advance()
+        assert session.current_index == 1
+        # accepting b1 settles b4: from c3 the next case is d6
+        session.record_rating(1)
+        session.advance()
+        assert session.current_index == 3
+        assert session.next_pending(4) == 6
+        session.record_rating(1)
+        session.advance()
+        assert session.current_index == 6
+        session.record_rating(2)
+        assert not session.advance() and session.finish_flag
+        # the subjects accepted so far are skipped, d is not settled by a minor-changes rating
+        assert session.next_pending(0) == 6
+    finally:
+        session.close()
@@ -0,0 +1,41 @@
+import logging
+import os
+
+from SegmentationReviewLib.session_log import LOG_FILENAME, SessionLog
+
+
+def read(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def test_session_log_keeps_a_single_handler(tmp_path):
+    logger = logging.getLogger("SegmentationReviewTest")
+    # a file handler left over by an earlier instance of the module
+    stale = logging.FileHandler(str(tmp_path / "stale.log"))
+    logger.addHandler(stale)
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    log = SessionLog("SegmentationReviewTest")
+    try:
+        assert log.open(str(first)) == os.path.join(str(first), LOG_FILENAME)
+        assert logger.handlers == [log._queue_handler]
+        logger.info("in the first directory")
+        log.open(str(second))
+        log.open(str(second))
+        assert len(logger.handlers) == 1
+        logger.info("in the second directory")
+        # a reloaded module creates another instance: the handler of the previous one is replaced
+        reloaded = SessionLog("SegmentationReviewTest")
+        reloaded.open(str(second))
+        assert logger.handlers == [reloaded._queue_handler]
+        logger.info("after the reload")
+        reloaded.close()
+    finally:
+        log.close()
+    assert not logger.handlers
+    assert "in the first directory" in read(os.path.join(str(first), LOG_FILENAME))
+    second_log = read(os.path.join(str(second), LOG_FILENAME))
+    assert "in the first directory" not in second_log
+    assert second_log.count("in the second directory") == 1 and "after the reload" in second_log
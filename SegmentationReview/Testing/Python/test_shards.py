@@ -0,0 +1,83 @@
+import os
+
+import pandas as pd
+
+from SegmentationReviewLib.common import rating_to_str
+from SegmentationReviewLib.session import ReviewSession
+from SegmentationReviewLib.shards import CaseLeases, merge_annotations, read_all_annotations, reviewer_name
+from SegmentationReviewLib.store import CsvAnnotationStore, SqliteAnnotationStore
+
+
+def record(file, rating):
+    return {"file": file, "annotation": rating_to_str(rating), "comment": "", "mask_path": "", "mask_status": "No mask found"}
+
+
+def test_reviewer_name():
+    assert reviewer_name(" Jane Doe/PC ") == "Jane_Doe_PC"
+    assert reviewer_name("...") == "reviewer"
+
+
+def test_case_leases(tmp_path):
+    case = os.path.join(str(tmp_path), "sub", "a.nii.gz")
+    alice, bob = CaseLeases(str(tmp_path), "alice"), CaseLeases(str(tmp_path), "bob")
+    assert alice.claim(case) and alice.claim(case)
+    assert not bob.claim(case)
+    alice.release(case)
+    assert bob.claim(case)
+    bob.complete(case)
+    assert bob.is_done(case) and alice.is_done(case)
+    assert not alice.claim(case) and not bob.held
+
+
+def test_expired_leases_are_taken_over(tmp_path):
+    case = os.path.join(str(tmp_path), "a.nii.gz")
+    alice, bob = CaseLeases(str(tmp_path), "alice"), CaseLeases(str(tmp_path), "bob", ttl=60)
+    assert alice.claim(case)
+    assert not bob.claim(case)
+    lease = alice._path(case)
+    os.utime(lease, (os.stat(lease).st_atime - 120, os.stat(lease).st_mtime - 120))
+    assert bob.claim(case)
+    # alice's late rating still marks the case as done
+    alice.complete(case)
+    assert bob.is_done(case)
+
+
+def test_merge_annotations(tmp_path):
+    directory = str(tmp_path)
+    CsvAnnotationStore(directory).append(record("a.nii.gz", 1))
+    CsvAnnotationStore(directory, "annotations.alice.csv").append(record("a.nii.gz", 2))
+    # the SQLite file of a reviewer wins over its CSV export
+    CsvAnnotationStore(directory, "annotations.bob.csv").append(record("stale.nii.gz", 5))
+    store = SqliteAnnotationStore(directory, "annotations.bob.sqlite")
+    store.append(record("b.nii.gz", 3))
+    store.close()
+    annotations = read_all_annotations(directory)
+    assert sorted(zip(annotations["reviewer"], annotations["file"])) == [
+        ("", "a.nii.gz"), ("alice", "a.nii.gz"), ("bob", "b.nii.gz"), ("bob", "stale.nii.gz")]
+    merged = pd.read_csv(merge_annotations(directory), keep_default_na=False)
+    assert len(merged) == 4 and set(merged["reviewer"]) == {"", "alice", "bob"}
+
+
+def test_sharded_sessions_split_the_cases(tmp_path):
+    for name in ("a.nii.gz", "b.nii.gz", "c.nii.gz"):
+        open(os.path.join(str(tmp_path), name), "w").close()
+    alice = ReviewSession(use_case_index=False, reviewer="alice").open(str(tmp_path))
+    bob = ReviewSession(use_case_index=False, reviewer="bob").open(str(tmp_path))
+    try:
+        first_alice = alice.nifti_files[alice.current_index]
+        first_bob = bob.nifti_files[bob.current_index]
+        assert first_alice != first_bob
+        alice.record_rating(1)
+        # the case under review by bob is skipped
+        assert alice.advance()
+        assert alice.nifti_files[alice.current_index] not in (first_alice, first_bob)
+    finally:
+        alice.close()
+        bob.close()
+    assert os.path.exists(os.path.join(str(tmp_path), "annotations.alice.csv"))
+    # bob's case was not rated and its lease released: it is still to review, alice's is not
+    carol = ReviewSession(use_case_index=False, reviewer="carol").open(str(tmp_path))
+    try:
+        assert first_alice not in carol.nifti_files and first_bob in carol.nifti_files
+    finally:
+        carol.close()
@@ -0,0 +1,123 @@
+import os
+import sqlite3
+
+import pytest
+
+from SegmentationReviewLib.common import rating_to_str
+from SegmentationReviewLib.session import ReviewSession
+from SegmentationReviewLib.store import (CsvAnnotationStore, SqliteAnnotationStore, open_annotation_store,
+                                         read_annotation_csv)
+
+
+def record(file, rating=1, comment="", metrics=""):
+    return {"file": file, "annotation": rating_to_str(rating), "comment": comment, "mask_path": file.replace(".nii", "_mask.nii"),
+            "mask_status": "Mask loaded", "metrics": metrics}
+
+
+@pytest.mark.parametrize("backend", ["csv", "sqlite"])
+def test_store_round_trip(tmp_path, backend):
+    store = open_annotation_store(str(tmp_path), backend)
+    try:
+        store.append(record("a.nii.gz", 2, comment="edge"))
+        store.append(record("b.nii.gz", 4, metrics='{"seg": {"dice": 0.5}}'))
+        assert store.is_checked("a.nii.gz") and not store.is_checked("c.nii.gz")
+        annotations = store.read_annotations()
+        assert annotations["file"].tolist() == ["a.nii.gz", "b.nii.gz"]
+        assert annotations["metrics"].tolist() == ["", '{"seg": {"dice": 0.5}}']
+        assert store.read_checked()["annotation"].tolist() == [rating_to_str(2), rating_to_str(4)]
+        exported = store.export_csv(os.path.join(str(tmp_path), "export.csv"))
+    finally:
+        store.close()
+    if backend == "sqlite":
+        assert exported.endswith("export.csv")
+    assert read_annotation_csv(os.path.join(str(tmp_path), "export.csv"))["comment"].tolist()[0] == "edge"
+
+
+def test_csv_store_reads_rows_without_metrics(tmp_path):
+    path = os.path.join(str(tmp_path), "annotations.csv")
+    with open(path, "w") as f:
+        f.write("a.nii.gz,Acceptable with no changes,,a_mask.nii.gz,Mask loaded\n")
+        f.write('b.nii.gz,Bad images,,,No mask,"{""x"": 1}",extra\n')
+    annotations = CsvAnnotationStore(str(tmp_path)).read_annotations()
+    assert annotations["file"].tolist() == ["a.nii.gz", "b.nii.gz"]
+    assert annotations["metrics"].tolist() == ["", '{"x": 1}']
+
+
+def test_sqlite_store_imports_annotations_csv(tmp_path):
+    csv_store = CsvAnnotationStore(str(tmp_path))
+    csv_store.append(record("a.nii.gz"))
+    csv_store.append(record("a.nii.gz", 3))
+    store = SqliteAnnotationStore(str(tmp_path))
+    try:
+        assert store.read_annotations()["annotation"].tolist() == [rating_to_str(1), rating_to_str(3)]
+    finally:
+        store.close()
+    # reopening does not import the same rows again
+    store = SqliteAnnotationStore(str(tmp_path))
+    try:
+        assert len(store.read_annotations()) == 2
+    finally:
+        store.close()
+
+
+def test_switching_backends_keeps_all_ratings(tmp_path):
+    directory = str(tmp_path)
+    store = SqliteAnnotationStore(directory)
+    store.append(record("a.nii.gz"))
+    store.export_csv()
+    store.close()
+    # reviewed with the csv backend in between
+    CsvAnnotationStore(directory).append(record("b.nii.gz", 2))
+    store = SqliteAnnotationStore(directory)
+    store.append(record("c.nii.gz", 3))
+    store.export_csv()
+    store.close()
+    assert read_annotation_csv(os.path.join(directory, "annotations.csv"))["file"].tolist() == ["a.nii.gz", "b.nii.gz", "c.nii.gz"]
+
+
+def test_export_merges_rows_added_to_the_csv_while_open(tmp_path):
+    directory = str(tmp_path)
+    store = SqliteAnnotationStore(directory)
+    try:
+        store.append(record("a.nii.gz"))
+        CsvAnnotationStore(directory).append(record("b.nii.gz"))
+        store.export_csv()
+    finally:
+        store.close()
+    assert sorted(read_annotation_csv(os.path.join(directory, "annotations.csv"))["file"]) == ["a.nii.gz", "b.nii.gz"]
+
+
+def test_sqlite_store_opens_a_database_without_metrics(tmp_path):
+    connection = sqlite3.connect(os.path.join(str(tmp_path), "annotations.sqlite"))
+    connection.execute("CREATE TABLE annotations (id INTEGER PRIMARY KEY AUTOINCREMENT, file TEXT NOT NULL, subj_id TEXT,"
+                       " annotation TEXT, comment TEXT, mask_path TEXT, mask_status TEXT, created_at REAL)")
+    connection.execute("INSERT INTO annotations (file, annotation) VALUES ('a.nii.gz', 'Bad images')")
+    connection.commit()
+    connection.close()
+    store = SqliteAnnotationStore(str(tmp_path))
+    try:
+        assert store.read_annotations()["metrics"].tolist() == [""]
+        assert store.is_checked("a.nii.gz")
+    finally:
+        store.close()
+
+
+def test_session_sqlite_csv_sqlite_round_trip(tmp_path):
+    for name in ("a.nii.gz", "b.nii.gz", "c.nii.gz", "d.nii.gz"):
+        open(os.path.join(str(tmp_path), name), "w").close()
+    rated = []
+    for backend in ("sqlite", "csv", "sqlite"):
+        session = ReviewSession(annotation_backend=backend, use_case_index=False).open(str(tmp_path))
+        try:
+            assert session.n_files == 4 - len(rated)
+            rated.append(os.path.basename(session.nifti_files[session.current_index]))
+            session.record_rating(2)
+        finally:
+            session.close()
+    annotations = read_annotation_csv(os.path.join(str(tmp_path), "annotations.csv"))
+    assert annotations["file"].tolist() == rated
+    session = ReviewSession(annotation_backend="sqlite", use_case_index=False).open(str(tmp_path))
+    try:
+        assert session.n_files == 1
+    finally:
+        session.close()
@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+
+from SegmentationReviewLib.timing import TIMINGS_FILENAME, StageTimer, read_timings, summarize
+
+
+def test_disabled_timer_writes_nothing():
+    timer = StageTimer()
+    assert not timer.enabled
+    with timer.stage("volume_read"):
+        pass
+    timer.record("mask_write", 1.0)
+    timer.close()
+
+
+def test_timer_writes_json_lines(tmp_path):
+    path = str(tmp_path / TIMINGS_FILENAME)
+    timer = StageTimer(path)
+    timer.case = "a.nii.gz"
+    with timer.stage("volume_read"):
+        pass
+    with pytest.raises(RuntimeError):
+        with timer.stage("segmentation_load"):
+            raise RuntimeError("failed stages are timed too")
+    timer.record("mask_write", 2.5, case="b.nii.gz")
+    timer.close()
+    # closed: further stages are dropped
+    timer.record("mask_write", 1.0)
+    timings = read_timings(path)
+    assert timings["stage"].tolist() == ["volume_read", "segmentation_load", "mask_write"]
+    assert timings["case"].tolist() == ["a.nii.gz", "a.nii.gz", "b.nii.gz"]
+    assert timings["seconds"].iloc[-1] == 2.5
+
+
+def test_summarize():
+    timings = pd.DataFrame({"stage": ["read"] * 20 + ["load"] * 2, "seconds": list(range(1, 21)) + [100.0, 200.0]})
+    summary = summarize(timings)
+    assert summary.index.tolist() == ["load", "read"]
+    assert summary.loc["read", "count"] == 20 and summary.loc["read", "p50"] == 10.5
+    assert summary.loc["read", "p95"] == pytest.approx(19.05)
+    assert summary.loc["load", "total"] == 300.0
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+
+from SegmentationReviewLib.volume_cache import VolumeCache
+
+
+def test_volume_cache_round_trip(write_image, box_mask, tmp_path):
+    path = write_image("image.nii.gz", box_mask.astype(np.int16), spacing=(0.5, 1.0, 2.0))
+    cache = VolumeCache(str(tmp_path / "cache"))
+    assert cache.get(path) is None
+    array, geometry = cache.read(path)
+    assert isinstance(array, np.memmap)
+    np.testing.assert_array_equal(array, box_mask)
+    assert list(geometry["spacing"]) == [0.5, 1.0, 2.0]
+    cached, cached_geometry = cache.get(path)
+    np.testing.assert_array_equal(cached, box_mask)
+    assert cached_geometry == {key: list(value) for key, value in geometry.items()}
+    assert cache.total_bytes >= box_mask.size * 2
+
+
+def test_volume_cache_arrays_are_copy_on_write(write_image, box_mask, tmp_path):
+    path = write_image("image.nii.gz", box_mask)
+    cache = VolumeCache(str(tmp_path / "cache"))
+    array, _ = cache.read(path)
+    # writeable without a copy, as volume nodes need; the cache file is not changed
+    assert array.flags.writeable
+    array[:] = 9
+    np.testing.assert_array_equal(cache.get(path)[0], box_mask)
+
+
+def test_volume_cache_reads_changed_files_again(write_image, box_mask, tmp_path):
+    path = write_image("image.nii.gz", box_mask)
+    cache = VolumeCache(str(tmp_path / "cache"))
+    cache.read(path)
+    write_image("image.nii.gz", box_mask * 3)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    np.testing.assert_array_equal(cache.read(path)[0], box_mask * 3)
+
+
+def test_volume_cache_evicts_least_recently_used(write_image, box_mask, tmp_path):
+    paths = [write_image(f"image{i}.nii.gz", box_mask) for i in range(3)]
+    cache = VolumeCache(str(tmp_path / "cache"), max_bytes=box_mask.nbytes * 2 + 1024)
+    for i, path in enumerate(paths):
+        cache.read(path)
+        # distinct last-use times, whatever the filesystem resolution
+        info_path = cache._paths(cache._key(path))[1]
+        os.utime(info_path, ns=(10 ** 18 + i * 10 ** 9, 10 ** 18 + i * 10 ** 9))
+    cache.evict()
+    assert cache.get(paths[0]) is None
+    assert cache.get(paths[2]) is not None
+    cache.clear()
+    assert cache.total_bytes == 0
+    # volumes larger than the cache are read, not cached
+    cache.max_bytes = 0
+    array, _ = cache.read(paths[1])
+    assert not isinstance(array, np.memmap)